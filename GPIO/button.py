@@ -0,0 +1,186 @@
+# Edge-triggered button input with debounce and long-press detection
+#
+#   backend: rpi_backend (RPi.GPIO) / sim_backend (no hardware, for tests)
+#   events : 'press'  (button down)
+#            'short'  (released before long_press seconds)
+#            'long'   (held for long_press seconds)
+import time
+import queue
+import threading
+
+HIGH = 1
+LOW = 0
+
+# ----- Hardware abstraction
+class gpio_backend():
+    def setup_input(self, pin): raise NotImplementedError
+    def setup_output(self, pin): raise NotImplementedError
+    def input(self, pin): raise NotImplementedError
+    def output(self, pin, level): raise NotImplementedError
+    def watch(self, pin, callback, bouncetime=50):
+        ''' call callback(level, t) on both edges '''
+        raise NotImplementedError
+    def cleanup(self): pass
+
+class rpi_backend(gpio_backend):
+    def __init__(self):
+        import RPi.GPIO as GPIO
+        self.GPIO = GPIO
+        GPIO.setmode(GPIO.BCM)
+
+    def setup_input(self, pin):
+        self.GPIO.setup(pin, self.GPIO.IN)
+
+    def setup_output(self, pin):
+        self.GPIO.setup(pin, self.GPIO.OUT)
+
+    def input(self, pin):
+        return HIGH if self.GPIO.input(pin) == self.GPIO.HIGH else LOW
+
+    def output(self, pin, level):
+        self.GPIO.output(pin, self.GPIO.HIGH if level else self.GPIO.LOW)
+
+    def watch(self, pin, callback, bouncetime=50):
+        self.GPIO.add_event_detect(pin, self.GPIO.BOTH, bouncetime=bouncetime,
+            callback=lambda ch: callback(self.input(ch), time.monotonic()))
+
+    def cleanup(self):
+        self.GPIO.cleanup()
+
+class sim_backend(gpio_backend):
+    ''' simulated pins: drive inputs with press()/release() '''
+    def __init__(self):
+        self.levels = {}
+        self.callbacks = {}
+        self.outputs = [] # (pin, level) history
+
+    def setup_input(self, pin):
+        self.levels.setdefault(pin, LOW)
+
+    def setup_output(self, pin):
+        self.levels.setdefault(pin, LOW)
+
+    def input(self, pin):
+        return self.levels.get(pin, LOW)
+
+    def output(self, pin, level):
+        self.levels[pin] = level
+        self.outputs.append((pin, level))
+
+    def watch(self, pin, callback, bouncetime=50):
+        self.callbacks[pin] = callback
+
+    def set_input(self, pin, level):
+        self.levels[pin] = level
+        if pin in self.callbacks:
+            self.callbacks[pin](level, time.monotonic())
+
+    def press(self, pin):
+        self.set_input(pin, HIGH)
+
+    def release(self, pin):
+        self.set_input(pin, LOW)
+
+    def click(self, pin, hold=0.0):
+        self.press(pin)
+        time.sleep(hold)
+        self.release(pin)
+
+# ----- Button
+class button():
+    def __init__(self, backend, pin, long_press=3.0, debounce=0.05, on_press=None):
+        self.backend = backend
+        self.pin = pin
+        self.on_press = on_press       # called with t on the press edge (GPIO thread, keep it short)
+        self.long_press = long_press   # hold recognition time (s)
+        self.debounce = debounce       # ignore edges closer than this (s)
+        self._events = queue.Queue()
+        self._lock = threading.Lock()
+        self._down = False
+        self._t_edge = 0.0
+        self._timer = None
+        self._long_fired = False
+        self._ignore = False           # suppress short/long of the current press
+        backend.setup_input(pin)
+        backend.watch(pin, self._edge, int(debounce * 1000))
+
+    @property
+    def held(self):
+        return self._down
+
+    def _edge(self, level, t):
+        with self._lock:
+            down = level == HIGH
+            if down == self._down:
+                return # duplicated edge
+            if t - self._t_edge < self.debounce:
+                # bounce, or a real release right after the press: look at the pin again once it settles
+                timer = threading.Timer(self.debounce, self._resample)
+                timer.daemon = True
+                timer.start()
+                return
+            self._apply(down, t)
+
+    def _resample(self):
+        level = self.backend.input(self.pin)
+        with self._lock:
+            if (level == HIGH) != self._down:
+                self._apply(level == HIGH, time.monotonic())
+
+    def _apply(self, down, t):
+        ''' a debounced edge (called with the lock held) '''
+        self._down = down
+        self._t_edge = t
+        if down:
+            self._long_fired = False
+            self._ignore = False
+            self._timer = threading.Timer(self.long_press, self._long, (t,))
+            self._timer.daemon = True
+            self._timer.start()
+            if self.on_press: self.on_press(t)
+            self._events.put(('press', t))
+        else:
+            if self._timer: self._timer.cancel()
+            if not self._long_fired and not self._ignore:
+                self._events.put(('short', t))
+
+    def _long(self, t):
+        with self._lock:
+            if self._down and self._t_edge == t and not self._ignore:
+                if self.backend.input(self.pin) != HIGH: # the release was missed
+                    self._apply(False, time.monotonic())
+                    return
+                self._long_fired = True
+                self._events.put(('long', time.monotonic()))
+
+    def wait(self, kinds=('press', 'short', 'long'), timeout=None):
+        ''' block until one of kinds happens, return (kind, t) or None on timeout '''
+        end = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remain = None if end is None else max(0.0, end - time.monotonic())
+            try:
+                kind, t = self._events.get(timeout=remain)
+            except queue.Empty:
+                return None
+            if kind in kinds:
+                return kind, t
+
+    def poll(self, kinds=('press', 'short', 'long')):
+        ''' non-blocking version of wait() '''
+        while True:
+            try:
+                kind, t = self._events.get_nowait()
+            except queue.Empty:
+                return None
+            if kind in kinds:
+                return kind, t
+
+    def consume(self):
+        ''' the current press was handled; do not report its short/long '''
+        with self._lock:
+            self._ignore = True
+            if self._timer: self._timer.cancel()
+
+    def clear(self):
+        while not self._events.empty():
+            self._events.get_nowait()
@@ -1,24 +1,129 @@
 # LOG表示関連をまとめたヘッダーファイル
-# コンソール出力用ハンドラー終了
+#
+# logger.debug/info/error はキューに入れるだけ (数 us), コンソールとファイルへの書き込みは
+# 別スレッド (QueueListener) で行うので, フレームを読むスレッドが SD カードの I/O やローテーションで止まらない
+#
+#   logger.info('...')                          テキスト (コンソール, ./log/app.log)
+#   log_event('session', frames=300, dropped=0) 構造化ログ (./log/app.jsonl, 1行1 JSON)
+#
+# 同じ呼び出し箇所からのログは RATE_LIMIT 件/RATE_PERIOD 秒まで (超えた分は数えて次のログに付ける)
+# python3 logger.py で呼び出し側の時間を計る
+import os
+import json
+import time
+import queue
+import atexit
 import logging
 import logging.handlers
+
+LOG_DIR = './log'
+LOG_FILE = 'app.log'
+JSONL_FILE = 'app.jsonl'   # 構造化ログ (None で無効)
+RATE_LIMIT = 20            # 呼び出し箇所ごとの上限 (0 で無効)
+RATE_PERIOD = 1.0          # (s)
+FORMAT = ' %(module)s -  %(asctime)s - %(levelname)s - %(message)s'
+
+os.makedirs(LOG_DIR, exist_ok=True)
+
+# ----- 呼び出し箇所ごとの流量制限 (呼び出し側のスレッドで動くので軽く)
+class rate_limit(logging.Filter):
+    def __init__(self, limit=RATE_LIMIT, period=RATE_PERIOD):
+        super().__init__()
+        self.limit = limit
+        self.period = period
+        self._state = {} # (pathname, lineno) -> [区間の開始, 件数, 捨てた数]
+
+    def filter(self, record):
+        if not self.limit or record.levelno >= logging.ERROR: return True # エラーは常に残す
+        key = (record.pathname, record.lineno)
+        now = record.created
+        st = self._state.get(key)
+        if st is None:
+            self._state[key] = [now, 1, 0]
+            return True
+        if now - st[0] >= self.period:
+            if st[2]: record.suppressed = st[2]
+            st[0], st[1], st[2] = now, 1, 0
+            return True
+        if st[1] < self.limit:
+            st[1] += 1
+            return True
+        st[2] += 1
+        return False
+
+# ----- キュー (整形は書き込みスレッドで行う)
+class _queue_handler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        return record # 同じプロセスのスレッドに渡すだけなので複製も整形もしない
+
+class _text_formatter(logging.Formatter):
+    def format(self, record):
+        s = super().format(record)
+        n = getattr(record, 'suppressed', 0)
+        return f'{s} (+{n} suppressed)' if n else s
+
+class _json_formatter(logging.Formatter):
+    def format(self, record):
+        out = {'t': round(record.created, 6), 'level': record.levelname, 'module': record.module,
+               'msg': record.getMessage()}
+        out.update(getattr(record, 'data', None) or {})
+        if getattr(record, 'suppressed', 0): out['suppressed'] = record.suppressed
+        return json.dumps(out, ensure_ascii=False, default=str)
+
+class _only_events(logging.Filter):
+    def filter(self, record):
+        return hasattr(record, 'data')
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
+logger.propagate = False
+
+# コンソール出力用ハンドラー
 handler = logging.StreamHandler()
-handler.setFormatter(logging.Formatter(
-    ' %(module)s -  %(asctime)s - %(levelname)s - %(message)s'))
-logger.addHandler(handler)
+handler.setFormatter(_text_formatter(FORMAT))
 
 # ログファイルに出力する
 # ローテーティングファイルハンドラを作成
 rh = logging.handlers.RotatingFileHandler(
-        r'./log/app.log', 
+        os.path.join(LOG_DIR, LOG_FILE),
         encoding='utf-8',
         maxBytes=100000,    # 100kB
         backupCount=3
     )
+rh.setFormatter(_text_formatter(FORMAT))
+
+handlers = [handler, rh]
+if JSONL_FILE:
+    jh = logging.handlers.RotatingFileHandler(
+            os.path.join(LOG_DIR, JSONL_FILE), encoding='utf-8', maxBytes=10000000, backupCount=3)
+    jh.setFormatter(_json_formatter())
+    jh.addFilter(_only_events())
+    handlers.append(jh)
+
+log_queue = queue.SimpleQueue()
+listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+qh = _queue_handler(log_queue)
+qh.addFilter(rate_limit())
+logger.addHandler(qh)
+listener.start()
+atexit.register(listener.stop) # 終了時に残りを書き出す
 
-rh.setFormatter(logging.Formatter(
-    ' %(module)s -  %(asctime)s - %(levelname)s - %(message)s'))
+def log_event(kind, level=logging.INFO, **data):
+    ''' 構造化ログ (app.jsonl に {"msg": kind, ...data} の1行, テキストのログにも出る) '''
+    logger.log(level, kind + ' ' + ' '.join(f'{k}={v}' for k, v in data.items()), extra={'data': dict(data, event=kind)},
+               stacklevel=2)
 
-logger.addHandler(rh)
\ No newline at end of file
+if __name__ == '__main__':
+    # 呼び出し側の時間 (書き込みは別スレッド)
+    n = 20000
+    limiter = qh.filters[0]
+    for name, limit in (('info', 0), ('info (rate limited)', RATE_LIMIT), ('log_event', 0)):
+        limiter.limit = limit
+        t = time.perf_counter()
+        for i in range(n):
+            if name == 'log_event':
+                log_event('bench', i=i)
+            else:
+                logger.info(f'bench {i}')
+        us = (time.perf_counter() - t) * 1e6 / n
+        print(f'{name}: {us:.1f} us/call', flush=True)
@@ -1,24 +1,34 @@
 import cv2
-import RPi.GPIO as GPIO
 import numpy as np
 import pyrealsense2 as rs
 import os
 import sys
 import time
 import datetime
+import collections
+from button import rpi_backend, button, HIGH, LOW
 from logger import *
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Realsense'))
+from raw_rec import profile_streams, frameset_images, bag_sink
+from segment import segment_writer
+from depth_codec import frame_codec
+from metrics import stage_metrics
+from warm_rec import warm_recorder
+from frame_health import frame_health, frame_bytes, queue_capacity
 
 LED_GPIO = 4
 TACT_GPIO = 17
+LONG_PRESS = 3 # hold recognition time (s)
+WARM = True    # keep streaming between recordings and start on the press edge (--cold: restart per press)
 
-GPIO.setmode(GPIO.BCM)
-GPIO.setup(LED_GPIO, GPIO.OUT)
-GPIO.setup(TACT_GPIO, GPIO.IN)
+io = rpi_backend()
+io.setup_output(LED_GPIO)
+btn = button(io, TACT_GPIO, long_press=LONG_PRESS)
 
 # ----- LED test
-GPIO.output(LED_GPIO, GPIO.HIGH)
+io.output(LED_GPIO, HIGH)
 time.sleep(1.0)
-GPIO.output(LED_GPIO, GPIO.LOW)
+io.output(LED_GPIO, LOW)
 
 # ----- Realsense class
 class _realsense():
@@ -27,39 +37,118 @@ class _realsense():
         self.save_dir = f'{self.save_dir_}{os.listdir(self.save_dir_)[0]}/Realsense_rec' # save dir
         self.video_size = (1280, 720) # video size
         self.fps = 30                 # frame rate
-        self.video_length = 5         # recode frame (False = inf)
+        self.video_length = False     # recode frame (False = inf, not used with segment_sec / segment_bytes)
+        self.segment_sec = 300        # start a new file every N seconds (False = one file)
+        self.segment_bytes = False    # start a new file every N bytes (False = no limit)
+        self.segment_fmt = 'raw'      # segment format ('bag' / 'raw')
+        self.compress = ('depth',)    # lossless compression of these streams ('raw' only, () = off)
+        self.codec_workers = 3        # compression threads (leave one core for capture)
+        self.preroll_sec = 3          # keep N seconds before the press (warm mode, 0 = off)
+                                      # depth is compressed in memory with the same codec
+                                      # (IR is noisy and hardly shrinks, it is kept uncompressed)
+        self.queue_latency_ms = 1000  # frame queue length: at most this much delay
+        self.queue_memory_mb = 128    # and at most this much memory (~5.5 MB/frameset)
         self.config = rs.config()
         self.config.enable_stream(rs.stream.infrared, 1, *self.video_size, rs.format.y8, self.fps)
         self.config.enable_stream(rs.stream.depth, *self.video_size, rs.format.z16, self.fps)
         self.config.enable_stream(rs.stream.color, *self.video_size, rs.format.rgb8, self.fps)
         os.makedirs(self.save_dir, exist_ok=True)
+        self.metrics = stage_metrics('recbag', export_sec=10,
+            jsonl=f'{self.save_dir}/metrics.jsonl', prom=f'{self.save_dir}/metrics.prom')
         logger.debug(f'save_dir: {self.save_dir}')
         logger.debug(f'size: {self.video_size}, fps: {self.fps}')
 
+    def start(self):
+        ''' warm mode: start the pipeline (and codec threads) once, recordings only switch the sink '''
+        self.codec = None
+        if self.compress and (self.segment_fmt == 'raw' or self.preroll_sec):
+            self.codec = frame_codec('left', level=1, workers=self.codec_workers)
+        self.rec = warm_recorder(self.config, self._sink, self.metrics, log=logger.info,
+                                 queue_latency_ms=self.queue_latency_ms, queue_memory_mb=self.queue_memory_mb,
+                                 preroll_sec=self.preroll_sec, codec=self.codec, compress=self.compress)
+        self.rec.start()
+
+    def _sink(self, path, streams):
+        if self.segment_sec or self.segment_bytes:
+            codec = self.codec if self.segment_fmt == 'raw' else None
+            return segment_writer(path, streams, self.segment_fmt, self.segment_sec, self.segment_bytes,
+                                  codec=codec, compress=self.compress)
+        return bag_sink(path + '.bag', streams)
+
+    def recode_warm(self, t_press):
+        dt = datetime.datetime.now()
+        filename = '/recorded_' + dt.strftime('%Y%m%d_%H%M%S') # session dir (or .bag)
+        logger.debug(f'filename: {filename}')
+        max_frames = None if self.segment_sec or self.segment_bytes else self.video_length # segments replace the cap
+        kind = self.rec.take(btn, self.save_dir+filename, t_press, max_frames)
+        log_event('session', file=filename, warm=True, **self.rec.last_summary)
+        return kind
+
+    def close(self):
+        self.rec.close()
+        if self.codec:
+            s = self.codec.stats()
+            logger.info(f'codec: ratio {s["ratio"]:.2f}, encode {s["encode_MBps"]:.1f} MB/s/thread, {s["MB_out"]:.0f} MB written')
+            self.codec.close()
+        logger.info(f'frames: {self.rec.frames}, dropped: {self.rec.dropped}')
+        log_event('frame_health', warm=True, **self.rec.health.summary())
+
     def recode(self):
         dt = datetime.datetime.now()
-        filename = '/recorded_' + dt.strftime('%Y%m%d_%H%M%S') + '.bag' # file name
-        self.config.enable_record_to_file(self.save_dir+filename)
-        queue = rs.frame_queue(50, keep_frames=True)
+        segmented = self.segment_sec or self.segment_bytes
+        if segmented:
+            filename = '/recorded_' + dt.strftime('%Y%m%d_%H%M%S') # session dir
+        else:
+            filename = '/recorded_' + dt.strftime('%Y%m%d_%H%M%S') + '.bag' # file name
+            self.config.enable_record_to_file(self.save_dir+filename)
+        cap = queue_capacity(frame_bytes([(*self.video_size, 1), (*self.video_size, 2), (*self.video_size, 3)]),
+                             self.fps, self.queue_latency_ms, self.queue_memory_mb)
+        queue = rs.frame_queue(cap, keep_frames=True)
+        health = frame_health(cap, self.fps)
         self.pipeline = rs.pipeline()
         # self.pipeline.start(self.config)
-        self.pipeline.start(self.config, queue)
+        profile = self.pipeline.start(self.config, queue)
+        writer = None
+        codec = None
+        if segmented:
+            if self.segment_fmt == 'raw' and self.compress:
+                codec = frame_codec('left', level=1, workers=self.codec_workers)
+            writer = segment_writer(self.save_dir+filename, profile_streams(profile), self.segment_fmt,
+                                    self.segment_sec, self.segment_bytes, codec=codec, compress=self.compress)
         self.frame_no = 1
+        self.dropped = 0
+        waiting = collections.deque()
+        btn.clear()
+        t0, c0 = time.time(), time.process_time()
         logger.debug(f'filename: {filename}')
         try:
+            m = self.metrics
             while True:
-                frames = queue.wait_for_frame()
+                t = m.start()
+                if not waiting: # everything waiting in the queue, oldest first (drops / desync / occupancy are recorded)
+                    waiting.extend(health.drain(queue))
+                    if not waiting: raise RuntimeError("Frame didn't arrive within 5000")
+                frames = waiting.popleft()
+                t = m.lap('wait', t)
                 # frames = self.pipeline.wait_for_frames()
                 color_frame = frames.as_frameset().get_color_frame()
                 ir_frame = frames.as_frameset().get_infrared_frame()
+                if writer:
+                    fs = frames.as_frameset()
+                    writer.write(fs.get_frame_number(), fs.get_timestamp(), frameset_images(fs))
+                    t = m.lap('write', t)
                 self.frame_no += 1
                 if not ir_frame or not color_frame:
                     ir_image = np.asanyarray(ir_frame .get_data())
                     color_image = np.asanyarray(color_frame.get_data())
-                if GPIO.input(TACT_GPIO) == GPIO.HIGH:
-                    GPIO.output(LED_GPIO, GPIO.LOW)
+                m.latency(frames)
+                health.gauges(m)
+                m.tick()
+                if btn.poll(('press',)): # stop on the next press (no polling of the pin)
+                    btn.consume()
+                    io.output(LED_GPIO, LOW)
                     break
-                if self.video_length:
+                if self.video_length and not segmented:
                     if self.frame_no > self.video_length:
                         break
         except Exception as e:
@@ -67,47 +156,67 @@ class _realsense():
         finally:
             logger.info('--- stop recoding ---')
             self.pipeline.stop()
-
-# ----- Timer class
-class _timer():
-    def __init__(self):
-        self.quit_intv = 3 # hold recognition time (s)
-        self.b_push = False
-        self.cnt = 0
-
-    def _diff_t(self):
-        self.cnt += 1
-        if not self.b_push: # first exec
-            self.b_push = datetime.datetime.now()
-            return False
-        return (datetime.datetime.now()-self.b_push).seconds >= self.quit_intv
+            hs = health.report(logger.info)
+            self.dropped = hs['dropped']
+            if writer:
+                writer.close()
+                logger.info(f'segments: {len(writer.manifest["segments"])}, dropped (codec behind): {writer.dropped}')
+            if codec:
+                s = codec.stats()
+                logger.info(f'codec: ratio {s["ratio"]:.2f}, encode {s["encode_MBps"]:.1f} MB/s/thread, {s["MB_out"]:.0f} MB written')
+                codec.close()
+            wall = max(time.time() - t0, 1e-9)
+            cpu = 100*(time.process_time()-c0)/wall
+            logger.info(f'frames: {self.frame_no}, dropped: {self.dropped}, cpu: {cpu:.0f} %')
+            log_event('session', file=filename, warm=False, frames=self.frame_no, dropped=self.dropped,
+                      sec=round(wall, 2), cpu=round(cpu, 1))
+            log_event('frame_health', file=filename, warm=False, **hs)
 
 # ----- main function
+def main_warm():
+    rs_mod = _realsense() # once (save dir lookup and device start are not repeated per press)
+    rs_mod.start()
+    btn.on_press = rs_mod.rec.arm # start holding frames on the press edge
+    try:
+        while True:
+            io.output(LED_GPIO, LOW)
+            logger.info('--- start program ---')
+            _, t_press = btn.wait(('press',)) # start on the press edge, not the release
+            io.output(LED_GPIO, HIGH)
+            logger.info('--- start recoding ---')
+            kind = rs_mod.recode_warm(t_press)
+            logger.info('--- stop recoding ---')
+            if kind == 'long': # hold button
+                for i in range(6):
+                    io.output(LED_GPIO, HIGH if i%2 else LOW)
+                    time.sleep(0.1)
+                logger.info('--- stop program ---')
+                break
+    finally:
+        rs_mod.close()
+        io.cleanup()
+
 def main():
-    ex_flag = False
     while True:
-        GPIO.output(LED_GPIO, GPIO.LOW)
+        io.output(LED_GPIO, LOW)
         logger.info('--- start program ---')
-        tt = _timer()
-        while True:
-            if ex_flag: break
-            if GPIO.input(TACT_GPIO) == GPIO.HIGH:
-                if tt._diff_t():    # hold button
-                    for i in range(6):
-                        GPIO.output(LED_GPIO, GPIO.HIGH if i%2 else GPIO.LOW)
-                        time.sleep(0.1)
-                    GPIO.cleanup()
-                    logger.info('--- stop program ---')
-                    ex_flag = True
-                    break
-            elif tt.cnt > 0: break  # release button
+        kind, _ = btn.wait(('short', 'long')) # sleeps until the button is used
+        if kind == 'long':  # hold button
+            for i in range(6):
+                io.output(LED_GPIO, HIGH if i%2 else LOW)
+                time.sleep(0.1)
+            io.cleanup()
+            logger.info('--- stop program ---')
+            break
 
-        if ex_flag: break
         logger.info('--- start recoding ---')
         rs_mod = _realsense()
-        GPIO.output(LED_GPIO, GPIO.HIGH)
+        io.output(LED_GPIO, HIGH)
         rs_mod.recode()
 
 if __name__ == '__main__':
-    main()
+    if WARM and '--cold' not in sys.argv:
+        main_warm()
+    else:
+        main()
     logger.info('--- exit program ---')
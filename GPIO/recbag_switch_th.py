@@ -1,24 +1,32 @@
 import cv2
-import RPi.GPIO as GPIO
 import numpy as np
 import pyrealsense2 as rs
 import os
 import sys
 import time
 import datetime
+import collections
+from button import rpi_backend, button, HIGH, LOW
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Realsense'))
+from metrics import stage_metrics
+from raw_rec import bag_sink
+from warm_rec import warm_recorder
+from frame_health import frame_health, frame_bytes, queue_capacity
 import threading
 
 LED_GPIO = 4
 TACT_GPIO = 17
+LONG_PRESS = 3 # hold recognition time (s)
+WARM = True    # keep streaming between recordings and start on the press edge (--cold: restart per press)
 
-GPIO.setmode(GPIO.BCM)
-GPIO.setup(LED_GPIO, GPIO.OUT)
-GPIO.setup(TACT_GPIO, GPIO.IN)
+io = rpi_backend()
+io.setup_output(LED_GPIO)
+btn = button(io, TACT_GPIO, long_press=LONG_PRESS)
 
 # ----- LED test
-GPIO.output(LED_GPIO, GPIO.HIGH)
+io.output(LED_GPIO, HIGH)
 time.sleep(1.0)
-GPIO.output(LED_GPIO, GPIO.LOW)
+io.output(LED_GPIO, LOW)
 
 # ----- Realsense class
 class _realsense():
@@ -27,32 +35,58 @@ class _realsense():
         self.save_dir = f'{self.save_dir_}{os.listdir(self.save_dir_)[0]}/Realsense_rec' # save dir
         self.video_size = (1280, 720) # video size
         self.fps = 30                 # frame rate
+        self.preroll_sec = 0          # keep N seconds before the press (warm mode, 0 = off, ~5.5 MB/frame raw)
+        self.queue_latency_ms = 1000  # frame queue length: at most this much delay
+        self.queue_memory_mb = 128    # and at most this much memory (~5.5 MB/frameset)
         self.config = rs.config()
         self.config.enable_stream(rs.stream.infrared, 1, *self.video_size, rs.format.y8, self.fps)
         self.config.enable_stream(rs.stream.depth, *self.video_size, rs.format.z16, self.fps)
         self.config.enable_stream(rs.stream.color, *self.video_size, rs.format.rgb8, self.fps)
         os.makedirs(self.save_dir, exist_ok=True)
+        self.metrics = stage_metrics('recbag', export_sec=10,
+            jsonl=f'{self.save_dir}/metrics.jsonl', prom=f'{self.save_dir}/metrics.prom')
+
+    def start(self):
+        ''' warm mode: start the pipeline once, recordings only switch the bag sink '''
+        self.rec = warm_recorder(self.config, lambda path, streams: bag_sink(path, streams), self.metrics,
+                                 queue_latency_ms=self.queue_latency_ms, queue_memory_mb=self.queue_memory_mb,
+                                 preroll_sec=self.preroll_sec)
+        self.rec.start()
+
+    def recode_warm(self, t_press):
+        dt = datetime.datetime.now()
+        filename = '/recorded_' + dt.strftime('%Y%m%d_%H%M%S') + '.bag' # file name
+        print(f'filename: {filename}')
+        return self.rec.take(btn, self.save_dir+filename, t_press)
+
+    def close(self):
+        self.rec.close()
 
     def recode(self):
         dt = datetime.datetime.now()
         filename = '/recorded_' + dt.strftime('%Y%m%d_%H%M%S') + '.bag' # file name
         self.config.enable_record_to_file(self.save_dir+filename)
-        self.queue = rs.frame_queue(50, keep_frames=True)
+        cap = queue_capacity(frame_bytes([(*self.video_size, 1), (*self.video_size, 2), (*self.video_size, 3)]),
+                             self.fps, self.queue_latency_ms, self.queue_memory_mb)
+        self.queue = rs.frame_queue(cap, keep_frames=True)
+        self.health = frame_health(cap, self.fps)
         self.pipeline = rs.pipeline()
         # self.pipeline.start(self.config)
         self.pipeline.start(self.config, self.queue)
         self.frame_no = 1
+        self.dropped = 0
+        btn.clear()
+        t0, c0 = time.time(), time.process_time()
         try:
             self._daemon_status = True
             th = threading.Thread(target=self._get_frame)
-            th.setDaemon(True)
+            th.daemon = True
             th.start()
 
-            while True:
-                if GPIO.input(TACT_GPIO) == GPIO.HIGH:
-                    GPIO.output(LED_GPIO, GPIO.LOW)
-                    self._daemon_status = False
-                    break
+            btn.wait(('press',)) # sleeps until the button is pressed
+            btn.consume()
+            io.output(LED_GPIO, LOW)
+            self._daemon_status = False
             th.join()
 
         except Exception as e:
@@ -60,60 +94,78 @@ class _realsense():
         finally:
             print('--- stop recoding ---')
             self.pipeline.stop()
+            self.dropped = self.health.report(print)['dropped']
+            wall = max(time.time() - t0, 1e-9)
+            print(f'frames: {self.frame_no}, dropped: {self.dropped}, cpu: {100*(time.process_time()-c0)/wall:.0f} %')
 
     def _get_frame(self):
+        waiting = collections.deque()
+        m = self.metrics
         while self._daemon_status:
-            frames = self.queue.wait_for_frame()
+            t = m.start()
+            if not waiting: # everything waiting in the queue, oldest first (drops / desync / occupancy are recorded)
+                waiting.extend(self.health.drain(self.queue, 100))
+                if not waiting: continue
+            frames = waiting.popleft()
+            m.lap('wait', t)
+            m.latency(frames)
+            self.health.gauges(m)
+            m.tick()
             # frames = self.pipeline.wait_for_frames()
             color_frame = frames.as_frameset().get_color_frame()
             ir_frame = frames.as_frameset().get_infrared_frame()
             self.color_frame = color_frame
             self.ir_frame = ir_frame
-            self._daemon_status = False
 
             self.frame_no += 1
             if not ir_frame or not color_frame:
                 ir_image = np.asanyarray(ir_frame .get_data())
                 color_image = np.asanyarray(color_frame.get_data())
 
-# ----- Timer class
-class _timer():
-    def __init__(self):
-        self.quit_intv = 3 # hold recognition time (s)
-        self.b_push = False
-        self.cnt = 0
-
-    def _diff_t(self):
-        self.cnt += 1
-        if not self.b_push: # first exec
-            self.b_push = datetime.datetime.now()
-            return False
-        return (datetime.datetime.now()-self.b_push).seconds > self.quit_intv
-
 # ----- main function
+def main_warm():
+    rs_mod = _realsense() # once (save dir lookup and device start are not repeated per press)
+    rs_mod.start()
+    btn.on_press = rs_mod.rec.arm # start holding frames on the press edge
+    try:
+        while True:
+            io.output(LED_GPIO, LOW)
+            print('--- start program ---')
+            _, t_press = btn.wait(('press',)) # start on the press edge, not the release
+            io.output(LED_GPIO, HIGH)
+            print('--- start recoding ---')
+            kind = rs_mod.recode_warm(t_press)
+            print('--- stop recoding ---')
+            if kind == 'long': # hold button
+                for i in range(6):
+                    io.output(LED_GPIO, HIGH if i%2 else LOW)
+                    time.sleep(0.1)
+                print('--- stop program ---')
+                break
+    finally:
+        rs_mod.close()
+        io.cleanup()
+
 def main():
-    ex_flag = False
     while True:
+        io.output(LED_GPIO, LOW)
         print('--- start program ---')
-        tt = _timer()
-        while True:
-            if ex_flag: break
-            if GPIO.input(TACT_GPIO) == GPIO.HIGH:
-                if tt._diff_t():    # hold button
-                    for i in range(6):
-                        GPIO.output(LED_GPIO, GPIO.HIGH if i%2 else GPIO.LOW)
-                        time.sleep(0.1)
-                    GPIO.cleanup()
-                    print('--- stop program ---')
-                    ex_flag = True
-                    break
-            elif tt.cnt > 0: break  # push button
-
-        if ex_flag: break
+        kind, _ = btn.wait(('short', 'long')) # sleeps until the button is used
+        if kind == 'long':  # hold button
+            for i in range(6):
+                io.output(LED_GPIO, HIGH if i%2 else LOW)
+                time.sleep(0.1)
+            io.cleanup()
+            print('--- stop program ---')
+            break
+
         print('--- start recoding ---')
         rs_mod = _realsense()
-        GPIO.output(LED_GPIO, GPIO.HIGH)
+        io.output(LED_GPIO, HIGH)
         rs_mod.recode()
 
 if __name__ == '__main__':
-    main()
+    if WARM and '--cold' not in sys.argv:
+        main_warm()
+    else:
+        main()
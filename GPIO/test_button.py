@@ -0,0 +1,70 @@
+# button.py with the simulated backend (no Raspberry Pi needed): python3 -m pytest test_button.py
+import time
+from button import sim_backend, button
+
+PIN = 17
+
+def make(long_press=0.3, debounce=0.01):
+    io = sim_backend()
+    return io, button(io, PIN, long_press=long_press, debounce=debounce)
+
+def test_short_press():
+    io, btn = make()
+    io.click(PIN, 0.05)
+    assert btn.wait(timeout=1)[0] == 'press'
+    assert btn.wait(timeout=1)[0] == 'short'
+
+def test_bounce_is_ignored():
+    io, btn = make()
+    io.press(PIN)
+    io.release(PIN) # bounce, the pin settles high again
+    io.press(PIN)
+    assert btn.wait(timeout=1)[0] == 'press'
+    time.sleep(0.05)
+    assert btn.poll() is None
+    assert btn.held
+
+def test_long_press():
+    io, btn = make()
+    io.press(PIN)
+    assert btn.wait(('long',), timeout=1)[0] == 'long'
+    io.release(PIN)
+    assert btn.poll() is None
+
+def test_quick_tap_is_not_long():
+    # the release comes within the debounce time, it must still end the press
+    io, btn = make(debounce=0.05)
+    io.press(PIN)
+    io.release(PIN)
+    assert btn.wait(timeout=1)[0] == 'press'
+    assert btn.wait(timeout=1)[0] == 'short'
+    assert not btn.held
+    time.sleep(0.4)
+    assert btn.poll() is None
+
+def test_missed_release_is_not_long():
+    # the backend lost the release edge entirely
+    io, btn = make()
+    io.press(PIN)
+    io.levels[PIN] = 0
+    assert btn.wait(timeout=1)[0] == 'press'
+    assert btn.wait(timeout=1)[0] == 'short'
+    assert btn.poll() is None
+
+def test_consume_suppresses_short():
+    io, btn = make()
+    io.press(PIN)
+    assert btn.wait(('press',), timeout=1)
+    btn.consume()
+    time.sleep(0.02)
+    io.release(PIN)
+    time.sleep(0.4)
+    assert btn.poll() is None
+
+def test_on_press_runs_on_the_edge():
+    io, btn = make()
+    seen = []
+    btn.on_press = seen.append
+    io.press(PIN)
+    assert len(seen) == 1 # before the event is even read
+    assert btn.wait(('press',), timeout=1)[1] == seen[0]
@@ -0,0 +1,134 @@
+# warm_rec.py with a fake camera and a fake sink (no RealSense needed): python3 -m pytest test_warm_rec.py
+import os
+import sys
+import time
+import types
+import threading
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Realsense'))
+if 'pyrealsense2' not in sys.modules: # only the names used without a device
+    try:
+        import pyrealsense2
+    except ImportError:
+        sys.modules['pyrealsense2'] = types.SimpleNamespace(
+            frame_metadata_value=types.SimpleNamespace(time_of_arrival='time_of_arrival'))
+from button import sim_backend, button
+from warm_rec import warm_recorder
+from preroll import preroll_buffer
+from frame_health import frame_health
+
+PIN = 17
+FPS = 30
+SHAPE = (4, 6)
+STREAMS = {'depth': {'shape': SHAPE, 'dtype': 'uint16', 'fps': FPS}}
+
+class fake_frame():
+    def __init__(self, no):
+        self.no = no
+        self.ts = no * 1000 / FPS
+        self.data = np.full(SHAPE, no, np.uint16)
+    def as_frameset(self): return self
+    def size(self): return 1
+    def __getitem__(self, i): return self
+    def get_frame_number(self): return self.no
+    def get_timestamp(self): return self.ts
+    def get_data(self): return self.data
+    def keep(self): pass
+    def supports_frame_metadata(self, key): return False
+    def get_profile(self):
+        return types.SimpleNamespace(stream_type=lambda: 'stream.depth', stream_index=lambda: 0, fps=lambda: FPS)
+
+class fake_queue():
+    ''' frame_queue fed by a thread every interval seconds '''
+    def __init__(self, interval):
+        self.cond = threading.Condition()
+        self.frames = []
+        self.backlog = 0 # most framesets ever waiting
+        self.running = True
+        threading.Thread(target=self._feed, args=(interval,), daemon=True).start()
+    def _feed(self, interval):
+        no = 1
+        while self.running:
+            with self.cond:
+                self.frames.append(fake_frame(no))
+                self.backlog = max(self.backlog, len(self.frames))
+                self.cond.notify()
+            no += 1
+            time.sleep(interval)
+    def try_wait_for_frame(self, timeout_ms):
+        with self.cond:
+            self.cond.wait_for(lambda: self.frames, timeout_ms / 1000)
+            return (True, self.frames.pop(0)) if self.frames else (False, None)
+    def poll_for_frame(self):
+        with self.cond:
+            return self.frames.pop(0) if self.frames else None
+
+class fake_sink():
+    def __init__(self, path, streams, delay=0.0):
+        self.frames = []
+        self.closed = False
+        self.delay = delay
+    def write(self, frame_no, timestamp, images):
+        time.sleep(self.delay)
+        self.frames.append(frame_no)
+    def close(self):
+        self.closed = True
+
+def make(preroll_sec=0, interval=0.01, delay=0.0):
+    sinks = []
+    def make_sink(path, streams):
+        sinks.append(fake_sink(path, streams, delay))
+        return sinks[-1]
+    rec = warm_recorder(None, make_sink, log=lambda *a: None, queue_size=8, preroll_sec=preroll_sec)
+    rec.queue = fake_queue(interval)
+    rec.health = frame_health(rec.queue_size, FPS)
+    rec.streams = STREAMS
+    if preroll_sec:
+        rec.preroll = preroll_buffer(STREAMS, preroll_sec, FPS)
+    rec._spawn()
+    io = sim_backend()
+    btn = button(io, PIN, long_press=1.0, debounce=0.01)
+    btn.on_press = rec.arm
+    return rec, io, btn, sinks
+
+def record(rec, io, btn, max_frames):
+    io.press(PIN)
+    _, t_press = btn.wait(('press',), timeout=1)
+    result = []
+    th = threading.Thread(target=lambda: result.append(rec.take(btn, 'x', t_press, max_frames)))
+    th.start()
+    io.release(PIN) # short press: keep recording until max_frames
+    th.join(timeout=5)
+    rec.queue.running = False
+    rec.close()
+    return result
+
+def test_max_frames_counts_live_frames():
+    rec, io, btn, sinks = make()
+    time.sleep(0.05)
+    assert record(rec, io, btn, 10) == ['stop']
+    s = rec.last_summary
+    assert s['preroll'] == 0
+    assert s['frames'] >= 10
+    assert sinks[0].frames == list(range(sinks[0].frames[0], sinks[0].frames[-1] + 1))
+
+def test_preroll_does_not_count_toward_max_frames():
+    rec, io, btn, sinks = make(preroll_sec=1)
+    time.sleep(0.5) # about 50 frames into a 30 frame ring
+    assert record(rec, io, btn, 10) == ['stop']
+    s = rec.last_summary
+    frames = sinks[0].frames
+    assert s['preroll'] >= 20
+    assert s['frames'] - s['preroll'] >= 10 # the live part is not cut short by the pre-roll
+    assert len(frames) == s['frames']
+    assert frames == list(range(frames[0], frames[-1] + 1)) # pre-roll then live, no gap
+    assert sinks[0].closed
+
+def test_slow_sink_does_not_stall_capture():
+    rec, io, btn, sinks = make(interval=0.005, delay=0.03)
+    time.sleep(0.05)
+    assert record(rec, io, btn, 10) == ['stop']
+    s = rec.last_summary
+    assert s['dropped'] > 0 # the writer queue filled up
+    assert s['frames'] == len(sinks[0].frames) >= 10
+    assert rec.queue.backlog <= 2 # capture kept draining the camera queue meanwhile
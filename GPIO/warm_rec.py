@@ -0,0 +1,280 @@
+# Keep the camera streaming between recordings and switch the output sink on and off
+#
+#   rec = warm_recorder(config, make_sink, metrics)
+#   rec.start()                    # once: device negotiation and auto exposure happen here
+#   btn.on_press = rec.arm         # optional: hold frames from the press edge (button thread)
+#   rec.begin(path, t_press)       # frames arriving after t_press go to make_sink(path, streams)
+#   rec.end()                      # close the sink, the pipeline keeps running
+#   rec.close()
+#
+# Frames that arrive while the sink is being opened are held (keep()) and written first,
+# so the first recorded frame is the first frame after the button press.
+# Pass arm as the button's on_press callback so holding starts on the press edge itself,
+# not when the main thread gets round to begin() (frames in between would be lost otherwise).
+# The press -> first recorded frame latency is logged for every recording.
+#
+# Sink writes run on their own writer thread, never on the capture thread: capture keep()s each
+# recorded frameset and queues it (at most queue_size framesets, the same budget as the frame queue).
+# When the sink cannot keep up the queue fills and further frames are counted as dropped
+# instead of stalling capture (bag_sink goes through a Python software_device and is slow on a Pi).
+#
+# preroll_sec > 0 keeps the last N seconds in a preallocated ring (Realsense/preroll.py) while idle.
+# On begin() the ring is written to the new sink first, then the sink switches to live frames
+# once the reader has caught up (capture keeps pushing into the ring meanwhile).
+# Compressed streams are handed to the sink as they are when it uses the same codec (sink.accepts(codec)).
+# Pushing never waits for the codec: frames it cannot keep up with are left out of the ring (dropped).
+#
+# queue_size=None sizes the frame queue from the resolved streams: the smaller of
+# queue_latency_ms worth of frames and queue_memory_mb / frameset size (Realsense/frame_health.py).
+# Per-stream frame drops, desync within a frameset and queue occupancy are tracked in self.health.
+import time
+import queue
+import threading
+import numpy as np
+import pyrealsense2 as rs
+from raw_rec import profile_streams, frameset_images
+from preroll import preroll_buffer
+from frame_health import frame_health, queue_capacity
+
+IDLE, STARTING, RECORDING = 'idle', 'starting', 'recording'
+
+class warm_recorder():
+    def __init__(self, config, make_sink, metrics=None, log=print, queue_size=None,
+                 queue_latency_ms=1000, queue_memory_mb=128, preroll_sec=0, codec=None, compress=('depth',)):
+        self.config = config
+        self.make_sink = make_sink   # (path, streams) -> object with write(frame_no, timestamp, images) / close()
+        self.metrics = metrics
+        self.log = log
+        self.queue_size = queue_size
+        self.queue_latency_ms = queue_latency_ms
+        self.queue_memory_mb = queue_memory_mb
+        self.queue = None
+        self.health = None
+        self.pipeline = None
+        self.streams = None
+        self.state = IDLE
+        self.frames = 0              # frames received since start()
+        self.dropped = 0             # frame number gaps since start()
+        self.recorded = 0            # live frames written in the current recording (max_frames counts these)
+        self.prerolled = 0           # pre-roll frames written at the start of the current recording
+        self.rec_dropped = 0         # gaps while recording
+        self.latency_ms = None       # press -> arrival of the first recorded frame
+        self.preroll_sec = preroll_sec
+        self.preroll_codec = codec   # compress these streams in the pre-roll ring (None = raw)
+        self.preroll_compress = compress
+        self.preroll = None
+        self.last_summary = None
+        self._lock = threading.Lock()
+        self._pending = []
+        self._sink = None
+        self._t_press = None
+        self._last_no = None
+        self._running = False
+        self._thread = None
+        self._writes = None          # (sink, t_arr, frameset) for the writer thread
+        self._writer = None
+
+    def start(self):
+        t0 = time.monotonic()
+        self.pipeline = rs.pipeline()
+        resolved = self.config.resolve(rs.pipeline_wrapper(self.pipeline)) # streams before starting
+        fps = max(sp.fps() for sp in resolved.get_streams())
+        if self.queue_size is None:
+            streams = profile_streams(resolved)
+            nbytes = sum(int(np.prod(info['shape'])) * np.dtype(info['dtype']).itemsize for info in streams.values())
+            self.queue_size = queue_capacity(nbytes, fps, self.queue_latency_ms, self.queue_memory_mb)
+            self.log(f'frame queue: {self.queue_size} framesets ({self.queue_size*nbytes/1e6:.0f} MB)')
+        self.queue = rs.frame_queue(self.queue_size, keep_frames=True)
+        self.health = frame_health(self.queue_size, fps)
+        profile = self.pipeline.start(self.config, self.queue)
+        self.streams = profile_streams(profile)
+        if self.preroll_sec:
+            fps = max(info['fps'] for info in self.streams.values())
+            self.preroll = preroll_buffer(self.streams, self.preroll_sec, fps, self.preroll_codec, self.preroll_compress)
+            self.log(f'pre-roll: {self.preroll_sec} s = {self.preroll.n} frames, {self.preroll.nbytes/1e6:.0f} MB')
+        self._spawn()
+        self.log(f'pipeline started in {1000*(time.monotonic()-t0):.0f} ms (warm)')
+
+    def _spawn(self):
+        ''' start the capture and writer threads (queue, health and streams are set up) '''
+        self._running = True
+        self._writes = queue.Queue(self.queue_size)
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+        self._thread = threading.Thread(target=self._capture, daemon=True)
+        self._thread.start()
+
+    def arm(self, t_press=None):
+        ''' press edge: hold frames arriving after t_press until begin() opens the sink (ignored unless idle) '''
+        with self._lock:
+            if self.state == IDLE:
+                self._arm(time.monotonic() if t_press is None else t_press)
+
+    def _arm(self, t_press):
+        self._t_press = t_press
+        self._pending = []
+        self.recorded = 0
+        self.prerolled = 0
+        self.rec_dropped = 0
+        self.latency_ms = None
+        self.state = STARTING
+
+    def begin(self, path, t_press=None):
+        ''' start writing frames that arrive after t_press (time.monotonic(), default now) '''
+        with self._lock:
+            t_press = time.monotonic() if t_press is None else t_press
+            if self.state != STARTING or self._t_press != t_press: # not armed by this press
+                self._arm(t_press)
+        try:
+            sink = self.make_sink(path, self.streams) # may take a while, capture keeps running
+        except Exception:
+            with self._lock:
+                self._pending = []
+                self.state = IDLE
+            raise
+        if self.preroll:
+            self._flush_preroll(sink)
+            return sink
+        with self._lock:
+            for t_arr, fs in self._pending: # no more than queue_size, the writer queue is empty while idle
+                self._writes.put_nowait((sink, t_arr, fs))
+            self._pending = []
+            self._sink = sink
+            self.state = RECORDING
+        return sink
+
+    def _flush_preroll(self, sink):
+        ''' write the ring (oldest first) while capture keeps filling it, then switch to live frames '''
+        t0 = time.monotonic()
+        pre = self.preroll
+        lost = pre.lost
+        written = [0, None, None] # frames, first / last timestamp
+        def caught_up(i):
+            with self._lock: # capture pushes under the same lock
+                if i < pre.head: return False
+                self.prerolled = written[0]
+                self._sink = sink
+                self.state = RECORDING
+                return True
+        accepts = getattr(sink, 'accepts', None)
+        encoded = accepts(pre.codec) if accepts else ()
+        for frame_no, timestamp, images, enc in pre.frames(stop=caught_up, encoded=encoded):
+            if enc:
+                sink.write(frame_no, timestamp, images, enc) # no decode / re-encode
+            else:
+                sink.write(frame_no, timestamp, images)
+            if written[1] is None: written[1] = timestamp
+            written[0] += 1
+            written[2] = timestamp
+        pre.reset() # capture no longer pushes while recording
+        span = f' ({(written[2] - written[1])/1000:.1f} s)' if written[0] else ''
+        self.log(f'pre-roll: {written[0]} frames{span} written in {1000*(time.monotonic()-t0):.0f} ms, '
+                 f'lost {pre.lost - lost}, dropped {pre.dropped}, overflow {pre.overflow}, '
+                 f'{len(encoded)} streams kept compressed')
+
+    def end(self):
+        ''' stop writing and close the sink, return a summary '''
+        with self._lock:
+            sink, self._sink = self._sink, None
+            self._pending = []
+            self.state = IDLE
+        self._writes.join() # frames already queued for this sink
+        if sink: sink.close()
+        self.last_summary = {'frames': self.prerolled + self.recorded, 'preroll': self.prerolled,
+                             'dropped': self.rec_dropped, 'latency_ms': self.latency_ms}
+        return self.last_summary
+
+    def take(self, btn, path, t_press, max_frames=None):
+        ''' record from the press until the next press (or max_frames live frames, the pre-roll is extra)
+
+            returns 'long' if the start press was held (exit gesture, the recording is kept), else 'stop'
+        '''
+        self.begin(path, t_press)
+        try:
+            kind, _ = btn.wait(('short', 'long')) # release of the start press
+            if kind == 'long':
+                return 'long'
+            while True:
+                if btn.wait(('press',), timeout=0.1): # stop on the next press
+                    btn.consume()
+                    return 'stop'
+                if max_frames and self.recorded >= max_frames:
+                    return 'stop'
+        finally:
+            s = self.end()
+            latency = 'n/a' if s['latency_ms'] is None else f'{s["latency_ms"]:.1f} ms'
+            self.log(f'recorded: {s["frames"]} frames ({s["preroll"]} pre-roll), dropped: {s["dropped"]}, '
+                     f'start latency: {latency}')
+
+    def close(self):
+        if self.state != IDLE: self.end()
+        self._running = False
+        if self._thread: self._thread.join()
+        if self._writer:
+            self._writes.put(None)
+            self._writer.join()
+        if self.pipeline: self.pipeline.stop()
+        if self.health: self.health.report(self.log)
+
+    def _capture(self):
+        m = self.metrics
+        while self._running:
+            t = m.start() if m else 0
+            # everything waiting (up to the queue capacity), oldest first, each with its own arrival time
+            batch = self.health.drain(self.queue, 100, times=True)
+            if not batch: continue
+            if m: t = m.lap('wait', t)
+            for j, (t_arr, fs) in enumerate(batch):
+                if j and m: t = m.start()
+                no = fs.get_frame_number()
+                gap = max(0, no - self._last_no - 1) if self._last_no is not None else 0
+                self._last_no = no
+                self.dropped += gap
+                self.frames += 1
+                with self._lock:
+                    if self.state == RECORDING:
+                        self.rec_dropped += gap
+                        try:
+                            fs.keep() # hold until the writer thread has written it
+                            self._writes.put_nowait((self._sink, t_arr, fs))
+                        except queue.Full: # the sink is behind: drop rather than stall capture
+                            self.rec_dropped += 1
+                        if m: m.lap('queue', t)
+                    elif self.preroll:
+                        self.preroll.push(no, fs.get_timestamp(), frameset_images(fs))
+                        if m: m.lap('preroll', t)
+                    elif self.state == STARTING and t_arr >= self._t_press:
+                        if len(self._pending) < self.queue_size: # kept frames stay out of the pool
+                            fs.keep() # hold until the sink is open
+                            self._pending.append((t_arr, fs))
+                        else:
+                            self.rec_dropped += 1
+                if m:
+                    m.latency(fs)
+                    m.gauge('recording', int(self.state == RECORDING))
+                    m.gauge('write_backlog', self._writes.qsize())
+                    self.health.gauges(m)
+                    m.tick()
+
+    def _write_loop(self):
+        m = self.metrics
+        while True:
+            item = self._writes.get()
+            if item is None: break
+            try:
+                t = m.start() if m else 0
+                self._write(*item)
+                if m: m.lap('write', t)
+            except Exception as e:
+                self.log(f'write failed: {e}')
+            finally:
+                self._writes.task_done()
+
+    def _write(self, sink, t_arr, fs):
+        sink.write(fs.get_frame_number(), fs.get_timestamp(), frameset_images(fs))
+        if self.latency_ms is None:
+            self.latency_ms = 1000 * (t_arr - self._t_press)
+            frame_ms = 1000 / fs.get_profile().fps()
+            self.log(f'start latency: {self.latency_ms:.1f} ms = {self.latency_ms/frame_ms:.1f} frames '
+                     f'(press -> first recorded frame {fs.get_frame_number()})')
+        self.recorded += 1
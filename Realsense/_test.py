@@ -1,5 +1,25 @@
+'''
+    処理速度のベンチマーク (カメラ不要)
+
+    合成データ (または raw_rec 形式で録画したフレーム) を各解像度で処理し,
+    ウォームアップ後に repeat 回測って統計を JSON に保存する
+    --baseline を指定すると前回の結果と比べて遅くなった項目を表示する (終了コード 1)
+
+    py _test.py bench [--raw DIR] [--out result.json] [--baseline base.json] [--threshold 0.1] [-k 名前]
+    py _test.py loop    (for / while の比較)
+'''
+
+import os
+import sys
+import json
 import time
 import random
+import platform
+import argparse
+import threading
+import numpy as np
+
+RESOLUTIONS = [(640, 480), (1280, 720)]
 
 def perf_timer(func):
     ''' 実行時間測定用デコレータ '''
@@ -29,6 +49,139 @@ def while_loop():
             break
     print(f'while: {cc}')
 
+# ----- 計測
+def measure(func, warmup=3, repeat=20):
+    ''' ウォームアップ後に repeat 回計測して統計 [ms] '''
+    for _ in range(warmup):
+        func()
+    t = np.empty(repeat)
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        t[i] = (time.perf_counter() - start) * 1000
+    return {
+        'mean': float(t.mean()), 'std': float(t.std()),
+        'min': float(t.min()), 'p50': float(np.median(t)),
+        'p95': float(np.percentile(t, 95)), 'max': float(t.max()),
+        'repeat': repeat,
+    }
+
+# ----- 入力フレーム
+def synthetic_frames(w, h):
+    from np_filter import synthetic_depth
+    depth = synthetic_depth(w, h)
+    rng = np.random.default_rng(1)
+    color = rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+    return depth, color
+
+def recorded_frames(raw_dir, w, h):
+    ''' 録画から解像度の合うフレームを取り出す (なければ None) '''
+    from raw_rec import raw_reader
+    r = raw_reader(raw_dir)
+    if 'depth' not in r.streams or r.streams['depth']['shape'][:2] != [h, w]:
+        return None
+    fr = r[len(r) // 2]
+    color = fr.get('color', synthetic_frames(w, h)[1])
+    return np.array(fr['depth']), np.array(color)
+
+# ----- 計測項目
+def cases(depth, color):
+    ''' 名前 -> 引数なし関数 '''
+    import cv2
+    from colorize import depth_colorizer
+    from np_filter import np_filter_chain
+    from stage_pipeline import stage_queue
+    out = {}
+    out['colorize/cv2'] = lambda: cv2.applyColorMap(cv2.convertScaleAbs(depth, alpha=0.08), cv2.COLORMAP_JET)
+    col = depth_colorizer(0.08)
+    out['colorize/colorizer'] = lambda: col(depth)
+    lut = depth_colorizer(0.08, method='lut')
+    out['colorize/lut'] = lambda: lut(depth)
+    chain = np_filter_chain()
+    out['filter/numpy'] = lambda: chain.process(depth)
+    from point_cloud import point_cloud
+    h, w = depth.shape
+    pc_intr = {'width': w, 'height': h, 'ppx': w/2, 'ppy': h/2, 'fx': 0.9*w, 'fy': 0.9*w,
+               'model': 'brown_conrady', 'coeffs': [0.0]*5}
+    pc = point_cloud(pc_intr)
+    out['pointcloud/xyz'] = lambda: pc.xyz(depth)
+    out['pointcloud/points_color'] = lambda: pc.points(depth, color)
+    from np_align import depth_aligner
+    ext = {'rotation': [1, 0, 0, 0, 1, 0, 0, 0, 1], 'translation': [0.015, 0, 0]}
+    aligner = depth_aligner(dict(pc_intr, fx=0.53*w, fy=0.53*w), dict(pc_intr, fx=0.73*w, fy=0.73*w), ext)
+    out['align/numpy'] = lambda: aligner.process(depth)
+    from roi_stats import roi_stats, grid_rois
+    rois = roi_stats(grid_rois((w, h), 20, 15, margin=w//16))
+    out['roi/stats_300'] = lambda: rois(depth)
+    out['encode/png1_color'] = lambda: cv2.imencode('.png', color, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+    out['encode/png1_depth16'] = lambda: cv2.imencode('.png', depth, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+    out['encode/jpg_color'] = lambda: cv2.imencode('.jpg', color)
+
+    def handoff(n=100):
+        ''' スレッド間で n フレーム受け渡し '''
+        q = stage_queue(4, 'block')
+        th = threading.Thread(target=lambda: [q.put(color) for _ in range(n)] and q.close())
+        th.start()
+        while q.get() is not None: pass
+        th.join()
+    out['queue/handoff_x100'] = handoff
+    return out
+
+def run_suite(raw_dir=None, warmup=3, repeat=20, keyword=None):
+    results = {}
+    for w, h in RESOLUTIONS:
+        frames = recorded_frames(raw_dir, w, h) if raw_dir else None
+        source = 'recorded' if frames is not None else 'synthetic'
+        depth, color = frames if frames is not None else synthetic_frames(w, h)
+        for name, func in cases(depth, color).items():
+            key = f'{name}@{w}x{h}'
+            if keyword and keyword not in key: continue
+            results[key] = dict(measure(func, warmup, repeat), source=source)
+            print(f'{key:36s} p50 {results[key]["p50"]:8.3f} ms  p95 {results[key]["p95"]:8.3f} ms  ({source})')
+    return results
+
+def environment():
+    import cv2
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': platform.node(), 'machine': platform.machine(), 'cpu': os.cpu_count(),
+        'python': platform.python_version(), 'numpy': np.__version__, 'opencv': cv2.__version__,
+    }
+
+def compare(results, baseline, threshold=0.1):
+    ''' p50 が threshold (割合) 以上遅くなった項目 '''
+    regressions = []
+    for key, r in results.items():
+        b = baseline.get(key)
+        if not b: continue
+        ratio = r['p50'] / max(b['p50'], 1e-9) - 1
+        mark = 'REGRESSION' if ratio > threshold else ''
+        print(f'{key:36s} {b["p50"]:8.3f} -> {r["p50"]:8.3f} ms ({ratio*100:+6.1f} %) {mark}')
+        if ratio > threshold: regressions.append(key)
+    return regressions
+
 if __name__ == "__main__":
-    for_loop()
-    while_loop()
+    parser = argparse.ArgumentParser(description='ベンチマーク')
+    parser.add_argument('cmd', nargs='?', default='bench', choices=('bench', 'loop'))
+    parser.add_argument('--raw', help='raw_rec 形式の録画 (解像度が合えば合成データの代わりに使う)')
+    parser.add_argument('--out', default='bench_result.json')
+    parser.add_argument('--baseline', help='比較する前回の結果')
+    parser.add_argument('--threshold', type=float, default=0.1, help='遅くなったとみなす割合')
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('-k', dest='keyword', help='名前に含まれる項目だけ実行')
+    args = parser.parse_args()
+    if args.cmd == 'loop':
+        for_loop()
+        while_loop()
+        sys.exit()
+    results = run_suite(args.raw, args.warmup, args.repeat, args.keyword)
+    with open(args.out, 'w') as f:
+        json.dump({'env': environment(), 'results': results}, f, indent=2)
+    print(f'saved: {args.out}')
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)['results'], args.threshold)
+        if regressions:
+            print(f'{len(regressions)} regressions')
+            sys.exit(1)
@@ -0,0 +1,165 @@
+'''
+    録画した .bag の一括処理 (画面なし)
+
+    ディレクトリ内の bag (または長い bag を --chunk 秒ごとに区切ったもの) を
+    プロセスプールに振り分け, main.Settings と同じフィルタチェーンを適用する
+    分割録画のセッション (segment.py) はセグメントごとに処理し, 結果をセッション単位でまとめる
+    (raw 形式のセグメントはワーカーで <セグメント>.bag に変換してから処理する)
+
+    出力 (<out_dir>/<bag名>[_cNNN]/):
+        depth/          フィルタ後の深度 (raw_rec 形式, NOISE_FILTER が無効ならそのまま)
+        colormap_*.png  深度のカラーマップ (--every フレームごと)
+        stats.json      フレーム数, 有効画素率, 平均距離, 処理速度 (これがあれば処理済みとして飛ばす)
+    セッションは <out_dir>/<セッション名>/seg_NNNNN/ に出力し, <セッション名>/stats.json に合計を書く
+
+    py batch.py <in_dir> <out_dir> [--workers N] [--chunk SEC] [--every N]
+'''
+
+import os
+import cv2
+import glob
+import json
+import time
+import shutil
+import argparse
+import numpy as np
+from multiprocessing import Pool, cpu_count
+from main import Settings
+from colorize import depth_colorizer
+from playback import bag_player, load_index, segment_bag
+from raw_rec import raw_writer, stream_info
+from segment import is_session, segment_files
+
+def make_jobs(in_dir, out_dir, chunk=0):
+    ''' (bag, 出力先, 開始 ts, 終了 ts) の一覧 '''
+    jobs = []
+    for path in sorted(glob.glob(os.path.join(in_dir, '*'))):
+        if os.path.isdir(path) and is_session(path):
+            session = os.path.join(out_dir, os.path.basename(path))
+            for bag in segment_files(path):
+                name = os.path.splitext(os.path.basename(bag))[0]
+                jobs.append((bag, os.path.join(session, name), None, None))
+    for bag in sorted(glob.glob(os.path.join(in_dir, '*.bag'))):
+        name = os.path.splitext(os.path.basename(bag))[0]
+        if not chunk:
+            jobs.append((bag, os.path.join(out_dir, name), None, None))
+            continue
+        ts = load_index(bag)['timestamp']
+        if not len(ts): continue
+        # 終了 ts は含まないので, 最後の区切りは最後のフレームの後ろに置く
+        edges = np.append(np.arange(ts[0], max(ts[-1], ts[0] + 1), chunk*1000), ts[-1] + 1)
+        for i, (t0, t1) in enumerate(zip(edges[:-1], edges[1:])):
+            jobs.append((bag, os.path.join(out_dir, f'{name}_c{i:03d}'), float(t0), float(t1)))
+    return jobs
+
+def process(job, every=30):
+    ''' 1ジョブ分の処理 (ワーカープロセスで実行) '''
+    bag, out, t0, t1 = job
+    if os.path.exists(os.path.join(out, 'stats.json')):
+        return out, None # 処理済み
+    bag = segment_bag(bag) # raw 形式のセグメントは bag に変換してから
+    shutil.rmtree(out, ignore_errors=True) # 中断された残りは作り直す
+    os.makedirs(out)
+    settings = Settings()
+    filters = settings.make_filters() if settings.NOISE_FILTER else None
+    colorizer = depth_colorizer(settings.DEPTH_ALPHA)
+    player = bag_player(bag, realtime=False, repeat=False, index=t0 is not None)
+    if t0 is not None:
+        player.seek_frame(int(np.searchsorted(player.index['timestamp'], t0)))
+    writer = None
+    n, valid, dist = 0, 0.0, 0.0
+    start = time.perf_counter()
+    try:
+        while True:
+            try:
+                frames = player.wait_for_frames(1000)
+            except RuntimeError: # 終端
+                break
+            ts = frames.get_timestamp()
+            if t0 is not None and ts < t0: continue
+            if t1 is not None and ts >= t1: break
+            depth_frame = frames.get_depth_frame()
+            if not depth_frame: continue
+            if filters:
+                depth_frame = filters.process(depth_frame)
+            depth = np.asanyarray(depth_frame.get_data())
+            if writer is None:
+                info = stream_info(depth_frame.get_profile(), depth_frame.get_units())
+                info['shape'] = list(depth.shape) # decimation 後の大きさ
+                writer = raw_writer(os.path.join(out, 'depth'), {'depth': info}, meta={'source': bag})
+            writer.write(frames.get_frame_number(), ts, {'depth': depth})
+            mask = depth > 0
+            valid += mask.mean()
+            if mask.any():
+                dist += depth[mask].mean() * depth_frame.get_units()
+            if n % every == 0:
+                cv2.imwrite(os.path.join(out, f'colormap_{n:06d}.png'), colorizer(depth))
+            n += 1
+    finally:
+        player.pipeline.stop()
+        if writer: writer.close()
+    sec = time.perf_counter() - start
+    stats = {
+        'bag': bag, 'start_ts': t0, 'end_ts': t1,
+        'frames': n, 'sec': sec, 'fps': n / max(sec, 1e-9),
+        'valid_ratio': valid / max(n, 1), 'mean_distance_m': dist / max(n, 1),
+    }
+    with open(os.path.join(out, 'stats.json'), 'w') as f:
+        json.dump(stats, f, indent=2)
+    return out, stats
+
+def _process(args):
+    return process(*args)
+
+def summarize_sessions(in_dir, out_dir):
+    ''' セッションごとにセグメントの統計を合計する '''
+    for path in sorted(glob.glob(os.path.join(in_dir, '*'))):
+        if not (os.path.isdir(path) and is_session(path)): continue
+        session = os.path.join(out_dir, os.path.basename(path))
+        parts = []
+        for bag in segment_files(path):
+            p = os.path.join(session, os.path.splitext(os.path.basename(bag))[0], 'stats.json')
+            if not os.path.exists(p): break # 未完了
+            with open(p) as f:
+                parts.append(json.load(f))
+        else:
+            n = sum(s['frames'] for s in parts)
+            w = [s['frames'] / max(n, 1) for s in parts]
+            stats = {
+                'session': path, 'segments': len(parts), 'frames': n,
+                'sec': sum(s['sec'] for s in parts),
+                'valid_ratio': sum(s['valid_ratio'] * k for s, k in zip(parts, w)),
+                'mean_distance_m': sum(s['mean_distance_m'] * k for s, k in zip(parts, w)),
+            }
+            with open(os.path.join(session, 'stats.json'), 'w') as f:
+                json.dump(stats, f, indent=2)
+
+def run(in_dir, out_dir, workers=None, chunk=0, every=30):
+    ''' 全ジョブを並列実行して進捗と処理速度を表示 '''
+    workers = workers or cpu_count()
+    jobs = make_jobs(in_dir, out_dir, chunk)
+    print(f'{len(jobs)} jobs, {workers} workers')
+    start = time.perf_counter()
+    frames, skipped = 0, 0
+    with Pool(workers) as pool:
+        for i, (out, stats) in enumerate(pool.imap_unordered(_process, [(j, every) for j in jobs]), 1):
+            if stats is None:
+                skipped += 1
+                print(f'[{i}/{len(jobs)}] {out}: done before, skip')
+                continue
+            frames += stats['frames']
+            print(f'[{i}/{len(jobs)}] {out}: {stats["frames"]} frames, {stats["fps"]:.1f} fps')
+    summarize_sessions(in_dir, out_dir)
+    sec = time.perf_counter() - start
+    print(f'----- {frames} frames in {sec:.1f} s: {frames/max(sec, 1e-9):.1f} fps total, '
+          f'{frames/max(sec, 1e-9)/workers:.1f} fps/worker ({skipped} skipped)')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='bag の一括処理')
+    parser.add_argument('in_dir')
+    parser.add_argument('out_dir')
+    parser.add_argument('--workers', type=int, default=None, help='プロセス数 (既定: CPU数)')
+    parser.add_argument('--chunk', type=float, default=0, help='bag を区切る秒数 (0: 区切らない)')
+    parser.add_argument('--every', type=int, default=30, help='カラーマップを保存する間隔 (フレーム)')
+    args = parser.parse_args()
+    run(args.in_dir, args.out_dir, args.workers, args.chunk, args.every)
@@ -0,0 +1,76 @@
+'''
+    フレーム用バッファの使い回し
+
+        pool = buffer_pool()
+        out = pool.get('colormap', (480, 640, 3), np.uint8)  # 2回目以降は同じ配列を返す
+        canvas = side_by_side(pool, [color, None])            # 並べて表示する画像 (左右の領域に直接書き込む)
+        allocs, nbytes = pool.frame()                         # 前回の frame() からの確保数とバイト数
+
+    長時間動かしてもメモリが増えず, 確保/GC による停止が起きないように
+    毎フレームの出力は (名前, 形状, 型) ごとに確保済みの配列へ書き込む
+    nbuf > 1 にすると同じ名前で nbuf 個の配列を順番に返す (別スレッドで表示中の配列を上書きしない)
+'''
+
+import threading
+import numpy as np
+
+class buffer_pool():
+    ''' (名前, 形状, 型) -> 確保済みの配列 '''
+    def __init__(self, nbuf=1):
+        self.nbuf = max(1, nbuf)
+        self._bufs = {}     # key -> [配列]
+        self._idx = {}      # key -> 次に返す番号
+        self._lock = threading.Lock()
+        self.allocs = 0     # 起動からの確保数
+        self.bytes = 0      # 起動からの確保バイト数
+        self._mark = (0, 0)
+
+    def get(self, name, shape, dtype=np.uint8, nbuf=None):
+        ''' 書き込み先の配列 (中身は前回のまま) '''
+        key = (name, tuple(shape), np.dtype(dtype).str)
+        with self._lock:
+            bufs = self._bufs.get(key)
+            if bufs is None:
+                n = nbuf or self.nbuf
+                bufs = self._bufs[key] = [np.empty(shape, dtype) for _ in range(n)]
+                self._idx[key] = 0
+                self.allocs += n
+                self.bytes += sum(b.nbytes for b in bufs)
+            i = self._idx[key]
+            self._idx[key] = (i + 1) % len(bufs)
+            return bufs[i]
+
+    def frame(self):
+        ''' 前回呼んでからの (確保数, バイト数), 1フレームに1回呼ぶ '''
+        allocs, nbytes = self.allocs - self._mark[0], self.bytes - self._mark[1]
+        self._mark = (self.allocs, self.bytes)
+        return allocs, nbytes
+
+    def total_bytes(self):
+        with self._lock:
+            return sum(b.nbytes for bufs in self._bufs.values() for b in bufs)
+
+    def clear(self):
+        with self._lock:
+            self._bufs.clear()
+            self._idx.clear()
+
+def side_by_side(pool, images, name='canvas', shapes=None):
+    ''' 画像を横に並べたキャンバスと各画像の領域 (np.hstack の代わり)
+
+        images に None を渡すと領域だけ返すので, そこへ直接書き込める
+        (None の場合は shapes で形状を指定する)
+    '''
+    shapes = shapes or [img.shape for img in images]
+    h = shapes[0][0]
+    w = sum(s[1] for s in shapes)
+    canvas = pool.get(name, (h, w, 3), np.uint8)
+    views = []
+    x = 0
+    for img, shape in zip(images, shapes):
+        view = canvas[:, x:x+shape[1]]
+        if img is not None:
+            np.copyto(view, img)
+        views.append(view)
+        x += shape[1]
+    return canvas, views
@@ -0,0 +1,263 @@
+'''
+    深度画像 (z16) の可逆圧縮
+
+        codec = frame_codec(workers=4)
+        buf = codec.encode(depth)           # bytes
+        depth2 = codec.decode(buf)          # 元と完全に一致
+        fut = codec.submit(depth)           # 別スレッドで圧縮 (フレーム単位で並列)
+        print(codec.stats())                # 圧縮率, 圧縮/展開の MB/s
+
+    1. 予測: 'left' (左の画素との差, 既定) / 'gradient' (左 + 上 - 左上 との差) / 'none'
+       合成データでは left の方が縮み (2.31 対 2.06) 速い (37 対 34 MB/s, 1スレッド)
+       どちらも numpy の diff で計算でき, 展開は cumsum で戻せる (16bit で桁あふれさせたまま計算)
+    2. 差を zigzag で符号なしにし (0, -1, 1, -2, ... -> 0, 1, 2, 3, ...), 上位/下位のバイト面に分ける ('none' は zigzag しない)
+       深度は滑らかなので上位バイトはほぼ 0 になり, よく縮む
+    3. バイト面ごとに zlib (zstandard があれば 'zstd' も可) で圧縮
+       zlib も numpy も GIL を解放するのでスレッドで並列化できる
+
+    tiles > 1 で画像を横の帯に分けて並列に圧縮する (1フレームの遅延を縮めたい時)
+    uint8 の画像 (y8, bgr8 など) もチャンネルごとに同じ方法で圧縮できる
+
+        py depth_codec.py bench [--raw DIR] [--workers 4]
+'''
+
+import time
+import zlib
+import struct
+import argparse
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, Future
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC = b'DPC1'
+PREDICTORS = ('none', 'left', 'gradient')
+ENTROPY = ('zlib', 'zstd')
+_HEADER = struct.Struct('<4sBBBBHHH') # magic, 予測, 圧縮, 1画素のバイト数, チャンネル数, 高さ, 幅, 帯の数
+_LEN = struct.Struct('<I')
+
+# ----- 予測と zigzag
+def predict(planes, predictor):
+    ''' (C, H, W) -> 予測との差 (同じ型, 桁あふれはそのまま) '''
+    if predictor == 'none':
+        return planes
+    r = np.diff(planes, axis=2, prepend=planes.dtype.type(0))
+    if predictor == 'gradient':
+        r = np.diff(r, axis=1, prepend=planes.dtype.type(0))
+    return r
+
+def unpredict(r, predictor):
+    if predictor == 'none':
+        return r
+    if predictor == 'gradient':
+        r = np.cumsum(r, axis=1, dtype=r.dtype)
+    return np.cumsum(r, axis=2, dtype=r.dtype)
+
+def zigzag(r):
+    ''' 符号付きの差 -> 符号なし (小さい値が小さいまま) '''
+    s = r.view(r.dtype.str.replace('u', 'i'))
+    return ((s << 1) ^ (s >> (8 * r.itemsize - 1))).view(r.dtype)
+
+def unzigzag(z):
+    return (z >> 1) ^ np.negative(z & 1)
+
+# ----- 1枚分 (帯) の圧縮
+def _compressor(entropy, level):
+    if entropy == 'zstd':
+        if zstandard is None: raise ImportError('zstandard がインストールされていない')
+        return zstandard.ZstdCompressor(level=level).compress
+    return lambda b: zlib.compress(b, level)
+
+def _decompressor(entropy):
+    if entropy == 'zstd':
+        if zstandard is None: raise ImportError('zstandard がインストールされていない')
+        return zstandard.ZstdDecompressor().decompress
+    return zlib.decompress
+
+def _encode_tile(tile, predictor, compress):
+    ''' (C, h, W) -> [バイト面ごとの圧縮データ] '''
+    r = predict(tile, predictor)
+    z = np.ascontiguousarray(r if predictor == 'none' else zigzag(r)) # (C, h, W) は moveaxis のビューのことがある
+    if z.itemsize == 1:
+        return [compress(z)]
+    b = z.view(np.uint8).reshape(*z.shape, z.itemsize)
+    return [compress(np.ascontiguousarray(b[..., k])) for k in range(z.itemsize)]
+
+def _decode_tile(chunks, shape, dtype, predictor, decompress):
+    if dtype.itemsize == 1:
+        z = np.frombuffer(decompress(chunks[0]), np.uint8).reshape(shape)
+    else:
+        b = np.empty((*shape, dtype.itemsize), np.uint8)
+        for k, c in enumerate(chunks):
+            b[..., k] = np.frombuffer(decompress(c), np.uint8).reshape(shape)
+        z = b.view(dtype).reshape(shape)
+    if predictor == 'none':
+        return z
+    return unpredict(unzigzag(z), predictor)
+
+def _tiles(h, n):
+    edges = np.linspace(0, h, max(1, min(n, h)) + 1).astype(int)
+    return list(zip(edges[:-1], edges[1:]))
+
+def _planes(img):
+    ''' (H, W) / (H, W, C) -> (C, H, W) '''
+    return img[None] if img.ndim == 2 else np.moveaxis(img, 2, 0)
+
+def encode(img, predictor='left', level=1, tiles=1, entropy='zlib', mapper=map):
+    ''' 画像 -> bytes (mapper に executor.map を渡すと帯を並列に圧縮) '''
+    img = np.ascontiguousarray(img)
+    if img.dtype.kind != 'u': raise ValueError(f'unsupported dtype: {img.dtype}')
+    h, w = img.shape[:2]
+    ch = 1 if img.ndim == 2 else img.shape[2]
+    planes = _planes(img)
+    spans = _tiles(h, tiles)
+    compress = _compressor(entropy, level)
+    parts = list(mapper(lambda s: _encode_tile(planes[:, s[0]:s[1]], predictor, compress), spans))
+    out = [_HEADER.pack(MAGIC, PREDICTORS.index(predictor), ENTROPY.index(entropy), img.itemsize, ch, h, w, len(spans))]
+    for chunks in parts:
+        for c in chunks:
+            out.append(_LEN.pack(len(c)))
+            out.append(c)
+    return b''.join(out)
+
+def decode(buf, out=None, mapper=map):
+    ''' bytes -> 画像 (out を渡すとそこに書き込む) '''
+    magic, pi, ei, itemsize, ch, h, w, n = _HEADER.unpack_from(buf, 0)
+    if magic != MAGIC: raise ValueError('not a depth_codec stream')
+    dtype = np.dtype(f'<u{itemsize}')
+    predictor, decompress = PREDICTORS[pi], _decompressor(ENTROPY[ei])
+    spans = _tiles(h, n)
+    pos = _HEADER.size
+    tile_chunks = []
+    mv = memoryview(buf)
+    for _ in spans:
+        chunks = []
+        for _ in range(itemsize):
+            size, = _LEN.unpack_from(buf, pos)
+            pos += _LEN.size
+            chunks.append(mv[pos:pos+size])
+            pos += size
+        tile_chunks.append(chunks)
+    if out is None:
+        out = np.empty((h, w) if ch == 1 else (h, w, ch), dtype)
+    planes = _planes(out)
+    def work(k):
+        s = spans[k]
+        planes[:, s[0]:s[1]] = _decode_tile(tile_chunks[k], (ch, s[1]-s[0], w), dtype, predictor, decompress)
+    list(mapper(work, range(len(spans))))
+    return out
+
+# ----- スレッドプール付きの圧縮器
+class frame_codec():
+    ''' 圧縮/展開とその統計 (圧縮率, MB/s) '''
+    def __init__(self, predictor='left', level=1, entropy='zlib', tiles=1, workers=4):
+        if predictor not in PREDICTORS: raise ValueError(f'unknown predictor: {predictor}')
+        if entropy == 'zstd' and zstandard is None: raise ImportError('zstandard がインストールされていない')
+        self.predictor = predictor
+        self.level = level
+        self.entropy = entropy
+        self.tiles = tiles
+        self.workers = workers
+        self._pool = ThreadPoolExecutor(workers) if workers > 1 else None
+        self._lock = threading.Lock()
+        self.raw_bytes = self.enc_bytes = self.frames = 0
+        self.enc_sec = self.dec_sec = 0.0
+        self.dec_bytes = 0
+
+    def params(self):
+        ''' meta.json に残す設定 '''
+        return {'predictor': self.predictor, 'level': self.level, 'entropy': self.entropy, 'tiles': self.tiles}
+
+    def encode(self, img):
+        ''' 圧縮 (tiles > 1 なら帯をプールで並列に) '''
+        return self._encode(img, self._pool.map if self._pool and self.tiles > 1 else map)
+
+    def submit(self, img, copy=True):
+        ''' 別スレッドで圧縮 (Future を返す, フレームのバッファは使い回されるので既定で複製)
+
+            フレーム単位で並列になるので, 帯は分けてもそのスレッドの中で順番に圧縮する
+        '''
+        if copy: img = np.array(img)
+        if self._pool is None:
+            f = Future()
+            f.set_result(self._encode(img, map))
+            return f
+        return self._pool.submit(self._encode, img, map)
+
+    def _encode(self, img, mapper):
+        start = time.perf_counter()
+        buf = encode(img, self.predictor, self.level, self.tiles, self.entropy, mapper)
+        sec = time.perf_counter() - start
+        with self._lock:
+            self.frames += 1
+            self.raw_bytes += img.nbytes
+            self.enc_bytes += len(buf)
+            self.enc_sec += sec
+        return buf
+
+    def decode(self, buf, out=None):
+        start = time.perf_counter()
+        img = decode(buf, out)
+        sec = time.perf_counter() - start
+        with self._lock:
+            self.dec_bytes += img.nbytes
+            self.dec_sec += sec
+        return img
+
+    def stats(self):
+        ''' 圧縮率と1スレッドあたりの MB/s '''
+        return {
+            'frames': self.frames,
+            'ratio': self.raw_bytes / max(self.enc_bytes, 1),
+            'encode_MBps': self.raw_bytes / 1e6 / max(self.enc_sec, 1e-9),
+            'decode_MBps': self.dec_bytes / 1e6 / max(self.dec_sec, 1e-9),
+            'MB_in': self.raw_bytes / 1e6,
+            'MB_out': self.enc_bytes / 1e6,
+        }
+
+    def close(self):
+        if self._pool: self._pool.shutdown()
+
+# ----- ベンチマーク
+def bench(frames, workers=4, fps=30):
+    ''' 予測方式 x 圧縮方式ごとの圧縮率と速度, 並列時に fps を満たせるか '''
+    mb = sum(f.nbytes for f in frames) / 1e6
+    print(f'{len(frames)} frames {frames[0].shape} {frames[0].dtype}, {mb/len(frames):.2f} MB/frame')
+    combos = [(p, 'zlib', 1) for p in PREDICTORS] + [('gradient', 'zlib', 6)]
+    if zstandard is not None:
+        combos += [('left', 'zstd', 1), ('left', 'zstd', 3)]
+    for predictor, entropy, level in combos:
+        codec = frame_codec(predictor, level, entropy, workers=1)
+        bufs = [codec.encode(f) for f in frames]
+        for f, b in zip(frames, bufs):
+            if not np.array_equal(codec.decode(b), f): raise AssertionError('not lossless')
+        s = codec.stats()
+        print(f'{predictor:9s} {entropy}-{level}: ratio {s["ratio"]:5.2f}, '
+              f'encode {s["encode_MBps"]:7.1f} MB/s, decode {s["decode_MBps"]:7.1f} MB/s (1 thread)')
+    codec = frame_codec('left', 1, 'zlib', workers=workers)
+    start = time.perf_counter()
+    for f in [f.result() for f in [codec.submit(f, copy=False) for f in frames]]: pass
+    sec = time.perf_counter() - start
+    codec.close()
+    print(f'left zlib-1, {workers} threads: {len(frames)/sec:.1f} frames/s ({mb/sec:.1f} MB/s), '
+          f'{"OK" if len(frames)/sec >= fps else "NG"} for {fps} fps, {mb/len(frames)*fps/codec.stats()["ratio"]:.1f} MB/s to disk')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='深度画像の可逆圧縮')
+    parser.add_argument('cmd', choices=('bench',))
+    parser.add_argument('--raw', help='raw_rec 形式の録画 (省略すると合成データ)')
+    parser.add_argument('--stream', default='depth')
+    parser.add_argument('-n', type=int, default=30, help='フレーム数')
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+    if args.raw:
+        from raw_rec import raw_reader
+        r = raw_reader(args.raw)
+        frames = [np.array(r[i][args.stream]) for i in range(0, len(r), max(1, len(r) // args.n))][:args.n]
+    else:
+        from np_filter import synthetic_depth
+        frames = [synthetic_depth(1280, 720, seed=i) for i in range(args.n)]
+    bench(frames, args.workers)
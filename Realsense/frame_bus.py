@@ -0,0 +1,370 @@
+'''
+    共有メモリのフレームバス (1つのプロセスがカメラを開き, 他のプロセスが名前でつなぐ)
+
+        bus = frame_publisher('realsense', profile_streams(profile), nslots=8)
+        bus.publish(frame_no, timestamp, frameset_images(frames))     # 待たない
+
+        sub = frame_subscriber('realsense')     # 別プロセス
+        f = sub.read()                          # 次のフレーム (None: 時間切れ / 終了)
+        depth = f.images['depth']               # 共有メモリをそのまま参照 (複製なし)
+        if f.valid(): ...                       # 使っている間に上書きされていないか
+        print(sub.dropped, bus.subscribers())
+
+    nslots 個のスロットのリングに書き込み, スロットごとに seqlock の番号を持つ
+        書き込み中は 2i+1 (奇数), 書き終わると 2i+2 (i は publish した通し番号)
+    読む側は番号を確かめるだけなので, 遅い購読者がいても publisher は待たない
+    追いつけずに上書きされたフレームは購読者ごとの dropped に数える (ヘッダの購読者表にも書く)
+
+    latest=True の購読者 (表示など) は溜まった分を飛ばして最新を読み,
+    latest=False (録画, 解析) はできるだけ全部を順番に読む
+
+        py frame_bus.py pub [NAME] [--slots 8]      カメラを開いて流す (表示なし)
+        py frame_bus.py view [NAME]                 表示
+        py frame_bus.py rec NAME DIR                raw_rec 形式で録画
+        py frame_bus.py stat [NAME]                 購読者ごとの読んだ数 / 取りこぼし
+        py frame_bus.py bench                       合成データで publish / read の時間
+'''
+
+import os
+import sys
+import json
+import time
+import struct
+import argparse
+import numpy as np
+from multiprocessing import shared_memory
+
+MAGIC = b'FBUS'
+ALIGN = 64
+MAX_SUBS = 16
+_HEADER = struct.Struct('<4sIIIQQ') # magic, version, スロット数, 購読者表の数, ヘッダの大きさ, スロットの大きさ
+_CTRL = 64          # ここから uint64: head (publish した数), closed
+_SUBS = 128         # 購読者表: (pid, 読んだ数, 取りこぼし, latest) x MAX_SUBS
+_LAYOUT = _SUBS + MAX_SUBS * 32 # レイアウトの JSON (長さ uint32 + 本体)
+_SLOT_HEAD = 64     # スロットの先頭: seq, frame_no, timestamp, publish した時刻
+
+def _round(n, a=ALIGN):
+    return (n + a - 1) // a * a
+
+_created = set() # このプロセスで作ったバス (resource_tracker に登録されている)
+
+def _attach(name):
+    ''' 既存の共有メモリを開く (終了時に resource_tracker に消されないように) '''
+    try:
+        return shared_memory.SharedMemory(name, track=False) # 3.13 以降
+    except TypeError:
+        shm = shared_memory.SharedMemory(name)
+        if name in _created: return shm
+        try:
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        except Exception:
+            pass
+        return shm
+
+class _ring():
+    ''' 共有メモリ上の配置 (publisher と subscriber で共通) '''
+    def _map(self, shm, layout, nslots, header_size, slot_size):
+        buf = shm.buf
+        self.nslots = nslots
+        self.layout = layout
+        self.ctrl = np.ndarray(2, np.uint64, buf, _CTRL)
+        self.subs = np.ndarray((MAX_SUBS, 4), np.uint64, buf, _SUBS)
+        self.seq, self.info, self.images = [], [], []
+        for k in range(nslots):
+            base = header_size + k * slot_size
+            self.seq.append(np.ndarray(1, np.uint64, buf, base))
+            self.info.append(np.ndarray(3, np.float64, buf, base + 8)) # frame_no, timestamp, publish した時刻
+            self.images.append({name: np.ndarray(s['shape'], s['dtype'], buf, base + s['offset'])
+                                for name, s in layout['streams'].items()})
+
+    def _unmap(self):
+        self.ctrl = self.subs = None
+        self.seq, self.info, self.images = [], [], []
+
+# ----- 書き込む側
+class frame_publisher(_ring):
+    ''' フレームを共有メモリのリングに書き込む (1つのバスに1つだけ) '''
+    def __init__(self, name, streams, nslots=8, meta=None):
+        ''' streams: {name: {'shape', 'dtype', ...}} (raw_rec.profile_streams) '''
+        self.name = name
+        offset = _SLOT_HEAD
+        lay = {}
+        for sname, s in streams.items():
+            lay[sname] = dict(s, offset=offset)
+            offset = _round(offset + int(np.prod(s['shape'])) * np.dtype(s['dtype']).itemsize)
+        slot_size = offset
+        layout = json.dumps({'streams': lay, 'meta': meta or {}}).encode()
+        header_size = _round(_LAYOUT + 4 + len(layout), 4096)
+        size = header_size + nslots * slot_size
+        try:
+            self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError: # 前回の publisher が異常終了して残っている
+            old = _attach(name)
+            old.close()
+            old.unlink()
+            self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+        _created.add(name)
+        buf = self.shm.buf
+        buf[:header_size] = bytes(header_size)
+        _HEADER.pack_into(buf, 0, MAGIC, 1, nslots, MAX_SUBS, header_size, slot_size)
+        struct.pack_into('<I', buf, _LAYOUT, len(layout))
+        buf[_LAYOUT + 4:_LAYOUT + 4 + len(layout)] = layout
+        self._map(self.shm, json.loads(layout), nslots, header_size, slot_size)
+        for s in self.seq: s[0] = 0
+        self.count = 0
+        self.publish_sec = 0.0
+
+    def publish(self, frame_no, timestamp, images):
+        ''' 1フレーム書き込む (購読者は待たない, 無いストリームは前の内容のまま) '''
+        t = time.perf_counter()
+        i = self.count
+        k = i % self.nslots
+        self.seq[k][0] = 2 * i + 1  # 書き込み中
+        dst = self.images[k]
+        for name, img in images.items():
+            if name in dst:
+                np.copyto(dst[name], img)
+        self.info[k][:] = (frame_no, timestamp, time.time() * 1000)
+        self.seq[k][0] = 2 * i + 2  # 書き終わり
+        self.count = i + 1
+        self.ctrl[0] = self.count
+        self.publish_sec += time.perf_counter() - t
+
+    def subscribers(self):
+        ''' 接続中の購読者 [{pid, read, dropped, latest}] '''
+        return [{'pid': int(p), 'read': int(r), 'dropped': int(d), 'latest': bool(l)}
+                for p, r, d, l in self.subs if p]
+
+    def stats(self):
+        return {'published': self.count, 'publish_ms': 1000 * self.publish_sec / max(self.count, 1),
+                'subscribers': self.subscribers()}
+
+    def close(self):
+        ''' 購読者に終了を知らせて共有メモリを消す '''
+        if self.shm is None: return
+        self.ctrl[1] = 1
+        self._unmap()
+        self.shm.close()
+        self.shm.unlink()
+        _created.discard(self.name)
+        self.shm = None
+
+# ----- 読む側
+class bus_frame():
+    ''' 読んだ1フレーム (images は共有メモリの view か複製) '''
+    def __init__(self, index, frame_no, timestamp, published, images, seq):
+        self.index = index          # publish の通し番号
+        self.frame_no = frame_no
+        self.timestamp = timestamp
+        self.published = published  # publish した時刻 [ms]
+        self.images = images
+        self._seq = seq
+
+    def valid(self):
+        ''' まだ上書きされていないか (view を使い終わってから確かめる) '''
+        return self._seq is None or self._seq[0] == 2 * self.index + 2
+
+class frame_subscriber(_ring):
+    ''' 名前でバスにつないでフレームを読む '''
+    def __init__(self, name, latest=False, copy=False, timeout=10.0, register=True):
+        self.name = name
+        self.latest = latest
+        self.copy = copy
+        t0 = time.time()
+        while True: # publisher が立ち上がるまで待つ
+            try:
+                self.shm = _attach(name)
+                break
+            except FileNotFoundError:
+                if time.time() - t0 > timeout: raise
+                time.sleep(0.1)
+        buf = self.shm.buf
+        magic, version, nslots, _, header_size, slot_size = _HEADER.unpack_from(buf, 0)
+        if magic != MAGIC: raise ValueError(f'not a frame bus: {name}')
+        n, = struct.unpack_from('<I', buf, _LAYOUT)
+        layout = json.loads(bytes(buf[_LAYOUT + 4:_LAYOUT + 4 + n]))
+        self._map(self.shm, layout, nslots, header_size, slot_size)
+        self.streams = layout['streams']
+        self.meta = layout['meta']
+        self.next = int(self.ctrl[0])   # つないだ後のフレームから読む
+        self.read_count = 0
+        self.dropped = 0
+        self.torn = 0                   # 複製中に上書きされた数 (dropped にも含む)
+        self._slot = None
+        for k in range(MAX_SUBS if register else 0): # 購読者表の空きを使う
+            if self.subs[k, 0] == 0:
+                self.subs[k] = (os.getpid(), 0, 0, latest)
+                self._slot = k
+                break
+
+    @property
+    def closed(self):
+        return self.ctrl is None or bool(self.ctrl[1])
+
+    def read(self, timeout=1.0):
+        ''' 次のフレーム (timeout 秒来なければ / publisher が終了したら None) '''
+        deadline = time.perf_counter() + timeout
+        while True:
+            head = int(self.ctrl[0])
+            if head > self.next:
+                oldest = head - self.nslots + 1 # head のスロットは次に上書きされる
+                first = head - 1 if self.latest else max(self.next, oldest)
+                self._drop(first - self.next)
+                f = self._get(first)
+                if f is not None:
+                    self._tally()
+                    return f
+                continue
+            if self.ctrl[1] or time.perf_counter() > deadline:
+                return None
+            time.sleep(0.0005)
+
+    def _get(self, i):
+        k = i % self.nslots
+        self.next = i + 1
+        seq = self.seq[k]
+        if seq[0] != 2 * i + 2: # もう上書きが始まっている
+            self._drop(1)
+            return None
+        frame_no, ts, published = self.info[k]
+        if not self.copy:
+            return bus_frame(i, int(frame_no), ts, published, self.images[k], seq)
+        images = {name: np.array(img) for name, img in self.images[k].items()}
+        if seq[0] != 2 * i + 2: # 複製中に上書きされた
+            self.torn += 1
+            self._drop(1)
+            return None
+        return bus_frame(i, int(frame_no), ts, published, images, None)
+
+    def _drop(self, n):
+        if n <= 0: return
+        self.dropped += n
+        if self._slot is not None: self.subs[self._slot, 2] = self.dropped
+
+    def _tally(self):
+        self.read_count += 1
+        if self._slot is not None: self.subs[self._slot, 1] = self.read_count
+
+    def __iter__(self):
+        ''' publisher が終了するまでフレームを返す '''
+        while not self.closed:
+            f = self.read()
+            if f is not None: yield f
+
+    def close(self):
+        if self.shm is None: return
+        if self._slot is not None and not self.ctrl[1]:
+            self.subs[self._slot] = 0
+        self._unmap()
+        try:
+            self.shm.close()
+        except BufferError: # 呼び出し側が view をまだ持っている (プロセス終了時に解放される)
+            pass
+        self.shm = None
+
+# ----- コマンドライン
+def publish_camera(name, nslots=8, size=(1280, 720), fps=30):
+    ''' カメラを開いてバスに流し続ける (Ctrl+C で終了) '''
+    import pyrealsense2 as rs
+    from raw_rec import profile_streams, frameset_images
+    config = rs.config()
+    config.enable_stream(rs.stream.depth, *size, rs.format.z16, fps)
+    config.enable_stream(rs.stream.color, *size, rs.format.bgr8, fps)
+    pipeline = rs.pipeline()
+    queue = rs.frame_queue(4, keep_frames=True)
+    profile = pipeline.start(config, queue)
+    bus = frame_publisher(name, profile_streams(profile), nslots)
+    print(f'publishing to "{name}" ({nslots} slots, {bus.shm.size/1e6:.1f} MB)')
+    t_report = time.time() + 5
+    try:
+        while True:
+            fs = queue.wait_for_frame().as_frameset()
+            bus.publish(fs.get_frame_number(), fs.get_timestamp(), frameset_images(fs))
+            if time.time() >= t_report:
+                t_report += 5
+                print(bus.stats())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pipeline.stop()
+        bus.close()
+
+def view(name):
+    import cv2
+    from colorize import depth_colorizer
+    colorizer = depth_colorizer()
+    sub = frame_subscriber(name, latest=True)
+    try:
+        for f in sub:
+            images = {n: colorizer(img) if img.dtype == np.uint16 else img for n, img in f.images.items()}
+            if not f.valid(): continue # 表示用に変換している間に上書きされた
+            for n, img in images.items():
+                cv2.imshow(n, img)
+            if cv2.waitKey(1) & 0xff == 27: break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f'read {sub.read_count}, dropped {sub.dropped}')
+        sub.close()
+
+def record(name, out_dir):
+    from raw_rec import raw_writer
+    sub = frame_subscriber(name, copy=True)
+    writer = raw_writer(out_dir, sub.streams, meta={'bus': name})
+    try:
+        for f in sub:
+            writer.write(f.frame_no, f.timestamp, f.images)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        writer.close()
+        print(f'read {sub.read_count}, dropped {sub.dropped}')
+        sub.close()
+
+def bench(n=300, nslots=8, size=(1280, 720)):
+    ''' 合成フレームで publish と (同じプロセスでの) 読み出しの時間 '''
+    w, h = size
+    streams = {'depth': {'shape': [h, w], 'dtype': 'uint16'}, 'color': {'shape': [h, w, 3], 'dtype': 'uint8'}}
+    images = {'depth': np.random.randint(0, 4000, (h, w), np.uint16), 'color': np.zeros((h, w, 3), np.uint8)}
+    bus = frame_publisher('frame_bus_bench', streams, nslots)
+    fast = frame_subscriber('frame_bus_bench')
+    slow = frame_subscriber('frame_bus_bench', copy=True)
+    t_read = 0.0
+    for i in range(n):
+        bus.publish(i, i * 33.3, images)
+        t = time.perf_counter()
+        f = fast.read(0)
+        t_read += time.perf_counter() - t
+        if not f.valid() or f.frame_no != i: raise AssertionError('bad frame')
+        if i % 3 == 0: slow.read(0) # 3フレームに1回しか読まない購読者
+    s = bus.stats()
+    mb = sum(img.nbytes for img in images.values()) / 1e6
+    print(f'{n} frames x {mb:.1f} MB: publish {s["publish_ms"]:.2f} ms, read (view) {1000*t_read/n:.3f} ms')
+    print(f'subscribers: {s["subscribers"]}')
+    fast.close()
+    slow.close()
+    bus.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='共有メモリのフレームバス')
+    parser.add_argument('cmd', choices=('pub', 'view', 'rec', 'stat', 'bench'))
+    parser.add_argument('name', nargs='?', default='realsense')
+    parser.add_argument('out_dir', nargs='?')
+    parser.add_argument('--slots', type=int, default=8)
+    args = parser.parse_args()
+    if args.cmd == 'pub':
+        publish_camera(args.name, args.slots)
+    elif args.cmd == 'view':
+        view(args.name)
+    elif args.cmd == 'rec':
+        if not args.out_dir: sys.exit('usage: py frame_bus.py rec NAME DIR')
+        record(args.name, args.out_dir)
+    elif args.cmd == 'stat':
+        sub = frame_subscriber(args.name, timeout=0, register=False)
+        print(f'published: {int(sub.ctrl[0])}')
+        for pid, read, dropped, latest in sub.subs:
+            if pid: print(f'  pid {pid}: read {read}, dropped {dropped}{" (latest)" if latest else ""}')
+        sub.close()
+    else:
+        bench()
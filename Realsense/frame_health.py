@@ -0,0 +1,157 @@
+'''
+    フレームの取りこぼし / ストリーム間のずれ / キューの溜まり具合の記録と, キューの長さの自動決定
+
+        cap = queue_capacity(frame_bytes([(1280, 720, 2), (1280, 720, 3)]), fps=30, latency_ms=500, memory_mb=256)
+        queue = rs.frame_queue(cap, keep_frames=True)
+        health = frame_health(cap, fps=30)
+        for fs in health.drain(queue): ...          # 待って, 溜まっている分も取り出す (捨てない, 最大 cap 個)
+        health.report(print)                        # セッションの終わりに
+
+    keep_frames=True のキューは capacity 個のフレームセットを抱えたままにできるので,
+    長さは 許容する遅延 (latency_ms 分のフレーム) と メモリ (memory_mb / 1フレームセットの大きさ) の小さい方にする
+
+    ストリームごとにハードウェアのフレーム番号の飛びを取りこぼしとして数え,
+    同じフレームセットの中のタイムスタンプの差 (最大 - 最小) をストリーム間のずれとして記録する
+    キューの溜まり具合は drain() で取り出した時に待っていた数
+    drain() は一度に capacity 個までしか取り出さないので, キューの外に抱えるフレームセットも capacity 個まで
+    (取り出した分を処理し終えてから次を drain する)
+'''
+
+import time
+import numpy as np
+import pyrealsense2 as rs
+
+def frame_bytes(streams):
+    ''' [(幅, 高さ, 1画素のバイト数), ...] -> 1フレームセットの大きさ '''
+    return sum(w * h * bpp for w, h, bpp in streams)
+
+def queue_capacity(nbytes, fps, latency_ms=500, memory_mb=256, lo=2, hi=64):
+    ''' 遅延とメモリの予算から frame_queue の長さを決める '''
+    by_latency = int(np.ceil(latency_ms * fps / 1000))
+    by_memory = int(memory_mb * 1e6 // max(nbytes, 1))
+    return int(np.clip(min(by_latency, by_memory), lo, hi))
+
+def stream_key(frame):
+    ''' フレーム -> ストリーム名 (infrared は index 付き) '''
+    p = frame.get_profile()
+    name = str(p.stream_type()).split('.')[-1]
+    return f'{name}{p.stream_index()}' if name == 'infrared' else name
+
+def arrival(frames, now=None):
+    ''' フレームセットがホストに届いた時刻 (time.monotonic(), メタデータが無ければ now) '''
+    now = time.monotonic() if now is None else now
+    key = rs.frame_metadata_value.time_of_arrival
+    toa = [frames[i].get_frame_metadata(key) for i in range(frames.size())
+           if frames[i].supports_frame_metadata(key)] # system_clock の ms
+    if not toa: return now
+    return now - max(0.0, time.time() - max(toa) / 1000)
+
+class frame_health():
+    ''' 取りこぼし, ずれ, キューの溜まり具合 (直近 size 個の値から統計) '''
+    def __init__(self, capacity=None, fps=30, size=4096):
+        self.capacity = capacity
+        self.fps = fps
+        self.size = size
+        self.framesets = 0
+        self.streams = {}           # name -> {'frames', 'dropped', 'last'}
+        self.missing = {}           # name -> フレームセットに無かった数
+        self.desync = np.zeros(size)
+        self.occupancy = np.zeros(size, np.int32)
+        self.occ_max = 0
+        self.full = 0               # キューが一杯 (以降は古いフレームが捨てられる) だった回数
+        self._nd = 0
+        self._no = 0
+
+    def add(self, frames):
+        ''' 1フレームセット '''
+        fs = frames.as_frameset()
+        ts = []
+        seen = set()
+        for i in range(fs.size()):
+            f = fs[i]
+            name = stream_key(f)
+            seen.add(name)
+            no = f.get_frame_number()
+            st = self.streams.get(name)
+            if st is None:
+                st = self.streams[name] = {'frames': 0, 'dropped': 0, 'last': None}
+            if st['last'] is not None and no > st['last']:
+                st['dropped'] += no - st['last'] - 1
+            st['last'] = no
+            st['frames'] += 1
+            ts.append(f.get_timestamp())
+        for name in self.streams:
+            if name not in seen:
+                self.missing[name] = self.missing.get(name, 0) + 1
+        if len(ts) > 1:
+            self.desync[self._nd % self.size] = max(ts) - min(ts)
+            self._nd += 1
+        self.framesets += 1
+
+    def sample(self, waiting):
+        ''' キューに待っていたフレームセットの数 '''
+        self.occupancy[self._no % self.size] = waiting
+        self._no += 1
+        self.occ_max = max(self.occ_max, waiting)
+        if self.capacity and waiting >= self.capacity - 1:
+            self.full += 1
+
+    def drain(self, queue, timeout_ms=5000, limit=None, times=False):
+        ''' 1つ待ち, 溜まっている分もまとめて返す (古い順, 全部 add 済み, 時間切れなら [])
+
+            limit: 一度に返す数の上限 (既定は capacity)
+            times: (届いた時刻, フレームセット) の組で返す (arrival(), まとめて取り出しても1つずつの時刻)
+        '''
+        limit = limit or self.capacity
+        ok, frame = queue.try_wait_for_frame(timeout_ms)
+        if not ok: return []
+        now = time.monotonic()
+        out = [frame.as_frameset()]
+        while not limit or len(out) < limit:
+            f = queue.poll_for_frame()
+            if not f: break
+            out.append(f.as_frameset())
+        self.sample(len(out) - 1)
+        for fs in out:
+            self.add(fs)
+        if times: return [(arrival(fs, now), fs) for fs in out]
+        return out
+
+    def gauges(self, metrics):
+        ''' metrics.py のゲージに出す '''
+        if self._no:
+            metrics.gauge('queue_occupancy', int(self.occupancy[(self._no - 1) % self.size]))
+        metrics.gauge('frames_dropped', sum(st['dropped'] for st in self.streams.values()))
+        if self._nd:
+            metrics.gauge('desync_ms', float(self.desync[(self._nd - 1) % self.size]))
+
+    def summary(self):
+        ''' セッションのまとめ '''
+        out = {
+            'framesets': self.framesets,
+            'streams': {n: {'frames': st['frames'], 'dropped': st['dropped'], 'missing': self.missing.get(n, 0)}
+                        for n, st in self.streams.items()},
+            'dropped': sum(st['dropped'] for st in self.streams.values()),
+        }
+        d = self.desync[:min(self._nd, self.size)]
+        if len(d):
+            half = 500 / self.fps # フレーム間隔の半分を超えたら別の時刻のフレーム
+            out['desync_ms'] = {'p50': float(np.median(d)), 'p95': float(np.percentile(d, 95)),
+                                'max': float(d.max()), 'over_half_frame': int((d > half).sum())}
+        o = self.occupancy[:min(self._no, self.size)]
+        if len(o):
+            out['queue'] = {'capacity': self.capacity, 'mean': float(o.mean()), 'p95': float(np.percentile(o, 95)),
+                            'max': self.occ_max, 'full': self.full}
+        return out
+
+    def report(self, log=print):
+        s = self.summary()
+        per = ', '.join(f'{n} {v["frames"]} (dropped {v["dropped"]}, missing {v["missing"]})' for n, v in s['streams'].items())
+        log(f'frames: {s["framesets"]} sets, dropped {s["dropped"]}: {per}')
+        if 'desync_ms' in s:
+            d = s['desync_ms']
+            log(f'desync: p50 {d["p50"]:.2f} ms, p95 {d["p95"]:.2f} ms, max {d["max"]:.2f} ms, {d["over_half_frame"]} sets over half a frame')
+        if 'queue' in s:
+            q = s['queue']
+            log(f'queue: capacity {q["capacity"]}, mean {q["mean"]:.2f}, p95 {q["p95"]:.0f}, max {q["max"]}, full {q["full"]} times')
+        return s
@@ -0,0 +1,111 @@
+'''
+    画像のバックグラウンド保存
+
+    put() はキューに積むだけで即座に戻る (満杯なら破棄して数える)
+    エンコードと書き込みはワーカースレッドで行う (cv2.imencode は GIL を解放する)
+    複製先はキュー長+ワーカー数+1 個のバッファを順番に使い回す (書き込み中の画像は上書きされない)
+
+    codec:
+        png : cv2.IMWRITE_PNG_COMPRESSION = level (0-9), 16bit 深度もそのまま可逆保存
+        tiff: 16bit 可逆
+        npy : エンコードなし (最速, 容量大)
+'''
+
+import os
+import cv2
+import time
+import queue
+import threading
+import numpy as np
+from buf_pool import buffer_pool
+
+class image_writer():
+    ''' 非同期の画像保存 '''
+    def __init__(self, out_dir, codec='png', level=1, workers=2, maxsize=64, pool=None):
+        self.out_dir = out_dir
+        self.codec = codec
+        self.level = level
+        self.written = 0        # 保存済み枚数
+        self.dropped = 0        # キュー満杯で破棄した枚数
+        self.errors = 0
+        self.bytes = 0
+        self.max_depth = 0      # キューの最大滞留数
+        self._q = queue.Queue(maxsize)
+        self.pool = pool or buffer_pool()
+        self._nbuf = maxsize + workers + 1
+        self._lock = threading.Lock()
+        os.makedirs(out_dir, exist_ok=True)
+        self._threads = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for th in self._threads: th.start()
+
+    def put(self, name, img, copy=True):
+        ''' 保存要求 (ブロックしない, 積めたら True) '''
+        if self._q.full():
+            self.dropped += 1
+            return False
+        if copy: # フレームのバッファは使い回されるので複製
+            buf = self.pool.get('image_writer', img.shape, img.dtype, self._nbuf)
+            np.copyto(buf, img)
+            img = buf
+        try:
+            self._q.put_nowait((name, img))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.max_depth = max(self.max_depth, self._q.qsize())
+        return True
+
+    def backpressure(self):
+        ''' キューの使用率 (0.0 - 1.0) '''
+        return self._q.qsize() / self._q.maxsize if self._q.maxsize else 0.0
+
+    def stats(self):
+        return {
+            'written': self.written,
+            'dropped': self.dropped,
+            'errors': self.errors,
+            'queued': self._q.qsize(),
+            'max_queued': self.max_depth,
+            'MB': self.bytes / 1e6,
+        }
+
+    def close(self, timeout=None):
+        ''' 残りを全て書き出して終了 '''
+        for _ in self._threads:
+            self._q.put((None, None))
+        end = None if timeout is None else time.time() + timeout
+        for th in self._threads:
+            th.join(None if end is None else max(0, end - time.time()))
+        print(f'image_writer: {self.stats()}')
+
+    def _encode(self, img):
+        if self.codec == 'png':
+            ok, buf = cv2.imencode('.png', img, [cv2.IMWRITE_PNG_COMPRESSION, self.level])
+        elif self.codec == 'tiff':
+            ok, buf = cv2.imencode('.tiff', img)
+        else:
+            raise ValueError(f'unknown codec: {self.codec}')
+        if not ok: raise IOError('encode failed')
+        return buf
+
+    def _work(self):
+        while True:
+            name, img = self._q.get()
+            if name is None: break
+            path = os.path.join(self.out_dir, f'{name}.{self.codec}')
+            try:
+                if self.codec == 'npy':
+                    np.save(path, img)
+                    size = img.nbytes
+                else:
+                    buf = self._encode(img)
+                    with open(path, 'wb') as f:
+                        f.write(buf.tobytes())
+                    size = buf.nbytes
+                with self._lock:
+                    self.written += 1
+                    self.bytes += size
+            except Exception as e:
+                print(e)
+                with self._lock:
+                    self.errors += 1
@@ -23,8 +23,24 @@ import os
 import sys
 import cv2
 import time
+import threading
+import collections
 import numpy as np
 import pyrealsense2 as rs
+from rs_filter import rs_filter_chain
+from stage_pipeline import stage_pipeline
+from colorize import depth_colorizer
+from buf_pool import buffer_pool
+from img_writer import image_writer
+from raw_rec import raw_writer, profile_streams, frameset_images
+from playback import open_player
+from metrics import stage_metrics
+from np_align import depth_aligner
+from depth_codec import frame_codec
+from quality import quality_controller
+from frame_bus import frame_publisher
+from roi_stats import roi_recorder
+from frame_health import frame_health, queue_capacity, frame_bytes
 
 class Settings():
     def __init__(self):
@@ -33,32 +49,134 @@ class Settings():
         self.V_SIZE_D = (1280, 720)      # Depth 画面サイズ (USB 3)
         self.FPS = 30                   # フレームレート
         self.HEATMAP = False            # ヒートマップ表示
+        self.HEADLESS = False           # ウィンドウを出さずに処理だけ行う (--headless, Ctrl+C で終了)
+        self.PREVIEW_HZ = 10            # 表示の更新頻度 (処理とは別, 0 で毎フレーム)
         self.NOISE_FILTER = True        # ノイズフィルタ
+        self.SHOW_RAW_DEPTH = True      # フィルタ前の深度も表示するか (NOISE_FILTER 時)
+        self.DEPTH_ALPHA = 0.08         # 深度 -> カラーマップの倍率
+        self.ALIGN = None               # 深度をカラーの画角に合わせる (live/play 共通)
+                                        # 'numpy': np_align (フィルタ後の配列, 1280x720 で約 100 ms/フレーム), 'rs': rs.align, None: しない
 
         # ----- BAGファイル保存ディレクトリ
-        self.F_NAME = 'realsense_b.bag' # ファイル名
+        self.F_NAME = 'realsense_b.bag' # ファイル名 (play は分割録画のセッションのディレクトリも可)
         desktop = os.path.expanduser('~/Desktop')
         self.FULL_NAME = os.path.join(desktop, self.F_NAME)
 
+        # ----- 録画形式
+        self.REC_FORMAT = 'bag'         # 'bag': rosbag, 'raw': メモリマップの生フレーム (raw_rec.py)
+        self.RAW_DIR = os.path.join(desktop, 'realsense_raw') # 'raw' の保存ディレクトリ
+        self.RAW_SEGMENT = 300          # 1セグメントのフレーム数
+        self.RAW_COMPRESS = ('depth',)  # 'raw' で可逆圧縮するストリーム (depth_codec.py, () で無効)
+        self.RAW_PREDICTOR = 'left'     # 圧縮の予測方式 ('left' / 'gradient')
+        self.RAW_CODEC_WORKERS = 4      # 圧縮スレッド数
+
+        # ----- 再生設定
+        self.PLAY_RATE = 1.0            # 再生速度の倍率
+        self.PLAY_REALTIME = True       # False: 待ち時間なしで最速再生
+        self.PLAY_START = 0.0           # 再生開始位置 (s)
+
         # ----- 画像での保存
         self.WRITE_IMG = False         # 保存するか
         self.WRITE_DIR = 'tmp'         # 保存するディレクトリ
+        self.WRITE_CODEC = 'png'       # 'png' / 'tiff' / 'npy'
+        self.WRITE_LEVEL = 1           # PNG 圧縮レベル (0-9)
+        self.WRITE_RAW_DEPTH = True    # 深度はカラーマップではなく 16bit のまま保存
+        self.WRITE_WORKERS = 2         # 保存スレッド数
+        self.WRITE_QUEUE = 64          # 保存待ちの上限 (超えた分は破棄)
+
+        # ----- 処理時間の計測 (metrics.py)
+        self.METRICS_SEC = 10           # 書き出し間隔 (s), 0 で無効
+        self.METRICS_JSONL = 'metrics.jsonl'    # JSON Lines (1行ごとに追記)
+        self.METRICS_PROM = 'metrics.prom'      # Prometheus textfile 形式
+
+        # ----- ROI ごとの距離 (roi_stats.py)
+        self.ROI_FILE = None           # ROI の JSON (None で無効), 座標は画角補正後の深度画像
+        self.ROI_LOG = 'roi_log'       # min/median/mean/有効画素の割合を列ごとに書き出すディレクトリ
+
+        # ----- 他のプロセスへの配信 (frame_bus.py)
+        self.PUBLISH = None            # live の生フレームを流す共有メモリのバス名 ('realsense' など, None で無効)
+        self.PUBLISH_SLOTS = 8         # リングのスロット数 (遅い購読者が追いつける余裕)
+
+        # ----- 負荷に応じた画質調整 (quality.py)
+        self.ADAPTIVE = True           # 処理が追いつかない時に画質を落として遅延を抑える
+        self.ADAPTIVE_BACKLOG = 2      # キューにこれだけ溜まったら画質を下げる
+
+        # ----- 入力キュー (frame_health.py)
+        self.QUEUE_LATENCY_MS = 500    # live のキューに溜めてよい遅延 (ms)
+        self.QUEUE_MEMORY_MB = 256     # キューが抱えてよいフレームのメモリ (MB), 長さは両方を満たす最大
+
+        # ----- マルチスレッド処理
+        self.MULTI_THREAD = False      # capture/filter/colorize/display を別スレッドで実行
+        self.QUEUE_SIZE = 4            # ステージ間キューの長さ
+        self.QUEUE_POLICY = 'drop'     # 'drop': 古いフレームを破棄, 'block': 空くまで待つ
+        self.FILTER_WORKERS = 2        # フィルタ処理のスレッド数
 
         # ----- フィルタ設定
-        self.decimate = rs.decimation_filter()
-        self.decimate.set_option(rs.option.filter_magnitude, 1)
-        self.spatial = rs.spatial_filter()
-        self.spatial.set_option(rs.option.filter_magnitude, 1)
-        self.spatial.set_option(rs.option.filter_smooth_alpha, 0.25)
-        self.spatial.set_option(rs.option.filter_smooth_delta, 50)
-        self.hole_filling = rs.hole_filling_filter()
-        self.depth_to_disparity = rs.disparity_transform(True)
-        self.disparity_to_depth = rs.disparity_transform(False)
+        self.DECIMATE_MAGNITUDE = 1    # decimation の間引き率
+        self.SPATIAL_MAGNITUDE = 1     # spatial filter の繰り返し回数
+        self.SMOOTH_ALPHA = 0.25       # spatial filter の alpha
+        self.SMOOTH_DELTA = 50         # spatial filter の delta
+        self.HOLE_FILLING = 1          # 0: fill_from_left, 1: farest_from_around, 2: nearest_from_around
+        self.filters = self.make_filters()
+        self.decimate = self.filters.decimate
+        self.spatial = self.filters.spatial
+        self.hole_filling = self.filters.hole_filling
+        self.depth_to_disparity = self.filters.depth_to_disparity
+        self.disparity_to_depth = self.filters.disparity_to_depth
         align_to = rs.stream.color
         self.align = rs.align(align_to)
 
+    def make_filters(self):
+        ''' 設定値からフィルタチェーンを作成 (スレッドごとに1つ) '''
+        return rs_filter_chain(
+            self.DECIMATE_MAGNITUDE,
+            self.SPATIAL_MAGNITUDE,
+            self.SMOOTH_ALPHA,
+            self.SMOOTH_DELTA,
+            self.HOLE_FILLING,
+        )
+
+class _preview():
+    ''' 表示 (ウィンドウは最初に1度だけ作り, hz で間引いて更新する) '''
+    def __init__(self, names, hz=10, headless=False):
+        self.names = names
+        self.headless = headless
+        self.intv = 1.0 / hz if hz else 0.0
+        self._next = 0.0
+        if not headless:
+            for name in names:
+                cv2.namedWindow(name, cv2.WINDOW_AUTOSIZE)
+
+    def due(self):
+        ''' 今回のフレームを表示するか '''
+        if self.headless: return False
+        now = time.perf_counter()
+        if now < self._next: return False
+        self._next = max(self._next + self.intv, now) if self.intv else now
+        return True
+
+    def show(self, images):
+        ''' 表示してキー入力を返す '''
+        for name, img in images.items():
+            cv2.imshow(name, img)
+        return cv2.waitKey(1) &0xff
+
+    def close(self):
+        if not self.headless:
+            cv2.destroyAllWindows()
+
 class Realsense_test():
+    def _metrics(self):
+        ''' 処理時間の計測 (METRICS_SEC=0 なら書き出さない) '''
+        return stage_metrics(
+            f'realsense_{self.mode}',
+            export_sec=settings.METRICS_SEC or float('inf'),
+            jsonl=settings.METRICS_JSONL,
+            prom=settings.METRICS_PROM,
+        )
+
     def __init__(self):
+        self.health = None # live の取りこぼし / ずれ / キューの記録
         self.config = rs.config()
         # self.config.enable_stream(rs.stream.infrared, 1, *settings.V_SIZE, rs.format.y8, settings.FPS)
         self.config.enable_stream(rs.stream.depth, *settings.V_SIZE_D, rs.format.z16, settings.FPS)
@@ -66,16 +184,31 @@ class Realsense_test():
 
     def rec(self, settings):
         self.mode = 'rec'
-        self.config.enable_record_to_file(settings.FULL_NAME)
+        raw = settings.REC_FORMAT == 'raw'
+        if not raw:
+            self.config.enable_record_to_file(settings.FULL_NAME)
 
         pipeline = rs.pipeline()
-        pipeline.start(self.config)
+        profile = pipeline.start(self.config)
+        writer = None
+        if raw:
+            codec = frame_codec(settings.RAW_PREDICTOR, workers=settings.RAW_CODEC_WORKERS) if settings.RAW_COMPRESS else None
+            writer = raw_writer(settings.RAW_DIR, profile_streams(profile), settings.RAW_SEGMENT,
+                                codec=codec, compress=settings.RAW_COMPRESS)
+        metrics = self._metrics()
         start = time.time()
         frame_no = 1
         try:
             while True:
+                t = metrics.start()
                 frames = pipeline.wait_for_frames()
+                t = metrics.lap('wait', t)
                 color_frame = frames.get_color_frame()
+                if writer:
+                    writer.write(frames.get_frame_number(), frames.get_timestamp(), frameset_images(frames))
+                    t = metrics.lap('write', t)
+                metrics.latency(frames)
+                metrics.tick()
                 # ir_frame = frames.get_infrared_frame()
 
                 if frame_no%settings.FPS == 0:
@@ -91,39 +224,103 @@ class Realsense_test():
             print(e)
         finally:    
             pipeline.stop()
+            if writer:
+                writer.close()
+                if writer.codec:
+                    print(f'codec: {writer.codec.stats()}, dropped (codec behind): {writer.dropped}')
+                    writer.codec.close()
 
     def live(self, settings):
         ''' カメラのデータをリアルタイムで表示 '''
         self.mode = 'live'
         pipeline = rs.pipeline()
-        self.queue = rs.frame_queue(50, keep_frames=True)
-        profile = pipeline.start(self.config, self.queue)
-        self._pw(pipeline)
+        nbytes = frame_bytes([(*settings.V_SIZE_D, 2), (*settings.V_SIZE_RGB, 3)])
+        cap = queue_capacity(nbytes, settings.FPS, settings.QUEUE_LATENCY_MS, settings.QUEUE_MEMORY_MB)
+        print(f'frame queue: {cap} ({cap*nbytes/1e6:.0f} MB max)')
+        self.queue = rs.frame_queue(cap, keep_frames=True)
+        self.health = frame_health(cap, settings.FPS)
+        if not settings.PUBLISH:
+            profile = pipeline.start(self.config, self.queue)
+            self._show(pipeline)
+            return
+        # 表示と同時に他のプロセス (録画, 解析) へ共有メモリで配る
+        bus = None
+        def publish(frame):
+            if bus:
+                fs = frame.as_frameset()
+                bus.publish(fs.get_frame_number(), fs.get_timestamp(), frameset_images(fs))
+            self.queue.enqueue(frame)
+        profile = pipeline.start(self.config, publish)
+        bus = frame_publisher(settings.PUBLISH, profile_streams(profile), settings.PUBLISH_SLOTS)
+        try:
+            self._show(pipeline)
+        finally:
+            print(f'bus: {bus.stats()}')
+            bus.close()
 
     def play(self, settings):
         ''' 録画したデータの再生 '''
         self.mode = 'play'
-        self.config.enable_device_from_file(settings.FULL_NAME)
-        pipeline = rs.pipeline()
-        profile = pipeline.start(self.config)
-        self._pw(pipeline)
+        self.health = None
+        self.player = open_player(
+            settings.FULL_NAME,
+            settings.PLAY_RATE,
+            settings.PLAY_REALTIME,
+            repeat=settings.PLAY_REALTIME,
+            start=settings.PLAY_START,
+        )
+        print(f'{len(self.player)} frames, {self.player.duration:.1f} s (space: pause, n: step, a/d: -5s/+5s)')
+        self._show(self.player)
+
+    def _show(self, pipeline):
+        ''' 設定に応じて表示ループを選択 '''
+        if settings.MULTI_THREAD:
+            self._pw_mt(pipeline)
+        else:
+            self._pw(pipeline)
 
     def _pw(self, pipeline):
         ''' フレームの表示 '''
+        pool = buffer_pool() # 毎フレームの出力先 (確保は最初の1回だけ)
+        colorizer = depth_colorizer(settings.DEPTH_ALPHA, pool=pool)
+        raw_colorizer = depth_colorizer(settings.DEPTH_ALPHA, pool=pool)
+        show_raw = settings.NOISE_FILTER and settings.SHOW_RAW_DEPTH and not settings.HEADLESS
+        writer = self._writer(pool)
+        metrics = self._metrics()
+        windows = ['color_image', 'depth_image'] + (['depth_image (no filter)'] if show_raw else [])
+        preview = _preview(windows, settings.PREVIEW_HZ, settings.HEADLESS)
+        need_colormap = writer and not settings.WRITE_RAW_DEPTH
+        aligner = None
+        qc = self._quality()
+        rois = self._rois()
+        waiting = collections.deque() # キューからまとめて取り出したフレーム
         try:
             start = time.time()
             frame_no = 0
             while True:
                 # ----- 画像取得
+                t = metrics.start()
+                backlog = 0
                 if self.mode == 'play':
                     frames = pipeline.wait_for_frames()
-                    aligned_frames = self.align.process(frames) # 画角補正
-                    depth_frame = aligned_frames.get_depth_frame()
-                    color_frame = aligned_frames.get_color_frame()
                 else:
-                    frame = self.queue.wait_for_frame()
-                    depth_frame = frame.as_frameset().get_depth_frame()
-                    color_frame = frame.as_frameset().get_color_frame()
+                    if not waiting: # 溜まっている分もまとめて取り出す (取りこぼしとキューの長さを記録)
+                        waiting.extend(self.health.drain(self.queue))
+                        if not waiting: raise RuntimeError("Frame didn't arrive within 5000") # wait_for_frames と同じ
+                    backlog = len(waiting) - 1
+                    if qc and (qc.level > 0 or backlog >= qc.backlog):
+                        # 追いつかない時だけ, 溜まっていた分は捨てて最新のフレームを処理する (遅延優先)
+                        frames = waiting[-1]
+                        waiting.clear()
+                    else: # 負荷が無ければ全部処理する (WRITE_IMG / ROI / metrics のフレームを飛ばさない)
+                        frames = waiting.popleft()
+                t = metrics.lap('wait', t)
+                t_proc = t
+                if settings.ALIGN == 'rs':
+                    frames = settings.align.process(frames) # 画角補正
+                    t = metrics.lap('align', t)
+                depth_frame = frames.get_depth_frame()
+                color_frame = frames.get_color_frame()
 
                 # ir_frame = frames.get_infrared_frame()
                 # if not depth_frame or not color_frame or not ir_frame:
@@ -144,56 +341,265 @@ class Realsense_test():
                 # time.sleep(100)
 
                 # ----- 深度カメラのノイズ除去
+                if settings.ALIGN == 'numpy' and aligner is None:
+                    aligner = depth_aligner.from_frames(depth_frame, color_frame)
+                raw_now = show_raw and (not qc or qc.show_raw)
                 if settings.NOISE_FILTER:
-                    _depth_image = np.asanyarray(depth_frame.get_data())
-                    _depth_colormap = cv2.applyColorMap(cv2.convertScaleAbs(_depth_image, alpha=0.08), cv2.COLORMAP_JET)
-                    ff = settings.decimate.process(depth_frame)
-                    ff = settings.depth_to_disparity.process(ff)
-                    ff = settings.spatial.process(ff)
-                    ff = settings.disparity_to_depth.process(ff)
-                    ff = settings.hole_filling.process(ff)
-                    depth_frame = ff.as_depth_frame()
-
-                # ----- カラーマップ適用
-                # ir_image = np.asanyarray(ir_frame.get_data())
+                    if raw_now:
+                        _depth_image = np.asanyarray(depth_frame.get_data())
+                    if qc:
+                        settings.filters.configure(qc.decimate, qc.spatial)
+                    depth_frame = settings.filters.process(depth_frame)
+                t = metrics.lap('filter', t)
+
+                # ----- 画角補正 (フィルタ後の配列をカラーの画素に投影)
                 depth_image = np.asanyarray(depth_frame.get_data())
                 color_image = np.asanyarray(color_frame.get_data())
-                depth_colormap = cv2.applyColorMap(cv2.convertScaleAbs(depth_image, alpha=0.08), cv2.COLORMAP_JET)
+                if settings.ALIGN == 'numpy':
+                    depth_image = aligner.process(depth_image)
+                    t = metrics.lap('align', t)
+
+                # ----- ROI ごとの距離
+                if rois:
+                    rois.write(color_frame.get_frame_number(), color_frame.get_timestamp(), depth_image, depth_frame.get_units())
+                    t = metrics.lap('roi', t)
+
+                # ----- カラーマップ適用 (表示か保存に使う時だけ)
+                # ir_image = np.asanyarray(ir_frame.get_data())
+                show = (not qc or qc.display(frame_no)) and preview.due()
+                depth_colormap = None
+                if show or need_colormap:
+                    depth_colormap = colorizer(depth_image)
+                    t = metrics.lap('colormap', t)
 
                 # ----- 表示
-                # cv2.namedWindow('ir_image', cv2.WINDOW_AUTOSIZE)
-                # cv2.imshow('ir_image', self._heat(ir_image))
-                cv2.namedWindow('color_image', cv2.WINDOW_AUTOSIZE)
-                cv2.imshow('color_image', color_image)
-                cv2.namedWindow('depth_image', cv2.WINDOW_AUTOSIZE)
-                # depth_colormap = depth_colormap[120:620, 150:960] # RGBの画像サイズ合わせ
-                cv2.imshow('depth_image', depth_colormap)
-                # cv2.imshow('depth_image', self._heat(depth_image))
+                key = 0xff
+                if show:
+                    # cv2.imshow('ir_image', self._heat(ir_image))
+                    # depth_colormap = depth_colormap[120:620, 150:960] # RGBの画像サイズ合わせ
+                    images = {'color_image': color_image, 'depth_image': depth_colormap}
+                    if raw_now:
+                        images['depth_image (no filter)'] = raw_colorizer(_depth_image)
+                    key = preview.show(images)
+                    t = metrics.lap('imshow', t)
 
-                if settings.NOISE_FILTER:
-                    cv2.namedWindow('depth_image (no filter)', cv2.WINDOW_AUTOSIZE)
-                    cv2.imshow('depth_image (no filter)', _depth_colormap)
+                # ----- 画像での保存
+                if writer:
+                    self._write(writer, frame_no, color_image, depth_image, depth_colormap)
+                    t = metrics.lap('imwrite', t)
+
+                if self.mode != 'play': # 再生中は記録時の時刻になる
+                    metrics.latency(color_frame)
+                self._allocs(metrics, pool)
+                if qc:
+                    qc.update((time.perf_counter() - t_proc) * 1000, backlog)
+                    metrics.gauge('quality_level', qc.level)
+                    metrics.gauge('backlog', backlog)
+                if self.health:
+                    self.health.gauges(metrics)
+                metrics.tick()
+                if key == 27:
+                    break
+                elif self.mode == 'play':
+                    self.player.key(key)
+        except KeyboardInterrupt:
+            pass
+        except Exception as e:
+            print(e)
+        finally:
+            preview.close()
+            pipeline.stop()
+            if writer: writer.close()
+            if rois: rois.close()
+            if self.health: self.health.report()
+
+    def _pw_mt(self, pipeline):
+        ''' フレームの表示 (capture -> filter -> colorize -> display を別スレッドで実行) '''
+        local = threading.local() # フィルタと画角補正はスレッドごとに持つ
+        show_raw = settings.NOISE_FILTER and settings.SHOW_RAW_DEPTH and not settings.HEADLESS
+        nbuf = settings.QUEUE_SIZE + 3 # 表示中のバッファを上書きしないだけの数
+        pool = buffer_pool()
+        colorizer = depth_colorizer(settings.DEPTH_ALPHA, nbuf=nbuf, pool=pool)
+        raw_colorizer = depth_colorizer(settings.DEPTH_ALPHA, nbuf=nbuf, pool=pool)
+
+        metrics = self._metrics()
+        qc = self._quality()
+        waiting = collections.deque()
+
+        def capture():
+            t = metrics.start()
+            if self.mode == 'play':
+                frames = pipeline.wait_for_frames()
+                frames.keep()
+            else:
+                if not waiting:
+                    waiting.extend(self.health.drain(self.queue))
+                    if not waiting: raise RuntimeError("Frame didn't arrive within 5000") # パイプラインを止める
+                frames = waiting.popleft()
+            metrics.lap('wait', t)
+            return {'frames': frames}
+
+        def filtering(item):
+            if not hasattr(local, 'filters'):
+                local.filters = settings.make_filters()
+                local.align = rs.align(rs.stream.color)
+                local.aligner = None
+            frames = item.pop('frames')
+            t = metrics.start()
+            if settings.ALIGN == 'rs':
+                frames = local.align.process(frames) # 画角補正
+                t = metrics.lap('align', t)
+            depth_frame = frames.get_depth_frame()
+            color_frame = frames.get_color_frame()
+            if not depth_frame or not color_frame:
+                return None
+            if settings.ALIGN == 'numpy' and local.aligner is None:
+                local.aligner = depth_aligner.from_frames(depth_frame, color_frame)
+            if settings.NOISE_FILTER:
+                if show_raw and (not qc or qc.show_raw):
+                    item['raw_depth'] = np.asanyarray(depth_frame.get_data())
+                if qc:
+                    local.filters.configure(qc.decimate, qc.spatial)
+                depth_frame = local.filters.process(depth_frame)
+            item['depth'] = np.asanyarray(depth_frame.get_data())
+            item['color'] = np.asanyarray(color_frame.get_data())
+            item['color_frame'] = color_frame
+            item['depth_units'] = depth_frame.get_units()
+            item['filter_ms'] = (time.perf_counter() - t) * 1000
+            t = metrics.lap('filter', t)
+            if settings.ALIGN == 'numpy':
+                # 出力は次のステージに渡すので, 表示中のものを上書きしない数のバッファを順番に使う
+                out = pool.get('aligned', local.aligner.shape, np.uint16, nbuf + settings.FILTER_WORKERS)
+                item['depth'] = local.aligner.process(item['depth'], out)
+                metrics.lap('align', t)
+            return item
+
+        def colorize(item):
+            t = metrics.start()
+            item['depth_colormap'] = colorizer(item['depth'])
+            if 'raw_depth' in item:
+                item['raw_colormap'] = raw_colorizer(item['raw_depth'])
+            metrics.lap('colormap', t)
+            return item
+
+        writer = self._writer(pool)
+        rois = self._rois()
+        need_colormap = not settings.HEADLESS or (writer and not settings.WRITE_RAW_DEPTH)
+        stages = stage_pipeline(settings.QUEUE_SIZE, settings.QUEUE_POLICY)
+        stages.add('filter', filtering, settings.FILTER_WORKERS)
+        if need_colormap:
+            stages.add('colorize', colorize)
+        windows = ['color_image', 'depth_image'] + (['depth_image (no filter)'] if show_raw else [])
+        preview = _preview(windows, settings.PREVIEW_HZ, settings.HEADLESS)
+        try:
+            stages.start(capture)
+            start = time.time()
+            frame_no = 0
+            while stages.running:
+                item = stages.get(timeout=1.0)
+                if item is None:
+                    continue
+
+                # ----- FPS 計算
+                if frame_no%settings.FPS == 0:
+                    fps  = settings.FPS / (time.time() - start)
+                    start = time.time()
+                    print(f'FPS: {fps}, queue: {stages.stats()}')
+                frame_no += 1
+
+                # ----- 表示 (最新の処理結果を PREVIEW_HZ で)
+                t = metrics.start()
+                key = 0xff
+                if (not qc or qc.display(frame_no)) and preview.due():
+                    images = {'color_image': item['color'], 'depth_image': item['depth_colormap']}
+                    if 'raw_colormap' in item:
+                        images['depth_image (no filter)'] = item['raw_colormap']
+                    key = preview.show(images)
+                    t = metrics.lap('imshow', t)
 
                 # ----- 画像での保存
-                if settings.WRITE_IMG:
-                    cv2.imwrite(f'{settings.WRITE_DIR}/color_{frame_no}.png', color_image)
-                    cv2.imwrite(f'{settings.WRITE_DIR}/depth_{frame_no}.png', depth_colormap)
+                if writer:
+                    self._write(writer, frame_no, item['color'], item['depth'], item.get('depth_colormap'))
+                    t = metrics.lap('imwrite', t)
+
+                # ----- ROI ごとの距離
+                if rois:
+                    cf = item['color_frame']
+                    rois.write(cf.get_frame_number(), cf.get_timestamp(), item['depth'], item['depth_units'])
+                    t = metrics.lap('roi', t)
 
-                if cv2.waitKey(1) &0xff == 27:
-                    cv2.destroyAllWindows()
+                if self.mode != 'play':
+                    metrics.latency(item['color_frame'])
+                depths = [q['depth'] for q in stages.stats().values()]
+                for name, q in stages.stats().items():
+                    metrics.gauge(f'queue_{name}', q['depth'])
+                self._allocs(metrics, pool)
+                if qc: # フィルタが律速なので, その時間をスレッド数で割ったものを1フレームの処理時間とみなす
+                    qc.update(item['filter_ms'] / settings.FILTER_WORKERS, max(depths))
+                    metrics.gauge('quality_level', qc.level)
+                if self.health:
+                    self.health.gauges(metrics)
+                metrics.tick()
+                if key == 27:
                     break
+                elif self.mode == 'play':
+                    self.player.key(key)
+        except KeyboardInterrupt:
+            pass
         except Exception as e:
             print(e)
         finally:
+            preview.close()
+            stages.stop()
             pipeline.stop()
+            if writer: writer.close()
+            if rois: rois.close()
+            if self.health: self.health.report()
+
+    def _quality(self):
+        ''' 画質調整 (ADAPTIVE が無効なら None) '''
+        if not settings.ADAPTIVE: return None
+        return quality_controller(1000 / settings.FPS, settings.DECIMATE_MAGNITUDE, backlog=settings.ADAPTIVE_BACKLOG)
+
+    def _rois(self):
+        ''' ROI の統計と書き出し (ROI_FILE が無ければ None) '''
+        if not settings.ROI_FILE: return None
+        return roi_recorder(settings.ROI_FILE, settings.ROI_LOG, meta={'mode': self.mode})
+
+    def _allocs(self, metrics, pool):
+        ''' このフレームでのバッファ確保 (定常状態では 0 になる) '''
+        allocs, nbytes = pool.frame()
+        metrics.gauge('alloc_count', allocs)
+        metrics.gauge('alloc_bytes', nbytes)
+        metrics.gauge('alloc_total', pool.allocs)
+        metrics.gauge('pool_bytes', pool.bytes)
+
+    def _writer(self, pool=None):
+        ''' 画像保存スレッドを作成 (WRITE_IMG が無効なら None) '''
+        if not settings.WRITE_IMG: return None
+        return image_writer(
+            settings.WRITE_DIR,
+            settings.WRITE_CODEC,
+            settings.WRITE_LEVEL,
+            settings.WRITE_WORKERS,
+            settings.WRITE_QUEUE,
+            pool,
+        )
+
+    def _write(self, writer, frame_no, color_image, depth_image, depth_colormap):
+        ''' 画像の保存要求 (ディスク I/O は待たない) '''
+        writer.put(f'color_{frame_no}', color_image)
+        if settings.WRITE_RAW_DEPTH:
+            writer.put(f'depth_{frame_no}', depth_image)
+        else:
+            writer.put(f'depth_{frame_no}', depth_colormap)
 
     def _heat(self, np_img):
         ''' ヒートマップに変換 '''
         if not settings.HEATMAP: return np_img
-        return cv2.applyColorMap(
-            cv2.convertScaleAbs(np_img, alpha=0.3),
-            cv2.COLORMAP_JET,
-        )
+        if not hasattr(self, '_heatmap'):
+            self._heatmap = depth_colorizer(alpha=0.3)
+        return self._heatmap(np_img)
         # heatmap = None
         # heatmap = cv2.normalize(
         #     np_img,
@@ -207,6 +613,9 @@ class Realsense_test():
 
 if __name__ == "__main__":
     settings = Settings()
+    if '--headless' in sys.argv:
+        settings.HEADLESS = True
+        sys.argv.remove('--headless')
     tester = Realsense_test()
     if len(sys.argv) >= 2:
         opt = str(sys.argv[1])
@@ -217,4 +626,4 @@ if __name__ == "__main__":
         else:
             tester.play(settings)
     else:
-        print(f'----- option -----\nrecode: py main.py rec\nlive  : py main.py live\nplay  : py main.py play')
+        print(f'----- option -----\nrecode: py main.py rec\nlive  : py main.py live [--headless]\nplay  : py main.py play [--headless]')
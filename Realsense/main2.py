@@ -1,6 +1,8 @@
 import pyrealsense2 as rs
 import numpy as np
 import cv2
+from colorize import depth_colorizer
+from buf_pool import buffer_pool, side_by_side
 
 # ストリーム(Color/Depth)の設定
 config = rs.config()
@@ -13,6 +15,9 @@ pipeline = rs.pipeline()
 profile = pipeline.start(config)
 align_to = rs.stream.color
 align = rs.align(align_to)
+pool = buffer_pool()
+colorizer = depth_colorizer(alpha=0.08, pool=pool)
+cv2.namedWindow('RealSense', cv2.WINDOW_AUTOSIZE)
 
 try:
     while True:
@@ -27,12 +32,13 @@ try:
         #depth
         depth_frame = aligned_frames.get_depth_frame()
         depth_image = np.asanyarray(depth_frame.get_data())
-        depth_colormap = cv2.applyColorMap(cv2.convertScaleAbs(depth_image, alpha=0.08), cv2.COLORMAP_JET)
 
-
-        # 表示
-        images = np.hstack((RGB_image, depth_colormap))
-        cv2.namedWindow('RealSense', cv2.WINDOW_AUTOSIZE)
+        # 表示 (RGB とカラーマップを同じキャンバスの左右に直接書き込む)
+        images, (_, depth_view) = side_by_side(pool, [RGB_image, None], shapes=[RGB_image.shape, (*depth_image.shape, 3)])
+        colorizer(depth_image, out=depth_view)
+        allocs, nbytes = pool.frame()
+        if allocs:
+            print(f'alloc: {allocs} ({nbytes/1e6:.1f} MB)')
         cv2.imshow('RealSense', images)
         if cv2.waitKey(1) & 0xff == 27:#ESCで終了
             cv2.destroyAllWindows()
@@ -0,0 +1,141 @@
+'''
+    ステージごとの処理時間の計測と書き出し
+
+        m = stage_metrics(jsonl='metrics.jsonl', prom='metrics.prom')
+        t = m.start()
+        ...; t = m.lap('wait', t)
+        ...; t = m.lap('filter', t)
+        m.latency(frame)    # フレームのタイムスタンプから表示までの遅延
+        m.tick()            # 1フレームに1回, export_sec ごとに書き出す
+
+    lap() は perf_counter と配列への代入だけ (数 us) なので常に有効にしておける
+    p50/p95/p99/max は直近 size 個の値から書き出しの時にだけ計算する
+    書き出し (計算とファイル I/O) は別スレッドで行い, tick() を呼んだスレッドは待たない
+    latency() は録画の再生中には呼ばないこと (記録時の時刻と今の時刻の差になる)
+'''
+
+import os
+import json
+import time
+import threading
+import contextlib
+import numpy as np
+try:
+    import pyrealsense2 as rs
+    _HOST_DOMAINS = (rs.timestamp_domain.global_time, rs.timestamp_domain.system_time)
+except ImportError:
+    rs = None
+    _HOST_DOMAINS = ()
+
+class stage_metrics():
+    ''' ステージごとの処理時間 [ms] のリングバッファ '''
+    def __init__(self, name='realsense', size=1024, export_sec=10.0, jsonl=None, prom=None):
+        self.name = name
+        self.size = size
+        self.export_sec = export_sec
+        self.jsonl = jsonl
+        self.prom = prom
+        self.samples = {}   # stage -> ndarray
+        self.counts = {}    # stage -> 記録した数
+        self.sums = {}      # stage -> 記録した値の合計 (Prometheus の _sum)
+        self.max = {}       # stage -> 起動からの最大
+        self.gauges = {}    # 任意の値 (キュー長など)
+        self.frames = 0
+        self._lock = threading.Lock()
+        self._t_export = time.perf_counter()
+        self._exporting = None
+
+    @staticmethod
+    def start():
+        return time.perf_counter()
+
+    def lap(self, stage, t0):
+        ''' t0 からの経過を stage の時間として記録し, 今の時刻を返す '''
+        now = time.perf_counter()
+        self.add(stage, (now - t0) * 1000)
+        return now
+
+    def add(self, stage, ms):
+        with self._lock:
+            buf = self.samples.get(stage)
+            if buf is None:
+                buf = self.samples[stage] = np.zeros(self.size)
+                self.counts[stage] = 0
+                self.sums[stage] = 0.0
+                self.max[stage] = 0.0
+            buf[self.counts[stage] % self.size] = ms
+            self.counts[stage] += 1
+            self.sums[stage] += ms
+            if ms > self.max[stage]: self.max[stage] = ms
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.lap(stage, t0)
+
+    def latency(self, frame, stage='capture_to_display'):
+        ''' フレームのタイムスタンプ (ホスト時刻の時のみ) から今までの遅延 '''
+        if frame.get_frame_timestamp_domain() in _HOST_DOMAINS:
+            self.add(stage, time.time() * 1000 - frame.get_timestamp())
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def tick(self):
+        ''' 1フレームごとに呼ぶ (export_sec ごとに書き出し) '''
+        self.frames += 1
+        now = time.perf_counter()
+        if now - self._t_export >= self.export_sec:
+            self.fps = self.frames / (now - self._t_export)
+            self.frames = 0
+            self._t_export = now
+            if self._exporting is None or not self._exporting.is_alive(): # 前の書き出しが終わっていなければ飛ばす
+                self._exporting = threading.Thread(target=self.export, args=(dict(self.gauges),), daemon=True)
+                self._exporting.start()
+
+    def summary(self):
+        ''' {stage: {p50, p95, p99, max, count, sum}} '''
+        out = {}
+        with self._lock:
+            snap = {k: (v[:min(self.counts[k], self.size)].copy(), self.counts[k], self.max[k], self.sums[k])
+                    for k, v in self.samples.items()}
+        for stage, (v, n, mx, total) in snap.items():
+            if not len(v): continue
+            p50, p95, p99 = np.percentile(v, (50, 95, 99))
+            out[stage] = {'p50': p50, 'p95': p95, 'p99': p99, 'max': float(v.max()), 'max_total': mx,
+                          'count': n, 'sum': total}
+        return out
+
+    def export(self, gauges=None):
+        summary = self.summary()
+        gauges = dict(self.gauges) if gauges is None else gauges
+        record = {'time': time.time(), 'fps': getattr(self, 'fps', None), 'stages': summary, 'gauges': gauges}
+        if self.jsonl:
+            with open(self.jsonl, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        if self.prom:
+            self._write_prom(summary, record['fps'], gauges)
+        return record
+
+    def _write_prom(self, summary, fps, gauges):
+        ''' Prometheus の textfile 形式 (node_exporter の textfile collector 用) '''
+        n = self.name
+        lines = [f'# TYPE {n}_stage_ms summary']
+        for stage, s in summary.items():
+            for q in ('p50', 'p95', 'p99'):
+                lines.append(f'{n}_stage_ms{{stage="{stage}",quantile="0.{q[1:]}"}} {s[q]:.4f}')
+            lines.append(f'{n}_stage_ms_sum{{stage="{stage}"}} {s["sum"]:.4f}')
+            lines.append(f'{n}_stage_ms_count{{stage="{stage}"}} {s["count"]}')
+            lines.append(f'{n}_stage_ms_max{{stage="{stage}"}} {s["max"]:.4f}')
+        if fps is not None:
+            lines.append(f'# TYPE {n}_fps gauge')
+            lines.append(f'{n}_fps {fps:.3f}')
+        for k, v in gauges.items():
+            lines.append(f'{n}_{k} {v}')
+        tmp = self.prom + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp, self.prom)
@@ -3,62 +3,197 @@
 import pyrealsense2 as rs
 import numpy as np
 import time
+import threading
 import matplotlib.pyplot as plt
 
-def initialize_camera():
-    # start the frames pipe
-    p = rs.pipeline()
-    conf = rs.config()
-    conf.enable_stream(rs.stream.accel)
-    conf.enable_stream(rs.stream.gyro)
-    prof = p.start(conf)
-    return p
-
-def gyro_data(gyro):
-    return np.asarray([gyro.x, gyro.y, gyro.z])
-
-def accel_data(accel):
-    return np.asarray([accel.x, accel.y, accel.z])
-
-p = initialize_camera()
-
-dt_start = time.perf_counter() # 処理開始時間
-dt = dt_start # 1回あたりの処理時間
-data_arr = [[0], [0], [0], [0], [0], [0], [0]] # 経過時間, x角度, y角度, z角度, x移動, y移動, z移動
-try:
-    while True:
-        f = p.wait_for_frames()
-        accel = accel_data(f[0].as_motion_frame().get_motion_data())
-        gyro = gyro_data(f[1].as_motion_frame().get_motion_data())
-        dt_n = time.perf_counter()
-        df = dt_n - dt
-        data_arr[0].append(dt_n-dt_start)   # 経過時間
-        data_arr[1].append(gyro[0]*df)      # x角度
-        data_arr[2].append(gyro[1]*df)      # y角度
-        data_arr[3].append(gyro[2]*df)      # z角度
-        data_arr[4].append(accel[0]*df)     # x移動
-        data_arr[5].append(accel[1]*df)     # y移動
-        data_arr[6].append(accel[2]*df)     # z移動
-        dt = dt_n
-        print("accelerometer: ", accel)
-        print("gyro: ", gyro)
-except Exception as e: print(e)
-finally:
-    p.stop()
-    # print(len(data_arr[0]))
-    # print(data_arr[0])
-
-    fig = plt.figure(figsize=(12, 6))
-    ax1 = fig.add_subplot(121)
-    ax1.plot(data_arr[0], data_arr[1], label="roll")
-    ax1.plot(data_arr[0], data_arr[2], label="pitch")
-    ax1.plot(data_arr[0], data_arr[3], label="yaw")
-    ax1.set_xlabel('t (s)')
-
-    ax2 = fig.add_subplot(122)
-    ax2.plot(data_arr[0], data_arr[4], label="x pos")
-    ax2.plot(data_arr[0], data_arr[5], label="y pos")
-    ax2.plot(data_arr[0], data_arr[6], label="z pos")
-    ax2.set_xlabel('t (s)')
-    plt.legend()
-    plt.show()
+SESSION_SEC = 3600  # 保持する長さ (s), これを超えると古いものから上書き
+MAX_RATE = 400      # 想定する最大サンプリング周波数 (Hz)
+PRINT_INTV = 1.0    # コンソール出力の間隔 (s)
+PLOT_INTV = 0.5     # グラフ更新の間隔 (s)
+PLOT_WINDOW = 30.0  # グラフに表示する直近の長さ (s)
+PLOT_POINTS = 2000  # グラフ1本あたりの最大点数 (間引き)
+
+class imu_ring():
+    ''' タイムスタンプ付き3軸データのリングバッファ (t[s], x, y, z) '''
+    def __init__(self, size):
+        self.size = size
+        self.buf = np.zeros((size, 4))
+        self.t = np.zeros(size)  # 時刻だけ連続した配列にも持つ (get の二分探索用)
+        self.n = 0  # これまでに書き込んだ数
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return min(self.n, self.size)
+
+    @property
+    def overwritten(self):
+        ''' 上書きで消えた数 '''
+        return max(0, self.n - self.size)
+
+    def push(self, t, x, y, z):
+        with self._lock:
+            k = self.n % self.size
+            self.buf[k] = (t, x, y, z)
+            self.t[k] = t
+            self.n += 1
+
+    def latest(self):
+        with self._lock:
+            return self.buf[(self.n - 1) % self.size].copy() if self.n else None
+
+    def get(self, t0=None, t1=None):
+        ''' 時刻順に並べた [t0, t1] のデータ (その範囲だけコピー) '''
+        with self._lock:
+            if self.n <= self.size:
+                parts = [slice(0, self.n)]
+            else: # 古い方 [i:] と新しい方 [:i] はそれぞれ時刻順
+                i = self.n % self.size
+                parts = [slice(i, self.size), slice(0, i)]
+            out = []
+            for p in parts:
+                t = self.t[p]
+                lo = 0 if t0 is None else np.searchsorted(t, t0)
+                hi = len(t) if t1 is None else np.searchsorted(t, t1, side='right')
+                if lo < hi:
+                    out.append(self.buf[p][lo:hi])
+            return np.concatenate(out) if out else np.zeros((0, 4))
+
+class imu_capture():
+    ''' 専用スレッドで accel/gyro を取り込む '''
+    def __init__(self, seconds=SESSION_SEC, rate=MAX_RATE):
+        self.accel = imu_ring(int(seconds * rate))
+        self.gyro = imu_ring(int(seconds * rate))
+        self.lost = {'accel': 0, 'gyro': 0} # フレーム番号の飛び
+        self._last_no = {}
+        self._stop = threading.Event()
+        self.error = None # 取り込みスレッドが止まった原因
+
+    def start(self):
+        self.pipeline = rs.pipeline()
+        conf = rs.config()
+        conf.enable_stream(rs.stream.accel)
+        conf.enable_stream(rs.stream.gyro)
+        self.queue = rs.frame_queue(1000)
+        self.pipeline.start(conf, self.queue)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.thread.join(timeout=2.0)
+        self.pipeline.stop()
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                ok, frame = self.queue.try_wait_for_frame(100)
+                if not ok: continue
+                if frame.is_frameset():
+                    fs = frame.as_frameset()
+                    frames = [fs[i] for i in range(fs.size())]
+                else:
+                    frames = [frame]
+                for f in frames:
+                    self._push(f)
+        except Exception as e:
+            self.error = e
+
+    def _push(self, f):
+        name = 'accel' if f.get_profile().stream_type() == rs.stream.accel else 'gyro'
+        no = f.get_frame_number()
+        last = self._last_no.get(name)
+        if last is not None:
+            if no <= last: return # 同じサンプルの重複
+            self.lost[name] += no - last - 1
+        self._last_no[name] = no
+        d = f.as_motion_frame().get_motion_data()
+        getattr(self, name).push(f.get_timestamp() / 1000, d.x, d.y, d.z) # フレームの時刻を使う
+
+def integrate(gyro, accel, gravity=True):
+    ''' 区間の積分 (台形則)
+        gyro  -> 角度 [rad] (roll, pitch, yaw)
+        accel -> 速度 [m/s], 位置 [m] (gravity=True なら最初の1秒の平均を重力として引く)
+    '''
+    out = {}
+    if len(gyro) > 1:
+        dt = np.diff(gyro[:, 0])[:, None]
+        angle = np.cumsum((gyro[1:, 1:] + gyro[:-1, 1:]) * 0.5 * dt, axis=0)
+        out['t_gyro'] = gyro[:, 0]
+        out['angle'] = np.vstack((np.zeros(3), angle))
+    if len(accel) > 1:
+        a = accel[:, 1:]
+        if gravity:
+            a = a - a[accel[:, 0] <= accel[0, 0] + 1.0].mean(axis=0)
+        dt = np.diff(accel[:, 0])[:, None]
+        vel = np.vstack((np.zeros(3), np.cumsum((a[1:] + a[:-1]) * 0.5 * dt, axis=0)))
+        pos = np.vstack((np.zeros(3), np.cumsum((vel[1:] + vel[:-1]) * 0.5 * dt, axis=0)))
+        out['t_accel'] = accel[:, 0]
+        out['velocity'] = vel
+        out['position'] = pos
+    return out
+
+def decimate(*arrs, points=PLOT_POINTS):
+    ''' 表示用に間引く '''
+    step = max(1, len(arrs[0]) // points)
+    return [a[::step] for a in arrs]
+
+class imu_plot():
+    ''' 直近 PLOT_WINDOW 秒の角度と位置を逐次描画 '''
+    def __init__(self):
+        plt.ion()
+        self.fig = plt.figure(figsize=(12, 6))
+        self.ax1 = self.fig.add_subplot(121)
+        self.ax2 = self.fig.add_subplot(122)
+        self.angle = [self.ax1.plot([], [], label=l)[0] for l in ('roll', 'pitch', 'yaw')]
+        self.pos = [self.ax2.plot([], [], label=l)[0] for l in ('x pos', 'y pos', 'z pos')]
+        for ax in (self.ax1, self.ax2):
+            ax.set_xlabel('t (s)')
+            ax.legend()
+
+    def update(self, data, t_start):
+        if 'angle' in data:
+            t, v = decimate(data['t_gyro'] - t_start, data['angle'])
+            for i, line in enumerate(self.angle): line.set_data(t, v[:, i])
+        if 'position' in data:
+            t, v = decimate(data['t_accel'] - t_start, data['position'])
+            for i, line in enumerate(self.pos): line.set_data(t, v[:, i])
+        for ax in (self.ax1, self.ax2):
+            ax.relim()
+            ax.autoscale_view()
+        self.fig.canvas.draw_idle()
+        plt.pause(0.001)
+
+def main():
+    cap = imu_capture()
+    cap.start()
+    plot = imu_plot()
+    t_print = t_plot = time.perf_counter()
+    t_start = None
+    try:
+        while True:
+            time.sleep(0.01)
+            if cap.error: raise cap.error
+            now = time.perf_counter()
+            acc, gyr = cap.accel.latest(), cap.gyro.latest()
+            if acc is None or gyr is None: continue
+            if t_start is None: t_start = min(acc[0], gyr[0])
+            if now - t_print >= PRINT_INTV:
+                t_print = now
+                print(f'accelerometer: {acc[1:]}, gyro: {gyr[1:]}, samples: {cap.accel.n}/{cap.gyro.n}, lost: {cap.lost}')
+            if now - t_plot >= PLOT_INTV:
+                t_plot = now
+                t1 = max(acc[0], gyr[0])
+                plot.update(integrate(cap.gyro.get(t1 - PLOT_WINDOW), cap.accel.get(t1 - PLOT_WINDOW)), t_start)
+    except KeyboardInterrupt:
+        pass
+    except Exception as e: print(e)
+    finally:
+        cap.stop()
+        # ----- セッション全体 (間引いて表示)
+        if t_start is not None:
+            plt.ioff()
+            plot.update(integrate(cap.gyro.get(), cap.accel.get()), t_start)
+            plt.show()
+
+if __name__ == '__main__':
+    main()
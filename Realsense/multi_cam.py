@@ -0,0 +1,258 @@
+'''
+    複数台のカメラの同時録画
+
+    カメラごとに別のスレッド (--process なら別プロセス) で pipeline を動かし, それぞれのファイルに書く
+    メインのスレッドはタイムスタンプなどのメタデータだけを受け取り, 許容差 (tolerance) 以内の
+    フレームを組にして, カメラ間のずれ (skew) とカメラごとの取りこぼしを集計する
+
+    <out_dir>/multi_YYYYmmdd_HHMMSS/
+        multi.json            カメラ, ファイル, 集計 (終了時に書く)
+        cam_<serial>.bag      (--fmt bag, librealsense の recorder が書く)
+        cam_<serial>/         (--fmt raw, raw_rec 形式, 深度は可逆圧縮)
+
+    タイムスタンプは global_time (ホストの時計に合わせたハードウェア時刻) で比べる
+    --sync でハードウェア同期 (1台目が master, 残りが slave, 同期ケーブルが必要) を設定する
+
+        py multi_cam.py list
+        py multi_cam.py rec <out_dir> [--sec 10] [--fmt bag|raw] [--size 848x480] [--fps 30] [--tol 5] [--process] [--sync]
+'''
+
+import os
+import sys
+import json
+import time
+import queue
+import argparse
+import datetime
+import threading
+import collections
+import multiprocessing as mp
+import numpy as np
+import pyrealsense2 as rs
+
+# ----- デバイス
+def list_devices():
+    ''' 接続されているカメラ [{serial, name, usb}] '''
+    out = []
+    for dev in rs.context().query_devices():
+        info = lambda k: dev.get_info(k) if dev.supports(k) else ''
+        out.append({
+            'serial': info(rs.camera_info.serial_number),
+            'name': info(rs.camera_info.name),
+            'usb': info(rs.camera_info.usb_type_descriptor),
+        })
+    return out
+
+def set_sync_mode(serial, mode):
+    ''' inter_cam_sync_mode (0: 無効, 1: master, 2: slave) '''
+    for dev in rs.context().query_devices():
+        if dev.get_info(rs.camera_info.serial_number) != serial: continue
+        for sensor in dev.query_sensors():
+            if sensor.is_depth_sensor() and sensor.supports(rs.option.inter_cam_sync_mode):
+                sensor.set_option(rs.option.inter_cam_sync_mode, mode)
+
+# ----- カメラ1台分 (スレッドでもプロセスでも動く)
+def camera_worker(serial, path, fmt, size, fps, meta_q, stop, queue_size=16):
+    ''' 録画しながら (serial, frame_no, timestamp[ms], 到着時刻) を meta_q に送る '''
+    config = rs.config()
+    config.enable_device(serial)
+    config.enable_stream(rs.stream.depth, *size, rs.format.z16, fps)
+    config.enable_stream(rs.stream.color, *size, rs.format.bgr8, fps)
+    if fmt == 'bag':
+        config.enable_record_to_file(path)
+    frames_q = rs.frame_queue(queue_size, keep_frames=True)
+    pipeline = rs.pipeline()
+    started = False
+    writer = codec = None
+    try: # 開始に失敗しても (使用中, USB の帯域不足) 終了の印は必ず送る
+        profile = pipeline.start(config, frames_q)
+        started = True
+        if fmt == 'raw':
+            from raw_rec import raw_writer, profile_streams, frameset_images
+            from depth_codec import frame_codec
+            codec = frame_codec('left', workers=2)
+            writer = raw_writer(path, profile_streams(profile), codec=codec, meta={'serial': serial})
+        while not stop.is_set():
+            ok, frame = frames_q.try_wait_for_frame(1000)
+            if not ok: continue
+            fs = frame.as_frameset()
+            if writer:
+                writer.write(fs.get_frame_number(), fs.get_timestamp(), frameset_images(fs))
+            domain = str(fs.get_frame_timestamp_domain()).split('.')[-1]
+            meta_q.put((serial, fs.get_frame_number(), fs.get_timestamp(), time.time() * 1000, domain))
+    finally:
+        try:
+            if started: pipeline.stop()
+            if writer: writer.close()
+            if codec: codec.close()
+        finally:
+            meta_q.put((serial, None, None, None, None)) # 終了
+
+# ----- 集計
+class cam_stats():
+    ''' カメラごとのフレーム数, 取りこぼし, 間隔 '''
+    def __init__(self, size=1024):
+        self.frames = 0
+        self.dropped = 0
+        self.last_no = None
+        self.last_ts = None
+        self.domain = None
+        self.intervals = np.zeros(size)
+        self.delays = np.zeros(size)    # タイムスタンプから受け取るまで [ms]
+        self._n = 0
+
+    def add(self, frame_no, ts, arrived, domain):
+        if self.last_no is not None:
+            self.dropped += max(0, frame_no - self.last_no - 1)
+            self.intervals[self._n % len(self.intervals)] = ts - self.last_ts
+            self._n += 1
+        self.delays[self.frames % len(self.delays)] = arrived - ts
+        self.last_no, self.last_ts, self.domain = frame_no, ts, domain
+        self.frames += 1
+
+    def summary(self):
+        iv = self.intervals[:min(self._n, len(self.intervals))]
+        dl = self.delays[:min(self.frames, len(self.delays))]
+        out = {'frames': self.frames, 'dropped': self.dropped, 'domain': self.domain}
+        if len(iv):
+            out.update(fps=1000 / max(float(np.median(iv)), 1e-9), interval_p95_ms=float(np.percentile(iv, 95)))
+        if len(dl) and self.domain in ('global_time', 'system_time'):
+            out['delay_p50_ms'] = float(np.median(dl))
+        return out
+
+class synchronizer():
+    ''' タイムスタンプが tol [ms] 以内のフレームを全カメラ分そろえる '''
+    def __init__(self, serials, tol=5.0, maxlen=64, on_set=None):
+        self.serials = list(serials)
+        self.tol = tol
+        self.on_set = on_set
+        self.pending = {s: collections.deque(maxlen=maxlen) for s in self.serials}
+        self.matched = 0
+        self.unmatched = collections.Counter()   # 組にならずに捨てたフレーム
+        self.skews = collections.deque(maxlen=4096)
+        self.pair_skews = {s: collections.deque(maxlen=4096) for s in self.serials[1:]} # 1台目との差
+
+    def add(self, serial, frame_no, ts):
+        q = self.pending[serial]
+        if len(q) == q.maxlen: # 他のカメラが止まっている: 押し出される一番古いフレームも数える
+            q.popleft()
+            self.unmatched[serial] += 1
+        q.append((ts, frame_no))
+        self._match()
+
+    def _match(self):
+        while all(self.pending.values()):
+            heads = {s: q[0][0] for s, q in self.pending.items()}
+            ref = max(heads.values())
+            stale = [s for s, ts in heads.items() if ts < ref - self.tol]
+            if stale: # 一番遅いカメラに対応するフレームがない
+                for s in stale:
+                    self.pending[s].popleft()
+                    self.unmatched[s] += 1
+                continue
+            fs = {s: self.pending[s].popleft() for s in self.serials}
+            ts = [fs[s][0] for s in self.serials]
+            self.skews.append(max(ts) - min(ts))
+            for s in self.serials[1:]:
+                self.pair_skews[s].append(fs[s][0] - fs[self.serials[0]][0])
+            self.matched += 1
+            if self.on_set: self.on_set(fs)
+
+    def summary(self):
+        out = {'matched': self.matched, 'unmatched': dict(self.unmatched), 'tolerance_ms': self.tol}
+        if self.skews:
+            sk = np.array(self.skews)
+            out['skew_ms'] = {'p50': float(np.median(sk)), 'p95': float(np.percentile(sk, 95)), 'max': float(sk.max())}
+        out['offset_ms'] = {s: float(np.median(v)) for s, v in self.pair_skews.items() if v}
+        return out
+
+# ----- セッション
+def write_json(path, data):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp, path)
+
+def record(out_dir, sec=10, fmt='bag', size=(848, 480), fps=30, tol=5.0, use_process=False, sync=False, report_sec=5, serials=None):
+    ''' 全カメラを同時に録画してセッションのディレクトリを返す '''
+    devices = list_devices()
+    if serials: devices = [d for d in devices if d['serial'] in serials]
+    if not devices: raise RuntimeError('no device')
+    session = os.path.join(out_dir, 'multi_' + datetime.datetime.now().strftime('%Y%m%d_%H%M%S'))
+    os.makedirs(session, exist_ok=True)
+    if sync and len(devices) > 1:
+        for i, d in enumerate(devices):
+            set_sync_mode(d['serial'], 1 if i == 0 else 2)
+
+    files = {d['serial']: f'cam_{d["serial"]}' + ('.bag' if fmt == 'bag' else '') for d in devices}
+    if use_process:
+        ctx = mp.get_context('spawn')
+        meta_q, stop, Worker = ctx.Queue(), ctx.Event(), ctx.Process
+    else:
+        meta_q, stop, Worker = queue.Queue(), threading.Event(), threading.Thread
+    workers = [Worker(target=camera_worker, args=(d['serial'], os.path.join(session, files[d['serial']]), fmt, size, fps, meta_q, stop), daemon=True)
+               for d in devices]
+    stats = {d['serial']: cam_stats() for d in devices}
+    sync_ = synchronizer(stats, tol)
+    for w in workers: w.start()
+    print(f'{len(devices)} cameras -> {session}')
+
+    t0 = time.time()
+    t_report = t0 + report_sec
+    running = len(workers)
+    try:
+        while running:
+            if time.time() - t0 >= sec: stop.set()
+            try:
+                serial, frame_no, ts, arrived, domain = meta_q.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if frame_no is None:
+                running -= 1
+                continue
+            stats[serial].add(frame_no, ts, arrived, domain)
+            sync_.add(serial, frame_no, ts)
+            if time.time() >= t_report:
+                t_report += report_sec
+                report(stats, sync_)
+    except KeyboardInterrupt:
+        stop.set()
+    finally:
+        stop.set()
+        for w in workers: w.join(timeout=10)
+    report(stats, sync_)
+    write_json(os.path.join(session, 'multi.json'), {
+        'start': t0, 'sec': time.time() - t0, 'format': fmt, 'size': list(size), 'fps': fps,
+        'hw_sync': bool(sync), 'process': bool(use_process),
+        'cameras': [dict(d, file=files[d['serial']], **stats[d['serial']].summary()) for d in devices],
+        'sync': sync_.summary(),
+    })
+    return session
+
+def report(stats, sync_):
+    for serial, st in stats.items():
+        s = st.summary()
+        print(f'  {serial}: {s["frames"]} frames, dropped {s["dropped"]}, {s.get("fps", 0):.1f} fps, unmatched {sync_.unmatched[serial]}')
+    sk = sync_.summary().get('skew_ms')
+    if sk:
+        print(f'  sets {sync_.matched}, skew p50 {sk["p50"]:.2f} ms, p95 {sk["p95"]:.2f} ms, max {sk["max"]:.2f} ms')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='複数台のカメラの同時録画')
+    parser.add_argument('cmd', choices=('list', 'rec'))
+    parser.add_argument('out_dir', nargs='?', default='.')
+    parser.add_argument('--sec', type=float, default=10)
+    parser.add_argument('--fmt', default='bag', choices=('bag', 'raw'))
+    parser.add_argument('--size', default='848x480')
+    parser.add_argument('--fps', type=int, default=30)
+    parser.add_argument('--tol', type=float, default=5.0, help='組にするタイムスタンプの許容差 [ms]')
+    parser.add_argument('--process', action='store_true', help='カメラごとに別プロセスで動かす')
+    parser.add_argument('--sync', action='store_true', help='ハードウェア同期 (1台目 master)')
+    parser.add_argument('--serial', nargs='*', help='使うカメラ (省略で全部)')
+    args = parser.parse_args()
+    if args.cmd == 'list':
+        for d in list_devices():
+            print(f'{d["serial"]}  {d["name"]}  USB {d["usb"]}')
+        sys.exit()
+    w, h = map(int, args.size.split('x'))
+    record(args.out_dir, args.sec, args.fmt, (w, h), args.fps, args.tol, args.process, args.sync, serials=args.serial)
@@ -0,0 +1,239 @@
+'''
+    深度画像をカラー画像の画角に合わせる (rs.align(rs.stream.color) の numpy 版)
+
+        aligner = depth_aligner.from_frames(depth_frame, color_frame)   # ライブ / 再生中のフレームから
+        aligner = depth_aligner.from_streams(reader.streams)             # raw_rec の meta.json から
+        aligned = aligner.process(depth)                                 # (カラーの H, W) uint16
+
+    内部パラメータ, 外部パラメータ, 解像度だけで決まる部分 (画素の角の視線ベクトルを回転したもの) は
+    深度の解像度ごとに1度だけ計算し, 毎フレームは深度を掛けて投影する部分だけを行う
+    重なった画素は近い方を残す (rs.align と同じく画素の角を投影した矩形を埋める)
+
+    ステートを持たない (出力バッファ以外) のでスレッドごとに作るか, プロセスに渡して使える
+
+        py np_align.py check <in.bag> [-n 100]   rs.align との比較 (一致率と処理時間)
+        py np_align.py bench
+'''
+
+import time
+import argparse
+import numpy as np
+try:
+    import pyrealsense2 as rs
+except ImportError:
+    rs = None
+from raw_rec import intrinsics_dict, extrinsics_dict
+from point_cloud import ray_table
+
+def scale_intrinsics(d, shape):
+    ''' 間引きなどで解像度が変わった時の内部パラメータ '''
+    h, w = shape
+    if (w, h) == (d['width'], d['height']):
+        return d
+    sx, sy = w / d['width'], h / d['height']
+    return dict(d, width=w, height=h, ppx=d['ppx']*sx, ppy=d['ppy']*sy, fx=d['fx']*sx, fy=d['fy']*sy)
+
+def distort(x, y, model, coeffs):
+    ''' 正規化座標 -> 歪みを加えた座標 (rs2_project_point_to_pixel と同じ計算) '''
+    c = coeffs
+    if model not in ('brown_conrady', 'modified_brown_conrady') or not any(c):
+        return x, y
+    r2 = x*x + y*y
+    f = 1 + c[0]*r2 + c[1]*r2*r2 + c[4]*r2*r2*r2
+    xf, yf = x*f, y*f
+    if model == 'modified_brown_conrady':
+        x, y = xf, yf
+    dx = xf + 2*c[2]*x*y + c[3]*(r2 + 2*x*x)
+    dy = yf + 2*c[3]*x*y + c[2]*(r2 + 2*y*y)
+    return dx, dy
+
+class depth_aligner():
+    ''' 深度 -> カラー画像の画素への再投影 (z バッファ付き) '''
+    def __init__(self, depth_intr, color_intr, extrinsics, depth_scale=0.001):
+        self.depth_intr = depth_intr if isinstance(depth_intr, dict) else intrinsics_dict(depth_intr)
+        self.color_intr = color_intr if isinstance(color_intr, dict) else intrinsics_dict(color_intr)
+        ext = extrinsics if isinstance(extrinsics, dict) else extrinsics_dict(extrinsics)
+        self.rotation = np.array(ext['rotation'], np.float64).reshape(3, 3).T # 列優先
+        self.translation = np.array(ext['translation'], np.float64)
+        self.depth_scale = depth_scale
+        self.shape = (self.color_intr['height'], self.color_intr['width'])
+        self._tables = {}   # 深度の形状 -> 角ごとの (x, y, z) 係数
+        self._out = None
+
+    @classmethod
+    def from_frames(cls, depth_frame, color_frame):
+        dp = depth_frame.get_profile().as_video_stream_profile()
+        cp = color_frame.get_profile().as_video_stream_profile()
+        return cls(dp.get_intrinsics(), cp.get_intrinsics(), dp.get_extrinsics_to(cp), depth_frame.get_units())
+
+    @classmethod
+    def from_streams(cls, streams):
+        ''' profile_streams() / meta.json の streams から '''
+        d, c = streams['depth'], streams['color']
+        return cls(d['intrinsics'], c['intrinsics'], d['extrinsics_to_color'], d.get('depth_scale', 0.001))
+
+    def __getstate__(self):
+        # テーブルは大きいので渡した先で作り直す
+        state = dict(self.__dict__)
+        state['_tables'] = {}
+        state['_out'] = None
+        return state
+
+    def table(self, shape):
+        ''' 画素の左上と右下の角について, 深度 (z16) に掛けるとカラーカメラ座標になる係数 '''
+        tab = self._tables.get(shape)
+        if tab is None:
+            intr = scale_intrinsics(self.depth_intr, shape)
+            tab = []
+            for offset in (-0.5, 0.5):
+                rays = ray_table(intr, self.depth_scale, offset) @ self.rotation.T.astype(np.float32)
+                tab.append(tuple(np.ascontiguousarray(rays[:, k]) for k in range(3)))
+            tab = self._tables[shape] = tuple(tab)
+        return tab
+
+    def _project(self, coef, z, idx):
+        ''' 角の座標をカラー画像の画素番号 (int) に '''
+        ci = self.color_intr
+        t = self.translation.tolist() # float32 のまま計算する (np.float64 を掛けると倍精度になる)
+        x = coef[0].take(idx); x *= z; x += t[0]
+        y = coef[1].take(idx); y *= z; y += t[1]
+        iw = coef[2].take(idx); iw *= z; iw += t[2]
+        np.reciprocal(iw, out=iw)
+        x *= iw
+        y *= iw
+        x, y = distort(x, y, ci['model'], ci['coeffs'])
+        x *= ci['fx']; x += ci['ppx'] + 0.5 # rs と同じく +0.5 して切り捨て
+        y *= ci['fy']; y += ci['ppy'] + 0.5
+        px = x.astype(np.int32)
+        py = y.astype(np.int32)
+        return px, py
+
+    def process(self, depth, out=None):
+        ''' 深度画像 (H, W) uint16 -> カラー画像の形状の深度画像 (out を省略すると内部バッファ) '''
+        h, w = self.shape
+        if self._out is None:
+            self._out = np.empty(h * w + 1, np.uint16) # 最後の1つは矩形の外を捨てる場所
+        flat = self._out
+        flat.fill(0xffff)
+        tl, br = self.table(depth.shape)
+        d = depth.reshape(-1)
+        idx = np.flatnonzero(d)
+        z16 = d.take(idx)
+        z = z16.astype(np.float32)
+        x0, y0 = self._project(tl, z, idx)
+        x1, y1 = self._project(br, z, idx)
+        # rs.align と同じく, 矩形がはみ出す画素は捨てる
+        ok = (x0 >= 0) & (y0 >= 0) & (x1 < w) & (y1 < h) & (x0 <= x1) & (y0 <= y1)
+        if not ok.all():
+            x0, y0, x1, y1, z16 = x0[ok], y0[ok], x1[ok], y1[ok], z16[ok]
+        sx, sy = x1 - x0, y1 - y0
+        base = y0 * w + x0
+        np.minimum.at(flat, base, z16)
+        trash = h * w
+        for dy in range(int(sy.max(initial=0)) + 1):
+            for dx in range(int(sx.max(initial=0)) + 1):
+                if dx == 0 and dy == 0: continue
+                # 矩形に入らない画素は捨てる場所へ (bool の添字で詰めるより速い)
+                target = np.where((dx <= sx) & (dy <= sy), base + (dy * w + dx), trash)
+                np.minimum.at(flat, target, z16)
+        flat[flat == 0xffff] = 0
+        aligned = flat[:trash].reshape(h, w)
+        if out is None:
+            return aligned
+        np.copyto(out, aligned)
+        return out
+
+    __call__ = process
+
+# ----- rs.align との比較
+def _stats(name, t):
+    t = np.array(t)
+    return f'{name:10s} p50 {np.median(t):7.2f} ms  p95 {np.percentile(t, 95):7.2f} ms'
+
+def check(bag, n=100, tol=0):
+    ''' 録画した .bag で rs.align の結果と比べる '''
+    from raw_rec import open_bag
+    pipeline, profile = open_bag(bag)
+    align = rs.align(rs.stream.color)
+    aligner = None
+    t_rs, t_np = [], []
+    agree = both = ref_valid = np_valid = 0
+    abs_err = 0.0
+    try:
+        for _ in range(n):
+            ok, frames = pipeline.try_wait_for_frames(1000)
+            if not ok: break
+            frames.keep()
+            depth_frame, color_frame = frames.get_depth_frame(), frames.get_color_frame()
+            if not depth_frame or not color_frame: continue
+            if aligner is None:
+                aligner = depth_aligner.from_frames(depth_frame, color_frame)
+            depth = np.asanyarray(depth_frame.get_data())
+
+            start = time.perf_counter()
+            ref = np.asanyarray(align.process(frames).get_depth_frame().get_data())
+            t_rs.append((time.perf_counter() - start) * 1000)
+            start = time.perf_counter()
+            out = aligner.process(depth)
+            t_np.append((time.perf_counter() - start) * 1000)
+
+            rv, nv = ref > 0, out > 0
+            b = rv & nv
+            diff = np.abs(ref[b].astype(np.int32) - out[b])
+            ref_valid += int(rv.sum())
+            np_valid += int(nv.sum())
+            both += int(b.sum())
+            agree += int((diff <= tol).sum())
+            abs_err += float(diff.sum())
+    finally:
+        pipeline.stop()
+    if not t_rs:
+        print('no frames')
+        return None
+    scale = aligner.depth_scale * 1000
+    result = {
+        'frames': len(t_rs),
+        'coverage': np_valid / max(ref_valid, 1),                 # 有効画素数の比
+        'overlap': both / max(ref_valid + np_valid - both, 1),    # 有効画素の IoU
+        'agree': agree / max(both, 1),                           # 両方有効な画素で値が一致する割合
+        'mae_mm': abs_err / max(both, 1) * scale,
+        'rs_ms': float(np.median(t_rs)),
+        'np_ms': float(np.median(t_np)),
+    }
+    print(f'{result["frames"]} frames, coverage {result["coverage"]:.4f}, overlap {result["overlap"]:.4f}, '
+          f'agree {result["agree"]:.4f}, MAE {result["mae_mm"]:.3f} mm')
+    print(_stats('rs.align', t_rs))
+    print(_stats('np_align', t_np))
+    return result
+
+def bench(repeat=50):
+    ''' 合成データでの処理時間 (D435 程度のパラメータ) '''
+    from np_filter import synthetic_depth
+    def intr(w, h, f):
+        return {'width': w, 'height': h, 'ppx': w/2, 'ppy': h/2, 'fx': f, 'fy': f, 'model': 'brown_conrady', 'coeffs': [0.0]*5}
+    ext = {'rotation': [1, 0, 0, 0, 1, 0, 0, 0, 1], 'translation': [0.015, 0, 0]}
+    for (dw, dh), (cw, ch) in [((640, 480), (640, 480)), ((848, 480), (1280, 720)), ((1280, 720), (1280, 720))]:
+        aligner = depth_aligner(intr(dw, dh, 0.53*dw), intr(cw, ch, 0.73*cw), ext)
+        depth = synthetic_depth(dw, dh)
+        start = time.perf_counter()
+        aligner.process(depth)
+        first = (time.perf_counter() - start) * 1000
+        t = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            aligner.process(depth)
+            t.append((time.perf_counter() - start) * 1000)
+        print(f'{dw}x{dh} -> {cw}x{ch}: first {first:6.1f} ms, {_stats("", t)}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='深度 -> カラーの位置合わせ')
+    parser.add_argument('cmd', choices=('check', 'bench'))
+    parser.add_argument('bag', nargs='?')
+    parser.add_argument('-n', type=int, default=100, help='比較するフレーム数')
+    parser.add_argument('--tol', type=int, default=0, help='一致とみなす差 (z16 の値)')
+    args = parser.parse_args()
+    if args.cmd == 'check':
+        if not args.bag: parser.error('check には .bag が必要')
+        check(args.bag, args.n, args.tol)
+    else:
+        bench()
@@ -0,0 +1,276 @@
+'''
+    numpy だけで動く深度後処理フィルタ (rs_filter.rs_filter_chain と同じ構成)
+
+    decimation -> disparity -> spatial -> depth -> hole filling
+    pyrealsense2 がないサーバーでも保存済みの深度を処理できる
+
+    spatial filter は librealsense と同じ再帰型のエッジ保存平滑化
+    (走査の向きには逐次, 直交方向にはベクトル化) で, 穴埋めの mode 1, 2 は
+    上下左右の近傍から選ぶ近似なので librealsense と完全には一致しない
+    -> compare で差を確認すること
+
+    再帰型なので走査の向きの Python ループは残り, 1280x720 で 60 ms/フレーム程度かかる
+    保存済みデータの処理 (オフライン, filter_frames で並列化) 用で, live の既定は rs_filter のまま
+
+    py np_filter.py bench [幅 高さ]                    合成データで速度計測
+    py np_filter.py make_ref <in.bag> <out_dir> [N]   rs のフィルタ結果を基準として保存 (要 pyrealsense2)
+    py np_filter.py compare <out_dir>                  基準との比較
+'''
+
+import os
+import sys
+import time
+import json
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+D400_BASELINE = 0.05 # D435 の基線長 (m)
+
+def disparity_factor(fx, depth_scale=0.001, baseline=D400_BASELINE):
+    ''' 深度 <-> 視差 (1/32 画素) の変換係数 '''
+    return 32.0 * fx * baseline / depth_scale
+
+class np_filter_chain():
+    ''' 深度配列用フィルタチェーン (バッファは大きさごとに確保して使い回す) '''
+    def __init__(self, decimate=1, spatial=1, smooth_alpha=0.25, smooth_delta=50, hole_filling=1, d_factor=None):
+        self.decimate = decimate
+        self.spatial = spatial
+        self.alpha = smooth_alpha
+        self.delta = smooth_delta
+        self.hole_filling = hole_filling
+        self.d_factor = d_factor or disparity_factor(640.0)
+        self._bufs = {}
+
+    def process(self, depth, out=None):
+        ''' z16 の深度配列 -> フィルタ後の z16 '''
+        d = self._decimate(depth)
+        disp = self._buf('disp', d.shape, np.float32)
+        self._to_disparity(d, disp)
+        for _ in range(self.spatial):
+            t = self._buf('disp_t', disp.shape[::-1], np.float32)
+            np.copyto(t, disp.T)        # 横方向 (転置して各列を連続したメモリにする)
+            self._recursive(t)
+            np.copyto(disp, t.T)
+            self._recursive(disp)       # 縦方向
+        if out is None:
+            out = np.empty(d.shape, np.uint16)
+        self._to_depth(disp, out)
+        self._fill_holes(out)
+        return out
+
+    __call__ = process
+
+    def _buf(self, name, shape, dtype):
+        key = (name, shape, np.dtype(dtype).str)
+        buf = self._bufs.get(key)
+        if buf is None:
+            buf = self._bufs[key] = np.empty(shape, dtype)
+        return buf
+
+    # ----- decimation (2,3: 有効画素の中央値, 4以上: 有効画素の平均)
+    def _decimate(self, depth):
+        m = self.decimate
+        if m <= 1: return depth
+        h, w = depth.shape[0] // m, depth.shape[1] // m
+        blocks = depth[:h*m, :w*m].reshape(h, m, w, m).transpose(0, 2, 1, 3).reshape(h, w, m*m)
+        if m >= 4:
+            valid = np.count_nonzero(blocks, axis=2)
+            total = blocks.sum(axis=2, dtype=np.uint32)
+            out = self._buf('dec', (h, w), np.uint16)
+            np.floor_divide(total, np.maximum(valid, 1), out=out, casting='unsafe')
+            return out
+        s = np.sort(blocks, axis=2) # 0 (無効) が前に集まる
+        valid = np.count_nonzero(s, axis=2)
+        mid = (m*m - valid) + np.maximum(valid - 1, 0) // 2
+        return np.take_along_axis(s, mid[..., None], axis=2)[..., 0]
+
+    # ----- disparity <-> depth
+    def _to_disparity(self, depth, disp):
+        np.copyto(disp, depth, casting='unsafe')
+        with np.errstate(divide='ignore'):
+            np.divide(self.d_factor, disp, out=disp, where=disp > 0)
+
+    def _to_depth(self, disp, out):
+        tmp = self._buf('inv', disp.shape, np.float32)
+        tmp.fill(0)
+        np.divide(self.d_factor, disp, out=tmp, where=disp > 0)
+        np.add(tmp, 0.5, out=tmp, where=disp > 0)
+        np.minimum(tmp, 65535, out=tmp)
+        np.copyto(out, tmp, casting='unsafe')
+
+    # ----- spatial (上下に1往復, 各行は全列を同時に処理)
+    def _recursive(self, img):
+        a, delta = self.alpha, self.delta
+        n, w = img.shape
+        valid = self._buf('valid', img.shape, bool)
+        np.greater(img, 0, out=valid) # 平滑化しても正のままなので最初に1度だけ
+        prev = self._buf(f'prev{w}', (w,), np.float32)
+        diff = self._buf(f'diff{w}', (w,), np.float32)
+        ad = self._buf(f'ad{w}', (w,), np.float32)
+        mask = self._buf(f'mask{w}', (w,), bool)
+        for rows in (range(n), range(n-1, -1, -1)):
+            prev.fill(-1e30) # 有効値がまだ無い (差が delta より大きいので平滑化しない)
+            for u in rows:
+                cur, ok = img[u], valid[u]
+                np.subtract(prev, cur, out=diff)
+                np.abs(diff, out=ad)
+                np.less(ad, delta, out=mask)
+                mask &= ok
+                # cur = a*cur + (1-a)*prev
+                diff *= (1 - a)
+                np.add(cur, diff, out=cur, where=mask)
+                np.copyto(prev, cur, where=ok) # 直前の有効値を持ち越す
+
+    # ----- hole filling
+    def _fill_holes(self, d):
+        holes = d == 0
+        if not holes.any(): return
+        if self.hole_filling == 0:     # fill_from_left
+            idx = np.where(holes, 0, np.arange(d.shape[1]))
+            np.maximum.accumulate(idx, axis=1, out=idx)
+            np.copyto(d, np.take_along_axis(d, idx, axis=1), where=holes)
+            return
+        # 1: farest_from_around, 2: nearest_from_around (上下左右の有効値から選ぶ)
+        cand = self._buf('cand', (4, *d.shape), np.uint16)
+        cand.fill(0)
+        cand[0, :, 1:] = d[:, :-1]
+        cand[1, :, :-1] = d[:, 1:]
+        cand[2, 1:, :] = d[:-1, :]
+        cand[3, :-1, :] = d[1:, :]
+        if self.hole_filling == 1:
+            fill = cand.max(axis=0)
+        else:
+            cand[cand == 0] = 65535
+            fill = cand.min(axis=0)
+            fill[fill == 65535] = 0
+        np.copyto(d, fill, where=holes)
+
+# ----- 並列処理
+_worker_chain = None
+
+def _init_worker(params):
+    global _worker_chain
+    _worker_chain = np_filter_chain(**params)
+
+def _work(depth):
+    return _worker_chain.process(depth)
+
+def filter_frames(frames, workers=None, **params):
+    ''' 複数フレームをプロセスプールで処理 (順序は保たれる) '''
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(params,)) as pool:
+        return list(pool.map(_work, frames, chunksize=4))
+
+def filter_tiles(depth, workers=None, tiles=4, overlap=16, **params):
+    ''' 1フレームを横長の帯に分けてプロセスプールで処理
+
+        縦方向の平滑化は帯をまたぐので overlap 行ずつ重ねて計算し, 重なりは捨てる
+    '''
+    m = max(params.get('decimate', 1), 1)
+    h = depth.shape[0] // m * m
+    step = -(-h // tiles // m) * m
+    overlap = -(-overlap // m) * m
+    bands, crops = [], []
+    for y0 in range(0, h, step):
+        y1 = min(y0 + step, h)
+        a, b = max(y0 - overlap, 0), min(y1 + overlap, h)
+        bands.append(depth[a:b])
+        crops.append(((y0 - a) // m, (y1 - a) // m))
+    parts = filter_frames(bands, workers, **params)
+    return np.vstack([p[c0:c1] for p, (c0, c1) in zip(parts, crops)])
+
+# ----- 速度計測・精度比較
+def synthetic_depth(w=1280, h=720, seed=0):
+    ''' 平面 + 球 + ノイズ + 穴 の合成深度 '''
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:h, 0:w]
+    d = 1500 + 0.5 * x + 0.3 * y
+    r2 = (x - w/2)**2 + (y - h/2)**2
+    d = np.where(r2 < (h/4)**2, d - 600 + np.sqrt(np.maximum((h/4)**2 - r2, 0)), d)
+    d += rng.normal(0, 8, d.shape)
+    d[rng.random(d.shape) < 0.03] = 0
+    return np.clip(d, 0, 65535).astype(np.uint16)
+
+def bench(w=1280, h=720, n=10, **params):
+    depth = synthetic_depth(w, h)
+    chain = np_filter_chain(**params)
+    chain.process(depth) # バッファ確保
+    t = []
+    for _ in range(n):
+        s = time.perf_counter()
+        chain.process(depth)
+        t.append(time.perf_counter() - s)
+    t = np.array(t) * 1000
+    print(f'{w}x{h} single: mean {t.mean():.1f} ms, min {t.min():.1f} ms')
+    frames = [depth] * (n * 4)
+    s = time.perf_counter()
+    filter_frames(frames, **params)
+    sec = time.perf_counter() - s
+    print(f'{w}x{h} pool  : {len(frames)/sec:.1f} fps ({os.cpu_count()} cpu)')
+
+def make_ref(bag, out_dir, n=100):
+    ''' bag の深度と rs フィルタの結果を保存 (比較の基準) '''
+    import pyrealsense2 as rs
+    from main import Settings
+    from raw_rec import raw_writer, open_bag, stream_info
+    settings = Settings()
+    filters = settings.make_filters()
+    pipeline, profile = open_bag(bag)
+    sensor = profile.get_device().first_depth_sensor()
+    baseline = D400_BASELINE
+    if sensor.supports(rs.option.stereo_baseline):
+        baseline = sensor.get_option(rs.option.stereo_baseline) / 1000
+    raw = ref = None
+    try:
+        for _ in range(n):
+            ok, frames = pipeline.try_wait_for_frames(1000)
+            if not ok: break
+            depth_frame = frames.get_depth_frame()
+            filtered = filters.process(depth_frame)
+            d, f = np.asanyarray(depth_frame.get_data()), np.asanyarray(filtered.get_data())
+            if raw is None:
+                info = stream_info(depth_frame.get_profile(), depth_frame.get_units())
+                params = {
+                    'decimate': settings.DECIMATE_MAGNITUDE, 'spatial': settings.SPATIAL_MAGNITUDE,
+                    'smooth_alpha': settings.SMOOTH_ALPHA, 'smooth_delta': settings.SMOOTH_DELTA,
+                    'hole_filling': settings.HOLE_FILLING,
+                    'd_factor': disparity_factor(info['intrinsics']['fx'], info['depth_scale'], baseline),
+                }
+                raw = raw_writer(os.path.join(out_dir, 'raw'), {'depth': info}, meta={'params': params})
+                ref = raw_writer(os.path.join(out_dir, 'ref'), {'depth': dict(info, shape=list(f.shape))})
+            raw.write(frames.get_frame_number(), frames.get_timestamp(), {'depth': d})
+            ref.write(frames.get_frame_number(), frames.get_timestamp(), {'depth': f})
+    finally:
+        pipeline.stop()
+        if raw: raw.close(); ref.close()
+
+def compare(ref_dir):
+    ''' 基準 (rs) との差 '''
+    from raw_rec import raw_reader
+    raw, ref = raw_reader(os.path.join(ref_dir, 'raw')), raw_reader(os.path.join(ref_dir, 'ref'))
+    params = raw.meta['params']
+    print(json.dumps(params))
+    chain = np_filter_chain(**params)
+    err, within, valid_agree, t = [], [], [], []
+    for a, b in zip(raw, ref):
+        s = time.perf_counter()
+        out = chain.process(a['depth'])
+        t.append(time.perf_counter() - s)
+        r = b['depth'].astype(np.int32)
+        both = (out > 0) & (r > 0)
+        diff = np.abs(out.astype(np.int32) - r)[both]
+        err.append(diff.mean() if diff.size else 0)
+        within.append((diff <= np.maximum(r[both] * 0.01, 1)).mean() if diff.size else 1)
+        valid_agree.append(((out > 0) == (r > 0)).mean())
+    print(f'{len(t)} frames: MAE {np.mean(err):.2f} units, within 1% {np.mean(within)*100:.1f} %, '
+          f'valid mask agree {np.mean(valid_agree)*100:.1f} %, {np.mean(t)*1000:.1f} ms/frame')
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 2 and sys.argv[1] == 'bench':
+        w, h = (int(sys.argv[2]), int(sys.argv[3])) if len(sys.argv) >= 4 else (1280, 720)
+        bench(w, h)
+    elif len(sys.argv) >= 4 and sys.argv[1] == 'make_ref':
+        make_ref(sys.argv[2], sys.argv[3], int(sys.argv[4]) if len(sys.argv) >= 5 else 100)
+    elif len(sys.argv) == 3 and sys.argv[1] == 'compare':
+        compare(sys.argv[2])
+    else:
+        print(f'----- option -----\nbench   : py np_filter.py bench [w h]\nmake_ref: py np_filter.py make_ref <in.bag> <out_dir> [N]\ncompare : py np_filter.py compare <out_dir>')
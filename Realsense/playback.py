@@ -0,0 +1,276 @@
+'''
+    シーク・倍速対応の .bag 再生
+
+    初回に bag を最速で読んでフレーム位置の索引を作り <bag>.index.npz に保存する
+    (bag のサイズと更新時刻が変わったら作り直す)
+    分割録画のセッション (segment.py) は session_player で1本として再生する
+    raw 形式のセグメントは初回に <セグメント>.bag へ変換してキャッシュする (segment_bag)
+
+    キー操作 (main.py play):
+        space: 一時停止/再開,  n: コマ送り,  a/d: 5秒戻る/進む
+
+    速度計測:
+        py playback.py <file.bag|session>  最速で読み切って FPS を表示
+        py playback.py <file.bag> 2.0      2倍速
+'''
+
+import os
+import sys
+import time
+import datetime
+import numpy as np
+import pyrealsense2 as rs
+from segment import is_session, segments, segment_files
+from raw_rec import raw_to_bag
+
+INDEX_DTYPE = np.dtype([('position', '<i8'), ('frame_no', '<i8'), ('timestamp', '<f8')])
+
+def index_path(bag):
+    return f'{bag}.index.npz'
+
+def build_index(bag):
+    ''' bag を最速で読んで (再生位置[ns], フレーム番号, タイムスタンプ[ms]) を集める '''
+    config = rs.config()
+    config.enable_device_from_file(bag, repeat_playback=False)
+    pipeline = rs.pipeline()
+    profile = pipeline.start(config)
+    playback = profile.get_device().as_playback()
+    playback.set_real_time(False)
+    rows = []
+    try:
+        while True:
+            ok, frames = pipeline.try_wait_for_frames(1000)
+            if not ok: break
+            rows.append((playback.get_position(), frames.get_frame_number(), frames.get_timestamp()))
+    finally:
+        pipeline.stop()
+    return np.array(rows, INDEX_DTYPE)
+
+def load_index(bag):
+    ''' 索引を読み込む (なければ作ってキャッシュ) '''
+    st = os.stat(bag)
+    key = np.array([st.st_size, int(st.st_mtime)], np.int64)
+    p = index_path(bag)
+    if os.path.exists(p):
+        try:
+            with np.load(p) as z:
+                if np.array_equal(z['key'], key):
+                    return z['index']
+        except (OSError, KeyError, ValueError):
+            pass
+    index = build_index(bag)
+    try:
+        np.savez(p, key=key, index=index)
+    except OSError as e:
+        print(f'index not cached: {e}')
+    return index
+
+def segment_bag(seg):
+    ''' セグメント -> 再生できる bag (raw 形式のディレクトリは変換して <seg>.bag に置く) '''
+    if not os.path.isdir(seg): return seg
+    bag = os.path.normpath(seg) + '.bag'
+    src = os.path.getmtime(os.path.join(seg, 'index.bin'))
+    if not os.path.exists(bag) or os.path.getmtime(bag) < src:
+        tmp = os.path.normpath(seg) + '.part.bag'
+        print(f'convert: {seg} -> {bag}')
+        raw_to_bag(seg, tmp)
+        os.replace(tmp, bag)
+    return bag
+
+class _player_keys():
+    ''' 再生中のキー操作 '''
+    def key(self, key):
+        if key == ord(' '):
+            self.resume() if self.paused else self.pause()
+        elif key == ord('n'):
+            self.step()
+        elif key == ord('d'):
+            self.seek_time(self.position() + 5)
+        elif key == ord('a'):
+            self.seek_time(self.position() - 5)
+
+class bag_player(_player_keys):
+    ''' シーク・コマ送り・倍速・最速モードを持つ再生器
+
+        pipeline と同じ wait_for_frames() / stop() を持つので main.py の表示ループにそのまま渡せる
+        realtime=False で再生待ちをなくす (バッチ処理用)
+    '''
+    def __init__(self, bag, rate=1.0, realtime=True, repeat=True, start=0.0, index=True):
+        self.bag = bag
+        self.index = load_index(bag) if index else np.zeros(0, INDEX_DTYPE)
+        self.config = rs.config()
+        self.config.enable_device_from_file(bag, repeat_playback=repeat)
+        self.pipeline = rs.pipeline()
+        self.profile = self.pipeline.start(self.config)
+        self.playback = self.profile.get_device().as_playback()
+        self.set_rate(rate, realtime)
+        self.paused = False
+        self._step = False
+        self._last = None
+        self.frames = 0
+        self._t0 = time.perf_counter()
+        if start: self.seek_time(start)
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def duration(self):
+        ''' 長さ [s] '''
+        return self.playback.get_duration().total_seconds()
+
+    def set_rate(self, rate=1.0, realtime=True):
+        self.rate = rate
+        self.realtime = realtime
+        self.playback.set_real_time(realtime)
+        if realtime:
+            self.playback.set_playback_speed(rate)
+
+    def position(self):
+        ''' 現在位置 [s] '''
+        return self.playback.get_position() / 1e9
+
+    def seek_time(self, sec):
+        ''' 先頭から sec 秒の位置へ '''
+        sec = min(max(sec, 0.0), self.duration)
+        self.playback.seek(datetime.timedelta(seconds=sec))
+
+    def seek_frame(self, i):
+        ''' 索引の i 番目のフレームへ '''
+        i = min(max(i, 0), len(self.index)-1)
+        self.playback.seek(datetime.timedelta(microseconds=int(self.index['position'][i]) // 1000))
+
+    def frame_at(self, sec):
+        ''' 時刻 [s] -> 索引の番号 '''
+        return int(np.searchsorted(self.index['position'], sec * 1e9, side='right')) - 1
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+
+    def step(self):
+        ''' 一時停止中に1フレームだけ進める '''
+        self._step = True
+
+    def wait_for_frames(self, timeout_ms=5000):
+        ''' 次のフレーム (一時停止中は直前のフレームを返す) '''
+        if self.paused and not self._step and self._last is not None:
+            time.sleep(0.03)
+            return self._last
+        self._step = False
+        frames = self.pipeline.wait_for_frames(timeout_ms)
+        frames.keep()
+        self._last = frames
+        self.frames += 1
+        return frames
+
+    def fps(self):
+        ''' 実際に処理できたフレームレート '''
+        return self.frames / max(time.perf_counter() - self._t0, 1e-9)
+
+    def summary(self):
+        return {'frames': self.frames, 'sec': time.perf_counter() - self._t0, 'fps': self.fps()}
+
+    def stop(self):
+        self.pipeline.stop()
+        print(f'playback: {self.summary()}')
+
+class session_player(_player_keys):
+    ''' 分割録画のセッションを1本の bag として再生 (bag_player と同じ操作) '''
+    def __init__(self, path, rate=1.0, realtime=True, repeat=True, start=0.0):
+        self.files = segment_files(path)
+        segs = segments(path)
+        self.starts = [(s['start_ts'] - segs[0]['start_ts']) / 1000 for s in segs] # 各セグメントの開始 (s)
+        self.total = sum(s['frames'] for s in segs)
+        self._duration = (segs[-1]['end_ts'] - segs[0]['start_ts']) / 1000
+        self.rate, self.realtime, self.repeat = rate, realtime, repeat
+        self.paused = False
+        self.frames = 0
+        self._t0 = time.perf_counter()
+        self.k = -1
+        self._open(0)
+        if start: self.seek_time(start)
+
+    def __len__(self):
+        return self.total
+
+    @property
+    def duration(self):
+        return self._duration
+
+    def _open(self, k):
+        if k == self.k: return
+        if self.k >= 0:
+            self.player.pipeline.stop()
+        self.k = k
+        self.player = bag_player(segment_bag(self.files[k]), self.rate, self.realtime, repeat=False, index=False)
+        self.player.paused = self.paused
+
+    def set_rate(self, rate=1.0, realtime=True):
+        self.rate, self.realtime = rate, realtime
+        self.player.set_rate(rate, realtime)
+
+    def position(self):
+        return self.starts[self.k] + self.player.position()
+
+    def seek_time(self, sec):
+        k = min(max(int(np.searchsorted(self.starts, sec, side='right')) - 1, 0), len(self.files)-1)
+        self._open(k)
+        self.player.seek_time(sec - self.starts[k])
+
+    def pause(self):
+        self.paused = self.player.paused = True
+
+    def resume(self):
+        self.paused = self.player.paused = False
+
+    def step(self):
+        self.player.step()
+
+    def wait_for_frames(self, timeout_ms=5000):
+        ''' 次のフレーム (セグメントの終わりで次のファイルへ) '''
+        while True:
+            try:
+                frames = self.player.wait_for_frames(timeout_ms)
+                self.frames += 1
+                return frames
+            except RuntimeError:
+                if self.k + 1 < len(self.files):
+                    self._open(self.k + 1)
+                elif self.repeat:
+                    self._open(0)
+                else:
+                    raise
+
+    def fps(self):
+        return self.frames / max(time.perf_counter() - self._t0, 1e-9)
+
+    def summary(self):
+        return {'frames': self.frames, 'sec': time.perf_counter() - self._t0, 'fps': self.fps()}
+
+    def stop(self):
+        self.player.pipeline.stop()
+        print(f'playback: {self.summary()}')
+
+def open_player(path, rate=1.0, realtime=True, repeat=True, start=0.0):
+    ''' bag でもセッションでも再生器を返す '''
+    if os.path.isdir(path) and is_session(path):
+        return session_player(path, rate, realtime, repeat, start)
+    return bag_player(path, rate, realtime, repeat, start)
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(f'----- option -----\nfastest: py playback.py <file.bag>\nrate   : py playback.py <file.bag> <rate>')
+        sys.exit()
+    rate = float(sys.argv[2]) if len(sys.argv) >= 3 else None
+    player = open_player(sys.argv[1], rate or 1.0, realtime=rate is not None, repeat=False)
+    print(f'{len(player)} frames, {player.duration:.1f} s')
+    try:
+        while True:
+            player.wait_for_frames()
+    except RuntimeError: # 終端
+        pass
+    finally:
+        player.stop()
@@ -0,0 +1,287 @@
+'''
+    深度画像 -> 点群 (XYZ [m], 色付きも可)
+
+        pc = point_cloud(intrinsics, depth_scale)  # rs.intrinsics か meta.json の dict
+        xyz = pc.xyz(depth)                        # (H*W, 3) float32, 深度 0 の画素は (0, 0, 0)
+        xyz, rgb = pc.points(depth, color)         # 有効な画素だけ (color は深度に位置合わせ済みのもの)
+
+    画素ごとの視線ベクトル (歪み補正と depth_scale 込み) を解像度ごとに1度だけ計算してキャッシュし,
+    毎フレームは z16 の配列との掛け算1回で座標を求める (get_distance を画素ごとに呼ばない)
+
+    voxel_grid は複数フレームの点をボクセルごとの重心にまとめる (フレームごとに追加できる)
+
+        py point_cloud.py <in.bag | raw_dir> <out_dir> [--every 30] [--voxel 0.01] [--merge] [--format ply|npy]
+        py point_cloud.py bench
+'''
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+try:
+    import pyrealsense2 as rs
+except ImportError:
+    rs = None
+from raw_rec import intrinsics_dict
+
+_ray_cache = {} # (内部パラメータ, depth_scale) -> (H*W, 3) float32
+
+def _intr_key(intr):
+    d = intr if isinstance(intr, dict) else intrinsics_dict(intr)
+    return d, (d['width'], d['height'], d['ppx'], d['ppy'], d['fx'], d['fy'], d['model'], tuple(d['coeffs']))
+
+def ray_table(intr, depth_scale=0.001, offset=0.0):
+    ''' 画素ごとの視線ベクトル * depth_scale (z16 の値を掛けると XYZ [m])
+
+        offset は画素の中心からのずれ (-0.5 で左上の角, 0.5 で右下の角)
+    '''
+    d, key = _intr_key(intr)
+    key = key + (float(depth_scale), float(offset))
+    rays = _ray_cache.get(key)
+    if rays is None:
+        w, h = d['width'], d['height']
+        u, v = np.meshgrid(np.arange(w, dtype=np.float64) + offset, np.arange(h, dtype=np.float64) + offset)
+        x, y = undistort((u - d['ppx']) / d['fx'], (v - d['ppy']) / d['fy'], d['model'], d['coeffs'])
+        rays = np.empty((h * w, 3), np.float32)
+        rays[:, 0] = (x * depth_scale).ravel()
+        rays[:, 1] = (y * depth_scale).ravel()
+        rays[:, 2] = depth_scale
+        rays.flags.writeable = False
+        _ray_cache[key] = rays
+    return rays
+
+def undistort(x, y, model, coeffs):
+    ''' 正規化座標の歪み補正 (librealsense の rs2_deproject_pixel_to_point と同じ計算) '''
+    c = coeffs
+    if model not in ('inverse_brown_conrady', 'brown_conrady') or not any(c):
+        return x, y
+    xo, yo = x, y
+    for _ in range(10):
+        r2 = x*x + y*y
+        icdist = 1 / (1 + ((c[4]*r2 + c[1])*r2 + c[0])*r2)
+        if model == 'inverse_brown_conrady':
+            xq, yq = x / icdist, y / icdist
+        else:
+            xq, yq = x, y
+        dx = 2*c[2]*xq*yq + c[3]*(r2 + 2*xq*xq)
+        dy = 2*c[3]*xq*yq + c[2]*(r2 + 2*yq*yq)
+        x = (xo - dx) * icdist
+        y = (yo - dy) * icdist
+    return x, y
+
+class point_cloud():
+    ''' z16 -> XYZ (視線ベクトルのテーブルはキャッシュ) '''
+    def __init__(self, intr, depth_scale=0.001, max_depth=None):
+        self.rays = ray_table(intr, depth_scale)
+        self.depth_scale = depth_scale
+        self.max_raw = None if max_depth is None else int(max_depth / depth_scale)
+        self._xyz = np.empty_like(self.rays)
+
+    def xyz(self, depth, out=None):
+        ''' (H*W, 3) float32 (out を省略すると内部バッファに書き込んで返す) '''
+        if out is None: out = self._xyz
+        np.multiply(self.rays, depth.reshape(-1, 1), out=out)
+        return out
+
+    def valid(self, depth):
+        ''' 有効な画素 (H*W,) bool '''
+        d = depth.reshape(-1)
+        if self.max_raw is None:
+            return d > 0
+        return (d > 0) & (d <= self.max_raw)
+
+    def points(self, depth, color=None):
+        ''' 有効な画素の XYZ (と色) '''
+        idx = np.flatnonzero(self.valid(depth)) # bool の添字より take の方が速い
+        xyz = self.xyz(depth).take(idx, axis=0)
+        if color is None:
+            return xyz, None
+        return xyz, color.reshape(-1, color.shape[-1]).take(idx, axis=0)
+
+# ----- ボクセルグリッドによる間引き
+_OFFSET = 1 << 20 # ボクセル番号を 21bit x 3 に詰める
+
+class voxel_grid():
+    ''' ボクセルごとの重心 (と平均色) を少しずつ追加しながら求める '''
+    def __init__(self, size=0.01):
+        self.size = size
+        self.keys = np.zeros(0, np.int64)
+        self.sums = np.zeros((0, 3))
+        self.colors = None
+        self.counts = np.zeros(0, np.int64)
+
+    def _keys(self, xyz):
+        idx = np.floor(xyz / self.size).astype(np.int64) + _OFFSET
+        return (idx[:, 0] << 42) | (idx[:, 1] << 21) | idx[:, 2]
+
+    def add(self, xyz, rgb=None):
+        keys = np.concatenate([self.keys, self._keys(xyz)])
+        uniq, inv = np.unique(keys, return_inverse=True)
+        n = len(uniq)
+        old = len(self.keys)
+        sums = np.zeros((n, 3))
+        sums[inv[:old]] = self.sums # 既存のキーは重複しない
+        for k in range(3):
+            sums[:, k] += np.bincount(inv[old:], xyz[:, k], minlength=n)
+        counts = np.bincount(inv, np.concatenate([self.counts, np.ones(len(xyz), np.int64)]), minlength=n).astype(np.int64)
+        if rgb is not None:
+            colors = np.zeros((n, 3))
+            if self.colors is not None:
+                colors[inv[:old]] = self.colors
+            for k in range(3):
+                colors[:, k] += np.bincount(inv[old:], rgb[:, k], minlength=n)
+            self.colors = colors
+        self.keys, self.sums, self.counts = uniq, sums, counts
+
+    def __len__(self):
+        return len(self.keys)
+
+    def points(self):
+        ''' ボクセルごとの (重心, 平均色) '''
+        c = self.counts[:, None]
+        xyz = (self.sums / c).astype(np.float32)
+        rgb = None if self.colors is None else np.clip(self.colors / c, 0, 255).astype(np.uint8)
+        return xyz, rgb
+
+# ----- 書き出し
+def to_records(xyz, rgb=None):
+    ''' (N, 3) と (N, 3) -> x, y, z, red, green, blue の構造化配列 '''
+    fields = [('x', '<f4'), ('y', '<f4'), ('z', '<f4')]
+    if rgb is not None:
+        fields += [('red', 'u1'), ('green', 'u1'), ('blue', 'u1')]
+    rec = np.empty(len(xyz), fields)
+    rec['x'], rec['y'], rec['z'] = xyz[:, 0], xyz[:, 1], xyz[:, 2]
+    if rgb is not None:
+        rec['red'], rec['green'], rec['blue'] = rgb[:, 0], rgb[:, 1], rgb[:, 2]
+    return rec
+
+def write_ply(path, xyz, rgb=None):
+    ''' バイナリ PLY (rgb は RGB 順) '''
+    rec = to_records(xyz, rgb)
+    types = {'<f4': 'float', 'u1': 'uchar'}
+    header = ['ply', 'format binary_little_endian 1.0', f'element vertex {len(rec)}']
+    header += [f'property {types[rec.dtype[n].str.replace("|", "")]} {n}' for n in rec.dtype.names]
+    header += ['end_header']
+    with open(path, 'wb') as f:
+        f.write(('\n'.join(header) + '\n').encode('ascii'))
+        rec.tofile(f)
+
+def write_npy(path, xyz, rgb=None):
+    np.save(path, to_records(xyz, rgb))
+
+def read_ply(path):
+    ''' write_ply で書いたファイルを構造化配列で読む '''
+    with open(path, 'rb') as f:
+        fields = []
+        while True:
+            line = f.readline().decode('ascii').strip()
+            if line.startswith('property'):
+                _, t, n = line.split()
+                fields.append((n, '<f4' if t == 'float' else 'u1'))
+            elif line == 'end_header':
+                break
+        return np.fromfile(f, fields)
+
+def save(path, xyz, rgb=None, fmt='ply'):
+    (write_ply if fmt == 'ply' else write_npy)(path, xyz, rgb)
+
+# ----- 録画からの点群
+def bag_frames(bag, every=1):
+    ''' .bag -> (frame_no, depth, 深度に合わせた color (BGR) か None, intrinsics, depth_scale) '''
+    from raw_rec import open_bag, profile_streams
+    pipeline, profile = open_bag(bag)
+    streams = profile_streams(profile)
+    intr, scale = streams['depth']['intrinsics'], streams['depth']['depth_scale']
+    align = rs.align(rs.stream.depth) if 'color' in streams else None
+    i = 0
+    try:
+        while True:
+            ok, frames = pipeline.try_wait_for_frames(1000)
+            if not ok: break
+            i += 1
+            if (i - 1) % every: continue
+            if align: frames = align.process(frames)
+            depth = np.asanyarray(frames.get_depth_frame().get_data())
+            color = frames.get_color_frame() if align else None
+            color = np.asanyarray(color.get_data()) if color else None
+            if color is not None and streams['color']['fmt'] == 'rgb8':
+                color = color[..., ::-1]
+            yield frames.get_frame_number(), depth, color, intr, scale
+    finally:
+        pipeline.stop()
+
+def raw_frames(path, every=1):
+    ''' raw_rec 形式 (またはセッション) -> 同上 (color は深度と画角が違うので付けない) '''
+    from segment import is_session, session_reader
+    from raw_rec import raw_reader
+    reader = session_reader(path) if is_session(path) else raw_reader(path)
+    info = reader.streams['depth']
+    for i in range(0, len(reader), every):
+        fr = reader[i]
+        yield fr['frame_no'], fr['depth'], None, info['intrinsics'], info.get('depth_scale', 0.001)
+
+def export(src, out_dir, every=30, voxel=None, merge=False, fmt='ply', max_depth=None):
+    ''' 録画の every フレームごとに点群を書き出す (merge ならボクセルでまとめて1ファイル) '''
+    os.makedirs(out_dir, exist_ok=True)
+    frames = bag_frames(src, every) if src.endswith('.bag') else raw_frames(src, every)
+    grid = voxel_grid(voxel) if merge else None
+    pc = None
+    count = 0
+    for frame_no, depth, color, intr, scale in frames:
+        if pc is None:
+            pc = point_cloud(intr, scale, max_depth)
+        xyz, bgr = pc.points(depth, color)
+        rgb = None if bgr is None else bgr[:, ::-1]
+        if merge:
+            grid.add(xyz, rgb)
+        else:
+            if voxel:
+                g = voxel_grid(voxel)
+                g.add(xyz, rgb)
+                xyz, rgb = g.points()
+            save(os.path.join(out_dir, f'cloud_{frame_no}.{fmt}'), xyz, rgb, fmt)
+        count += 1
+    if merge and count:
+        xyz, rgb = grid.points()
+        save(os.path.join(out_dir, f'cloud_merged.{fmt}'), xyz, rgb, fmt)
+    return count
+
+def bench(w=640, h=480, repeat=100):
+    ''' 合成データで1フレームの処理時間 [ms] '''
+    from np_filter import synthetic_depth
+    intr = {'width': w, 'height': h, 'ppx': w/2, 'ppy': h/2, 'fx': 0.9*w, 'fy': 0.9*w,
+            'model': 'brown_conrady', 'coeffs': [0.0]*5}
+    depth = synthetic_depth(w, h)
+    color = np.zeros((h, w, 3), np.uint8)
+    start = time.perf_counter()
+    pc = point_cloud(intr, 0.001)
+    print(f'ray table: {(time.perf_counter() - start)*1000:.1f} ms (初回のみ)')
+    tests = {
+        'xyz': lambda: pc.xyz(depth),
+        'points+color': lambda: pc.points(depth, color),
+        'voxel 1cm': lambda: voxel_grid(0.01).add(*pc.points(depth, color)),
+    }
+    for name, func in tests.items():
+        func()
+        start = time.perf_counter()
+        for _ in range(repeat): func()
+        print(f'{name:14s} {(time.perf_counter() - start) / repeat * 1000:7.2f} ms')
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['bench']:
+        bench()
+        sys.exit()
+    parser = argparse.ArgumentParser(description='録画から点群を書き出す')
+    parser.add_argument('src', help='.bag か raw_rec 形式のディレクトリ')
+    parser.add_argument('out_dir')
+    parser.add_argument('--every', type=int, default=30, help='何フレームごとに書き出すか')
+    parser.add_argument('--voxel', type=float, help='ボクセルの大きさ [m]')
+    parser.add_argument('--merge', action='store_true', help='全フレームをまとめて1ファイルにする')
+    parser.add_argument('--max-depth', type=float, help='これより遠い点を捨てる [m]')
+    parser.add_argument('--format', default='ply', choices=('ply', 'npy'))
+    args = parser.parse_args()
+    if args.merge and not args.voxel:
+        parser.error('--merge には --voxel が必要')
+    n = export(args.src, args.out_dir, args.every, args.voxel, args.merge, args.format, args.max_depth)
+    print(f'{n} frames')
@@ -0,0 +1,250 @@
+'''
+    プリロール (ボタンを押す前の N 秒) を保持するリングバッファ
+
+        pre = preroll_buffer(profile_streams(profile), seconds=5, fps=30, codec=frame_codec(workers=2))
+        pre.push(frame_no, timestamp, images)      # 録画していない間, 毎フレーム (キャプチャのスレッド)
+        for fn, ts, images, enc in pre.frames(encoded=sink.accepts(codec)):
+            sink.write(fn, ts, images, enc)         # 録画開始時 (別のスレッド, 押した後のフレームまで続く)
+        pre.reset()
+
+    メモリは最初に全部確保し, 以後は増えない (nbytes で確認できる)
+        圧縮しないストリーム: (N, *shape) の配列
+        圧縮するストリーム (codec と compress): N フレーム分 / min_ratio のバイトのリング (arena)
+            フレームごとの大きさは自由で, 縮みにくいフレーム (ノイズの多い画像) が続けば
+            保持できる秒数が減るだけでフレームは捨てない (seconds で確認)
+    push はキャプチャのスレッドを止めない
+        圧縮は codec のスレッドで行い, 終わったものを次の push で arena に写す
+        圧縮が max_pending フレーム分溜まっていたら, そのフレームはプリロールに入れない (dropped)
+
+    読み出しは push を止めずに古い順に行う (リングの中身をそのまま待ち行列として使う)
+    読む前と後でスロットの番号 (gen) と arena の書き込み位置を確かめ, 読んでいる間に上書きされたフレームは捨てる (lost)
+    encoded に挙げたストリームは展開せずに圧縮したまま返す (同じ codec の raw_writer にそのまま書ける)
+    読み出しが push に追いつけば, その後のフレームは直接 writer に書けばよい (warm_rec.py)
+
+        py preroll.py bench [--sec 5] [--raw DIR]
+'''
+
+import time
+import argparse
+import threading
+import collections
+import numpy as np
+
+class preroll_buffer():
+    ''' 直近 seconds 秒のフレームの固定長リング '''
+    def __init__(self, streams, seconds=5.0, fps=30, codec=None, compress=('depth',), min_ratio=2.0, margin=2,
+                 max_pending=None):
+        self.n = max(2, int(round(seconds * fps)))
+        self.fps = fps
+        self.streams = streams
+        self.codec = codec
+        self.compress = [name for name in compress if name in streams] if codec else []
+        self.margin = margin            # push が次に上書きするスロットからこれだけ離れたものだけ読む
+        self.max_pending = max_pending or 2 * getattr(codec, 'workers', 1)
+        n = self.n
+        self.raw = {name: np.empty((n, *info['shape']), info['dtype'])
+                    for name, info in streams.items() if name not in self.compress}
+        self.arena = {}                 # name -> 圧縮したフレームを順に詰めるバイトのリング
+        self.enc_pos = {}               # name -> (N,) arena に書いた位置 (通算のバイト数)
+        self.enc_len = {}               # name -> (N,) 圧縮後の大きさ
+        self._wpos = {}                 # name -> arena に書いた通算のバイト数
+        for name in self.compress:
+            info = streams[name]
+            raw_bytes = int(np.prod(info['shape'])) * np.dtype(info['dtype']).itemsize
+            self.arena[name] = np.empty(int(n * raw_bytes / min_ratio), np.uint8)
+            self.enc_pos[name] = np.zeros(n, np.int64)
+            self.enc_len[name] = np.zeros(n, np.int64)
+            self._wpos[name] = 0
+        self.frame_no = np.zeros(n, np.int64)
+        self.timestamp = np.zeros(n, np.float64)
+        self.gen = np.full(n, -1, np.int64) # スロットに入っているフレームの通し番号 (-1: 空か書き込み中)
+        self.ready = np.zeros(n, bool)      # 圧縮も終わって読めるか
+        self.head = 0                       # push した数
+        self.start = 0                      # これより前の通し番号は無効 (reset)
+        self._pending = collections.deque() # (通し番号, {name: Future})
+        self._lock = threading.Lock()       # スロットの確保と圧縮結果の書き込み
+        self.dropped = 0                    # 圧縮が追いつかず入れなかった
+        self.overflow = 0                   # arena より大きかった
+        self.lost = 0
+        for a in list(self.raw.values()) + list(self.arena.values()):
+            a.fill(0) # ページを今確保しておく (後で増えない)
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in self.raw.values()) + sum(a.nbytes for a in self.arena.values())
+
+    @property
+    def seconds(self):
+        ''' 今保持している長さ (s) '''
+        return self.available() / self.fps
+
+    def available(self):
+        ''' 今読めるフレームの数 '''
+        idx = np.arange(max(self.start, self.head - self.n), self.head)
+        k = idx % self.n
+        ok = (self.gen[k] == idx) & self.ready[k]
+        for name, arena in self.arena.items():
+            ok &= self._wpos[name] - self.enc_pos[name][k] <= len(arena)
+        return int(ok.sum())
+
+    def push(self, frame_no, timestamp, images):
+        ''' 1フレーム入れる (いちばん古いものを上書き, 待たない) '''
+        self._retire()
+        i = self.head
+        k = i % self.n
+        with self._lock:
+            self.gen[k] = -1
+            self.ready[k] = False
+        self.head = i + 1
+        if self.compress and len(self._pending) >= self.max_pending:
+            self.dropped += 1 # 圧縮が追いついていない (キャプチャは止めない)
+            return
+        for name, buf in self.raw.items():
+            img = images.get(name)
+            if img is not None:
+                np.copyto(buf[k], img.reshape(buf.shape[1:]))
+        self.frame_no[k] = frame_no
+        self.timestamp[k] = timestamp
+        if self.compress:
+            self._pending.append((i, {name: self.codec.submit(images[name]) for name in self.compress if name in images}))
+        else:
+            self.ready[k] = True
+        self.gen[k] = i
+
+    def _retire(self):
+        ''' 圧縮が終わったものを arena に写す (終わっていないものは待たない) '''
+        with self._lock:
+            while self._pending:
+                i, futs = self._pending[0]
+                if not all(f.done() for f in futs.values()): break
+                self._pending.popleft()
+                k = i % self.n
+                bufs = {name: f.result() for name, f in futs.items()}
+                if self.gen[k] != i: continue
+                if any(len(b) > len(self.arena[name]) for name, b in bufs.items()):
+                    self.overflow += 1
+                    self.gen[k] = -1
+                    continue
+                for name, b in bufs.items():
+                    arena = self.arena[name]
+                    pos = self._wpos[name]
+                    off = pos % len(arena)
+                    if off + len(b) > len(arena): # 端で折り返さず先頭から
+                        pos += len(arena) - off
+                        off = 0
+                    arena[off:off+len(b)] = np.frombuffer(b, np.uint8)
+                    self.enc_pos[name][k] = pos
+                    self.enc_len[name][k] = len(b)
+                    self._wpos[name] = pos + len(b)
+                self.ready[k] = True
+
+    def _intact(self, i):
+        ''' 通し番号 i のフレームがまだ上書きされていないか '''
+        k = i % self.n
+        if self.gen[k] != i or not self.ready[k]: return False
+        return all(self._wpos[name] - self.enc_pos[name][k] <= len(arena) for name, arena in self.arena.items())
+
+    def read(self, i, out, encoded=None):
+        ''' 通し番号 i のフレームを out ({name: 配列}) に写す (上書きされていたら None)
+
+            encoded ({}) を渡すと arena のストリームのうち out に無いものは圧縮したまま bytes で入れる
+        '''
+        if not self._intact(i): return None
+        k = i % self.n
+        fn, ts = int(self.frame_no[k]), float(self.timestamp[k])
+        try:
+            for name, buf in self.raw.items():
+                if name in out: np.copyto(out[name], buf[k])
+            for name, arena in self.arena.items():
+                off = int(self.enc_pos[name][k]) % len(arena)
+                b = arena[off:off+int(self.enc_len[name][k])]
+                if name in out:
+                    self.codec.decode(b, out[name])
+                elif encoded is not None:
+                    encoded[name] = b.tobytes()
+        except Exception: # 展開中に上書きされて壊れた
+            return None
+        if not self._intact(i): return None
+        return fn, ts
+
+    def frames(self, stop=None, wait=0.5, encoded=()):
+        ''' 古い順に (frame_no, timestamp, images, encoded) を返す, push に追いついたら終わる
+
+            stop(i) が True を返したら (呼び出し側が直接書き始めたら) そこで終わる
+            encoded に挙げた圧縮ストリームは images に入れず, 展開しないで encoded {name: bytes} に入れる
+            images は同じバッファを使い回すので, 次を取り出す前に書き終えること
+        '''
+        keep = [name for name in encoded if name in self.arena]
+        out = {name: np.empty(info['shape'], info['dtype']) for name, info in self.streams.items() if name not in keep}
+        i = max(self.start, self.head - self.n + self.margin)
+        while True:
+            if stop and stop(i): return
+            if i >= self.head: return
+            oldest = self.head - self.n + self.margin
+            if i < oldest: # 読むのが遅く push に追い越された
+                self.lost += oldest - i
+                i = oldest
+                continue
+            k = i % self.n
+            t0 = time.perf_counter()
+            while self.gen[k] == i and not self.ready[k] and time.perf_counter() - t0 < wait:
+                self._retire() # 圧縮の終わり待ち
+                if not self.ready[k]: time.sleep(0.001)
+            enc = {}
+            fr = self.read(i, out, enc if keep else None)
+            if fr is None:
+                if self.gen[k] != -1 or self.ready[k]: self.lost += 1
+            else:
+                yield fr[0], fr[1], out, enc
+            i += 1
+
+    def reset(self):
+        ''' 中身を捨てる (録画が終わって次のプリロールを溜め直す時, 圧縮中のものも待たない) '''
+        self.start = self.head
+
+    def stats(self):
+        return {'frames': self.available(), 'seconds': self.seconds, 'MB': self.nbytes / 1e6,
+                'dropped': self.dropped, 'overflow': self.overflow, 'lost': self.lost}
+
+def bench(frames, seconds=5.0, fps=30, workers=2):
+    ''' fps の間隔で push した時の push の時間, 捨てた数, メモリ, 読み出しの速さ (圧縮あり/なし, 展開あり/なし) '''
+    from depth_codec import frame_codec
+    streams = {name: {'shape': list(img.shape), 'dtype': img.dtype.str} for name, img in frames[0].items()}
+    for compress in ((), ('depth',)):
+        codec = frame_codec('left', workers=workers) if compress else None
+        pre = preroll_buffer(streams, seconds, fps, codec, compress)
+        n = pre.n + 10
+        t = np.zeros(n)
+        start = time.perf_counter()
+        for i in range(n):
+            t0 = time.perf_counter()
+            pre.push(i, i * 1000 / fps, frames[i % len(frames)])
+            t[i] = time.perf_counter() - t0
+            time.sleep(max(0.0, start + (i + 1) / fps - time.perf_counter())) # カメラと同じ間隔
+        time.sleep(0.2)
+        pre._retire()
+        print(f'compress={compress or "off"}: {pre.nbytes/1e6:.0f} MB for {seconds} s, '
+              f'push mean {t.mean()*1000:.2f} ms / max {t.max()*1000:.2f} ms, {pre.stats()}')
+        for encoded in ((), tuple(compress)) if compress else ((),):
+            start = time.perf_counter()
+            count = sum(1 for _ in pre.frames(encoded=encoded))
+            read_ms = (time.perf_counter() - start) * 1000 / max(count, 1)
+            print(f'    read{" (encoded)" if encoded else ""}: {read_ms:.2f} ms/frame, {count} frames')
+        if codec: codec.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='プリロールのリングバッファ')
+    parser.add_argument('cmd', choices=('bench',))
+    parser.add_argument('--sec', type=float, default=5.0)
+    parser.add_argument('--raw', help='raw_rec 形式の録画 (省略すると合成データ)')
+    args = parser.parse_args()
+    if args.raw:
+        from raw_rec import raw_reader
+        r = raw_reader(args.raw)
+        frames = [{name: np.array(r[i][name]) for name in r.streams} for i in range(min(len(r), 30))]
+    else:
+        from np_filter import synthetic_depth
+        rng = np.random.default_rng(1)
+        frames = [{'depth': synthetic_depth(1280, 720, seed=i),
+                   'color': rng.integers(0, 256, (720, 1280, 3), dtype=np.uint8)} for i in range(10)]
+    bench(frames, args.sec)
@@ -0,0 +1,100 @@
+'''
+    処理が追いつかない時に画質を段階的に落としてフレームレート (遅延) を保つ
+
+        qc = quality_controller(budget_ms=1000/30)
+        qc.update(proc_ms, backlog)     # 1フレームごとに (処理時間とキューに溜まっていた数)
+        filters.configure(qc.decimate, qc.spatial)
+        if qc.show_raw: ...             # フィルタ前の深度の表示
+        if qc.display(frame_no): ...    # 表示するフレームか
+
+    段階 (LEVELS): 0 が最高画質, 数字が大きいほど軽い
+        1. decimation を上げる  2. spatial filter を止める  3. フィルタ前の表示を止める
+        4. 表示を 2 フレームに1回  5. decimation をさらに上げる  6. 表示を 3 フレームに1回
+    処理時間の移動平均が予算の high 倍を超えるかキューが溜まったら1段下げ,
+    low 倍を下回って溜まりもない状態が続いたら1段戻す (切り替え直後は hold 秒待つ)
+'''
+
+import time
+
+LEVELS = [
+    # decimate: 基準からの倍率, spatial, show_raw, display_every
+    {'decimate': 1, 'spatial': True,  'show_raw': True,  'display_every': 1},
+    {'decimate': 2, 'spatial': True,  'show_raw': True,  'display_every': 1},
+    {'decimate': 2, 'spatial': False, 'show_raw': True,  'display_every': 1},
+    {'decimate': 2, 'spatial': False, 'show_raw': False, 'display_every': 1},
+    {'decimate': 2, 'spatial': False, 'show_raw': False, 'display_every': 2},
+    {'decimate': 4, 'spatial': False, 'show_raw': False, 'display_every': 2},
+    {'decimate': 4, 'spatial': False, 'show_raw': False, 'display_every': 3},
+]
+
+class quality_controller():
+    ''' 処理時間とキューの溜まり具合から画質の段階を決める '''
+    def __init__(self, budget_ms, base_decimate=1, high=0.9, low=0.6, backlog=2,
+                 hold=2.0, recover=5.0, smooth=0.1, max_level=None, log=print):
+        self.budget_ms = budget_ms      # 1フレームに使える時間 (1000 / FPS)
+        self.base_decimate = base_decimate
+        self.high = high                # 予算に対してこれを超えたら下げる
+        self.low = low                  # これを下回り続けたら戻す
+        self.backlog = backlog          # キューにこれ以上溜まったら下げる
+        self.hold = hold                # 切り替え後, 次に下げるまでの時間 (s)
+        self.recover = recover          # 余裕がこれだけ続いたら戻す (s)
+        self.smooth = smooth            # 移動平均の係数
+        self.max_level = len(LEVELS) - 1 if max_level is None else max_level
+        self.log = log
+        self.level = 0
+        self.avg_ms = None
+        self.transitions = []           # (時刻, 前, 後, 理由)
+        self._t_change = time.monotonic()
+        self._t_ok = None               # 余裕のある状態になった時刻
+
+    @property
+    def state(self):
+        return LEVELS[self.level]
+
+    @property
+    def decimate(self):
+        return min(self.base_decimate * self.state['decimate'], 8)
+
+    @property
+    def spatial(self):
+        return self.state['spatial']
+
+    @property
+    def show_raw(self):
+        return self.state['show_raw']
+
+    def display(self, frame_no):
+        ''' このフレームを表示するか '''
+        return frame_no % self.state['display_every'] == 0
+
+    def update(self, proc_ms, backlog=0):
+        ''' 1フレームの処理時間 [ms] とキューに溜まっていたフレーム数, 段階が変わったら True '''
+        self.avg_ms = proc_ms if self.avg_ms is None else self.avg_ms + self.smooth * (proc_ms - self.avg_ms)
+        now = time.monotonic()
+        busy = self.avg_ms > self.high * self.budget_ms
+        if (busy or backlog >= self.backlog) and self.level < self.max_level:
+            self._t_ok = None
+            if now - self._t_change >= self.hold:
+                reason = f'avg {self.avg_ms:.1f} ms / {self.budget_ms:.1f} ms, backlog {backlog}'
+                return self._set(self.level + 1, reason, now)
+            return False
+        if self.avg_ms < self.low * self.budget_ms and backlog == 0 and self.level > 0:
+            if self._t_ok is None:
+                self._t_ok = now
+            elif now - self._t_ok >= self.recover and now - self._t_change >= self.hold:
+                return self._set(self.level - 1, f'avg {self.avg_ms:.1f} ms / {self.budget_ms:.1f} ms', now)
+        else:
+            self._t_ok = None
+        return False
+
+    def _set(self, level, reason, now):
+        old = self.level
+        self.level = level
+        self._t_change = now
+        self._t_ok = None
+        self.avg_ms = None # 新しい段階で測り直す
+        self.transitions.append((time.time(), old, level, reason))
+        if self.log:
+            kind = 'degrade' if level > old else 'restore'
+            self.log(f'quality {kind}: {old} -> {level} {LEVELS[level]} ({reason})')
+        return True
@@ -0,0 +1,457 @@
+'''
+    メモリマップによる生フレームの録画形式 (.bag の代わり)
+
+    <dir>/meta.json           ストリームの形状, 内部パラメータ, 深度スケール
+    <dir>/index.bin           1フレーム 16byte (frame_no: int64, timestamp[ms]: float64) を追記
+    <dir>/<stream>_00000.raw  固定長フレームを frames_per_segment 枚ずつ確保したセグメント
+    <dir>/<stream>_00000.pack 可逆圧縮したストリーム (depth_codec.py) のフレームを追記したもの
+    <dir>/<stream>_00000.pos  .pack の中の各フレームの位置 (offset: int64, size: int64)
+
+    読み込み側は np.memmap のビューを返すのでコピーが発生しない (圧縮したストリームは展開した配列)
+    圧縮は codec のスレッドプールで行い, 書き込みは終わった順ではなくフレーム順に行う
+    pyrealsense2 は .bag との変換と録画にだけ使う (読み込みだけならなくても動く)
+
+    変換:
+        py raw_rec.py to_raw  <in.bag> <out_dir>
+        py raw_rec.py to_bag  <in_dir> <out.bag>
+'''
+
+import os
+import sys
+import json
+import collections
+import numpy as np
+from concurrent.futures import Future
+try:
+    import pyrealsense2 as rs
+except ImportError:
+    rs = None
+
+INDEX_DTYPE = np.dtype([('frame_no', '<i8'), ('timestamp', '<f8')])
+POS_DTYPE = np.dtype([('offset', '<i8'), ('size', '<i8')])
+
+# ----- rs のストリーム形式 <-> 配列
+FORMATS = {
+    # fmt: (dtype, チャンネル数)
+    'z16': ('<u2', 1),
+    'y8': ('u1', 1),
+    'y16': ('<u2', 1),
+    'bgr8': ('u1', 3),
+    'rgb8': ('u1', 3),
+}
+
+def intrinsics_dict(intr):
+    ''' rs.intrinsics -> dict '''
+    return {
+        'width': intr.width, 'height': intr.height,
+        'ppx': intr.ppx, 'ppy': intr.ppy,
+        'fx': intr.fx, 'fy': intr.fy,
+        'model': str(intr.model).split('.')[-1],
+        'coeffs': list(intr.coeffs),
+    }
+
+def make_intrinsics(d):
+    ''' dict -> rs.intrinsics '''
+    intr = rs.intrinsics()
+    intr.width, intr.height = d['width'], d['height']
+    intr.ppx, intr.ppy = d['ppx'], d['ppy']
+    intr.fx, intr.fy = d['fx'], d['fy']
+    intr.model = getattr(rs.distortion, d['model'])
+    intr.coeffs = d['coeffs']
+    return intr
+
+def extrinsics_dict(ext):
+    ''' rs.extrinsics -> dict (rotation は列優先の 3x3) '''
+    return {'rotation': list(ext.rotation), 'translation': list(ext.translation)}
+
+def make_extrinsics(d):
+    ''' dict -> rs.extrinsics '''
+    ext = rs.extrinsics()
+    ext.rotation = d['rotation']
+    ext.translation = d['translation']
+    return ext
+
+def stream_name(profile):
+    ''' ストリームのキー名 (infrared は index 付き) '''
+    name = str(profile.stream_type()).split('.')[-1]
+    if name == 'infrared':
+        name = f'infrared{profile.stream_index()}'
+    return name
+
+def stream_info(profile, depth_scale=None):
+    ''' stream_profile -> meta.json 用の情報 '''
+    vp = profile.as_video_stream_profile()
+    fmt = str(profile.format()).split('.')[-1]
+    dtype, ch = FORMATS[fmt]
+    intr = vp.get_intrinsics()
+    shape = [intr.height, intr.width] + ([ch] if ch > 1 else [])
+    info = {'fmt': fmt, 'dtype': dtype, 'shape': shape, 'fps': profile.fps(), 'intrinsics': intrinsics_dict(intr)}
+    if depth_scale is not None and fmt == 'z16':
+        info['depth_scale'] = depth_scale
+    return info
+
+def profile_streams(profile):
+    ''' pipeline_profile -> {name: stream_info} '''
+    depth_scale = None
+    for sensor in profile.get_device().query_sensors():
+        if sensor.is_depth_sensor():
+            depth_scale = sensor.as_depth_sensor().get_depth_scale()
+    sps = {stream_name(sp): sp for sp in profile.get_streams()}
+    streams = {name: stream_info(sp, depth_scale) for name, sp in sps.items()}
+    if 'color' in sps: # カラー画像への位置合わせ用
+        for name, sp in sps.items():
+            if name != 'color':
+                streams[name]['extrinsics_to_color'] = extrinsics_dict(sp.get_extrinsics_to(sps['color']))
+    return streams
+
+def frameset_images(frames):
+    ''' frameset -> {name: ndarray} (フレームのバッファをそのまま参照) '''
+    images = {}
+    for i in range(frames.size()):
+        f = frames[i]
+        images[stream_name(f.get_profile())] = np.asanyarray(f.get_data())
+    return images
+
+class _pack_writer():
+    ''' 圧縮したフレームの追記 (1ストリーム, 1セグメント) '''
+    def __init__(self, path, name, seg):
+        self._data = open(pack_path(path, name, seg), 'wb')
+        self._pos = open(pack_path(path, name, seg, '.pos'), 'wb')
+        self._rec = np.zeros(1, POS_DTYPE)
+        self.bytes = 0
+
+    def append(self, buf):
+        ''' buf が None なら欠けたフレーム (読むと 0) '''
+        size = len(buf) if buf is not None else 0
+        if size: self._data.write(buf)
+        self._rec['offset'] = self.bytes
+        self._rec['size'] = size
+        self._pos.write(self._rec.tobytes())
+        self.bytes += size
+
+    def flush(self):
+        self._data.flush() # 中身を先に (.pos が指す所は必ず書けている)
+        self._pos.flush()
+
+    def close(self):
+        self._data.close()
+        self._pos.close()
+
+class raw_writer():
+    ''' 生フレームの追記
+
+        codec (depth_codec.frame_codec) を渡すと compress のストリームを可逆圧縮して書く
+        圧縮が追いつかず max_pending フレーム分溜まったら, 待たずにそのフレームを欠けたフレームとして書く (dropped)
+    '''
+    def __init__(self, path, streams, frames_per_segment=300, meta=None, codec=None, compress=('depth',), max_pending=None):
+        self.path = path
+        self.codec = codec
+        self.compress = [n for n in compress if n in streams] if codec else []
+        streams = {n: dict(info, codec=codec.params()) if n in self.compress else info for n, info in streams.items()}
+        self.streams = streams
+        self.frames_per_segment = frames_per_segment
+        self.count = 0
+        self._segs = {}     # name -> 現在のセグメントの memmap
+        self._packs = {}    # (name, seg) -> _pack_writer
+        self._pending = collections.deque() # (name, seg, Future か None) をフレーム順に
+        self.max_pending = max_pending or (4 * codec.workers if codec else 0)
+        self.dropped = 0    # 圧縮が追いつかず書かなかったフレーム (ストリームごとに数える)
+        self._seg_no = -1
+        os.makedirs(path, exist_ok=True)
+        self.meta = dict(meta or {}, version=1, streams=streams, frames_per_segment=frames_per_segment)
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(self.meta, f, indent=2)
+        self._index = open(os.path.join(path, 'index.bin'), 'ab')
+        self._rec = np.zeros(1, INDEX_DTYPE)
+
+    def accepts(self, codec):
+        ''' 圧縮済みのまま write(encoded=) に渡せるストリーム (同じ設定の codec の時だけ) '''
+        if self.codec is None or codec is None or codec.params() != self.codec.params(): return []
+        return list(self.compress)
+
+    def write(self, frame_no, timestamp, images, encoded=None):
+        ''' 1フレーム追記 (images: {name: ndarray}, 欠けたストリームは 0 のまま)
+
+            encoded: {name: bytes} 同じ codec で圧縮済みのフレーム (preroll.py から, 圧縮し直さない)
+        '''
+        seg, pos = divmod(self.count, self.frames_per_segment)
+        if seg != self._seg_no:
+            self._open_segment(seg)
+        for name, img in images.items():
+            mm = self._segs.get(name)
+            if mm is not None:
+                np.copyto(mm[pos], img.reshape(mm.shape[1:]))
+        self._drain()
+        full = len(self._pending) >= self.max_pending * len(self.compress)
+        for name in self.compress:
+            if encoded and name in encoded:
+                fut = Future()
+                fut.set_result(encoded[name])
+                self._pending.append((name, seg, fut))
+                continue
+            img = images.get(name)
+            if img is not None and full:
+                self.dropped += 1 # 書き込むスレッド (キャプチャ) は止めない
+                img = None
+            self._pending.append((name, seg, None if img is None else self.codec.submit(img)))
+        self._rec['frame_no'] = frame_no
+        self._rec['timestamp'] = timestamp
+        for pack in self._packs.values():
+            pack.flush()
+        self._index.write(self._rec.tobytes())
+        self._index.flush() # 電源断でも書けた所までは読める
+        self.count += 1
+
+    def _drain(self, wait=False):
+        ''' 圧縮が終わったものをフレーム順に書き出す (wait=True なら全部終わるまで待つ) '''
+        while self._pending:
+            name, seg, fut = self._pending[0]
+            if fut is not None and not fut.done() and not wait:
+                break
+            self._pending.popleft()
+            self._packs[(name, seg)].append(fut.result() if fut is not None else None)
+        # 書き終わった前のセグメントを閉じる
+        busy = {seg for _, seg, _ in self._pending}
+        for key in [k for k in self._packs if k[1] < self._seg_no and k[1] not in busy]:
+            self._packs.pop(key).close()
+
+    def close(self):
+        ''' 最後のセグメントを使った分だけに切り詰めて閉じる '''
+        self._drain(wait=True)
+        for pack in self._packs.values():
+            pack.close()
+        self._packs = {}
+        used = self.count - self._seg_no * self.frames_per_segment
+        sizes = {}
+        for name, mm in self._segs.items():
+            mm.flush()
+            sizes[name] = used * int(np.prod(mm.shape[1:])) * mm.dtype.itemsize
+        self._segs = {} # マップを解放してから切り詰める
+        for name, size in sizes.items():
+            os.truncate(segment_path(self.path, name, self._seg_no), size)
+        self._index.close()
+
+    def _open_segment(self, seg):
+        for mm in self._segs.values():
+            mm.flush()
+        self._segs = {}
+        for name, info in self.streams.items():
+            if name in self.compress:
+                self._packs[(name, seg)] = _pack_writer(self.path, name, seg)
+                continue
+            shape = (self.frames_per_segment, *info['shape'])
+            p = segment_path(self.path, name, seg)
+            with open(p, 'wb') as f:
+                size = int(np.prod(shape)) * np.dtype(info['dtype']).itemsize
+                try:
+                    os.posix_fallocate(f.fileno(), 0, size) # 書き込み中に断片化させない
+                except (AttributeError, OSError):
+                    f.truncate(size)
+            self._segs[name] = np.memmap(p, dtype=info['dtype'], mode='r+', shape=shape)
+        self._seg_no = seg
+
+def segment_path(path, name, seg):
+    return os.path.join(path, f'{name}_{seg:05d}.raw')
+
+def pack_path(path, name, seg, ext='.pack'):
+    return os.path.join(path, f'{name}_{seg:05d}{ext}')
+
+class _pack_reader():
+    ''' 圧縮したストリームの1セグメント ([pos] で展開した配列を返す) '''
+    def __init__(self, path, name, seg, info):
+        from depth_codec import decode
+        self._decode = decode
+        self.info = info
+        pos = np.fromfile(pack_path(path, name, seg, '.pos'), POS_DTYPE)
+        size = os.path.getsize(pack_path(path, name, seg))
+        bad = np.flatnonzero(pos['offset'] + pos['size'] > size) # 電源断で中身が書けていない
+        self.pos = pos[:bad[0]] if len(bad) else pos
+        self.data = np.memmap(pack_path(path, name, seg), np.uint8, mode='r') if size else np.zeros(0, np.uint8)
+
+    def __len__(self):
+        return len(self.pos)
+
+    def __getitem__(self, i):
+        off, size = int(self.pos['offset'][i]), int(self.pos['size'][i])
+        if not size:
+            return np.zeros(self.info['shape'], self.info['dtype'])
+        return self._decode(self.data[off:off+size])
+
+class raw_reader():
+    ''' 生フレームの読み込み (ランダムアクセス, ゼロコピー) '''
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.streams = self.meta['streams']
+        self.frames_per_segment = self.meta['frames_per_segment']
+        self.index = np.fromfile(os.path.join(path, 'index.bin'), INDEX_DTYPE)
+        self._segs = {}
+        # 圧縮したストリームは index より遅れて書かれるので, 電源断の後は読める所までにする
+        # (最後のセグメントとは限らない, 前のセグメントの圧縮待ちが残っていることもある)
+        n = len(self.index)
+        fps = self.frames_per_segment
+        for name, info in self.streams.items():
+            if 'codec' not in info: continue
+            seg = 0
+            while seg * fps < n:
+                try:
+                    have = len(self._segment(name, seg))
+                except FileNotFoundError:
+                    have = 0
+                if have < fps:
+                    n = min(n, seg * fps + have)
+                    break
+                seg += 1
+        self.index = self.index[:n]
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.frame(i)
+
+    def frame(self, i):
+        ''' i 番目のフレーム {name: ndarray, frame_no, timestamp} '''
+        if i < 0: i += len(self)
+        if not 0 <= i < len(self): raise IndexError(i)
+        seg, pos = divmod(i, self.frames_per_segment)
+        out = {name: self._segment(name, seg)[pos] for name in self.streams}
+        out['frame_no'] = int(self.index['frame_no'][i])
+        out['timestamp'] = float(self.index['timestamp'][i])
+        return out
+
+    __getitem__ = frame
+
+    def find(self, timestamp):
+        ''' timestamp[ms] 以前で最も近いフレームの番号 '''
+        i = int(np.searchsorted(self.index['timestamp'], timestamp, side='right')) - 1
+        return min(max(i, 0), len(self)-1)
+
+    def at_time(self, timestamp):
+        return self.frame(self.find(timestamp))
+
+    def find_frame_no(self, frame_no):
+        ''' ハードウェアのフレーム番号 -> 番号 (なければ None) '''
+        hit = np.flatnonzero(self.index['frame_no'] == frame_no)
+        return int(hit[0]) if len(hit) else None
+
+    def _segment(self, name, seg):
+        mm = self._segs.get((name, seg))
+        if mm is None and 'codec' in self.streams[name]:
+            mm = self._segs[(name, seg)] = _pack_reader(self.path, name, seg, self.streams[name])
+        if mm is None:
+            info = self.streams[name]
+            mm = np.memmap(segment_path(self.path, name, seg), dtype=info['dtype'], mode='r')
+            mm = mm.reshape(-1, *info['shape'])
+            self._segs[(name, seg)] = mm
+        return mm
+
+# ----- .bag との変換
+def open_bag(bag):
+    ''' bag を最速 (非リアルタイム) で再生する pipeline '''
+    config = rs.config()
+    config.enable_device_from_file(bag, repeat_playback=False)
+    pipeline = rs.pipeline()
+    profile = pipeline.start(config)
+    playback = profile.get_device().as_playback()
+    playback.set_real_time(False)
+    return pipeline, profile
+
+def bag_to_raw(bag, out_dir, frames_per_segment=300):
+    ''' .bag -> 生フレーム形式 '''
+    pipeline, profile = open_bag(bag)
+    writer = raw_writer(out_dir, profile_streams(profile), frames_per_segment, {'source': os.path.basename(bag)})
+    try:
+        while True:
+            ok, frames = pipeline.try_wait_for_frames(1000)
+            if not ok: break # 終端
+            writer.write(frames.get_frame_number(), frames.get_timestamp(), frameset_images(frames))
+    finally:
+        pipeline.stop()
+        writer.close()
+    return writer.count
+
+class bag_sink():
+    ''' numpy 配列を software_device 経由で .bag に書き込む '''
+    def __init__(self, path, streams):
+        self.path = path
+        self.streams = streams
+        self.device = rs.software_device()
+        self._sensors = {}  # name -> (sensor, profile, info)
+        sensors = {}
+        kinds = {name: 'Depth' if name in ('depth',) or name.startswith('infrared') else 'Color' for name in streams}
+        scales = {kinds[name]: info['depth_scale'] for name, info in streams.items() if 'depth_scale' in info}
+        for uid, (name, info) in enumerate(streams.items()):
+            kind = kinds[name]
+            if kind not in sensors:
+                sensors[kind] = self.device.add_sensor(kind)
+                if kind in scales: # infrared が先に来ても depth の値を使う
+                    sensors[kind].add_read_only_option(rs.option.depth_units, scales[kind])
+            sensor = sensors[kind]
+            vs = rs.video_stream()
+            vs.type = getattr(rs.stream, name.rstrip('0123456789'))
+            vs.index = int(name[len('infrared'):] or 0) if name.startswith('infrared') else 0
+            vs.uid = uid
+            vs.width, vs.height = info['shape'][1], info['shape'][0]
+            vs.fps = info.get('fps', 30)
+            vs.fmt = getattr(rs.format, info['fmt'])
+            vs.bpp = np.dtype(info['dtype']).itemsize * (info['shape'][2] if len(info['shape']) > 2 else 1)
+            vs.intrinsics = make_intrinsics(info['intrinsics'])
+            self._sensors[name] = (sensor, sensor.add_video_stream(vs), vs.bpp)
+        if 'color' in self._sensors:
+            color_profile = self._sensors['color'][1]
+            for name, (_, profile, _) in self._sensors.items():
+                if 'extrinsics_to_color' in streams[name]:
+                    profile.register_extrinsics_to(color_profile, make_extrinsics(streams[name]['extrinsics_to_color']))
+        self.recorder = rs.recorder(path, self.device)
+        self._open = {}
+        for name, (sensor, profile, _) in self._sensors.items():
+            self._open.setdefault(id(sensor), (sensor, []))[1].append(profile)
+        for sensor, profiles in self._open.values():
+            sensor.open(profiles)
+            sensor.start(lambda f: None)
+        self.count = 0
+
+    def write(self, frame_no, timestamp, images):
+        ''' 1フレーム書き込み '''
+        for name, img in images.items():
+            if name not in self._sensors: continue
+            sensor, profile, bpp = self._sensors[name]
+            img = np.ascontiguousarray(img)
+            f = rs.software_video_frame()
+            f.pixels = img
+            f.bpp = bpp
+            f.stride = img.shape[1] * bpp
+            f.timestamp = timestamp
+            f.domain = rs.timestamp_domain.hardware_clock
+            f.frame_number = frame_no
+            f.profile = profile.as_video_stream_profile()
+            sensor.on_video_frame(f)
+        self.count += 1
+
+    def close(self):
+        for sensor, _ in self._open.values():
+            sensor.stop()
+            sensor.close()
+        del self.recorder # デストラクタでファイルが閉じられる
+
+def raw_to_bag(in_dir, bag):
+    ''' 生フレーム形式 -> .bag '''
+    reader = raw_reader(in_dir)
+    sink = bag_sink(bag, reader.streams)
+    try:
+        for fr in reader:
+            sink.write(fr['frame_no'], fr['timestamp'], {n: fr[n] for n in reader.streams})
+    finally:
+        sink.close()
+    return sink.count
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == 'to_raw':
+        print(f'{bag_to_raw(sys.argv[2], sys.argv[3])} frames')
+    elif len(sys.argv) == 4 and sys.argv[1] == 'to_bag':
+        print(f'{raw_to_bag(sys.argv[2], sys.argv[3])} frames')
+    else:
+        print(f'----- option -----\nbag -> raw: py raw_rec.py to_raw <in.bag> <out_dir>\nraw -> bag: py raw_rec.py to_bag <in_dir> <out.bag>')
@@ -0,0 +1,301 @@
+'''
+    領域 (ROI) ごとの距離の統計
+
+        rois = load_rois('rois.json')           # [{'name', 'rect': [x0, y0, x1, y1]} か {'name', 'poly': [[x, y], ...]}]
+        stage = roi_stats(rois, size=(1280, 720), depth_scale=0.001)
+        s = stage(depth)                        # {'min', 'median', 'mean', 'valid'} (ROI 数の配列, 距離は m)
+        log = roi_log('roi_log', stage.names, depth_scale)
+        log.write(frame_no, timestamp, s)
+
+        rec = roi_recorder('rois.json', 'roi_log')      # 上の2つをまとめたもの (深度の単位は最初のフレームから)
+        rec.write(frame_no, timestamp, depth, depth_scale)
+
+    ROI ごとのマスクから画素の番号 (flat index) を最初に1度だけ作り, 全 ROI 分をつなげて持つ
+    1フレームの処理は take で画素を集めて reduceat で ROI ごとに集計するだけ (Python のループなし)
+    中央値は (ROI 番号 << 16 | 深度) を1度ソートして各 ROI の真ん中を取る
+    深度 0 (と範囲外) は無効として除き, valid はその割合
+
+    座標は size (w, h) の画像での値, decimation などで大きさが変わったら縮めて作り直す (大きさごとにキャッシュ)
+
+    roi_log は列ごとのファイルに追記する (chunk 行ごとに書き出す)
+        <dir>/meta.json         ROI 名, 列, 行数
+        <dir>/frame_no.i8 timestamp.f8      (行数,)
+        <dir>/min.f4 median.f4 mean.f4 valid.f4     (行数, ROI 数)
+
+        py roi_stats.py run <src> --rois rois.json [--out roi_log]     src: .bag / raw_rec / live
+        py roi_stats.py show <roi_log>
+        py roi_stats.py bench [--n 300]
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+STATS = ('min', 'median', 'mean', 'valid')
+
+def load_rois(path):
+    ''' JSON ([...] か {'size': [w, h], 'rois': [...]}) -> (rois, size か None) '''
+    with open(path) as f:
+        data = json.load(f)
+    if isinstance(data, list):
+        return data, None
+    return data['rois'], data.get('size')
+
+def grid_rois(size, nx, ny, margin=0):
+    ''' 画像を nx x ny に分けた矩形 (試験用) '''
+    w, h = size
+    xs = np.linspace(margin, w - margin, nx + 1).astype(int)
+    ys = np.linspace(margin, h - margin, ny + 1).astype(int)
+    return [{'name': f'r{j}_{i}', 'rect': [int(xs[i]), int(ys[j]), int(xs[i+1]), int(ys[j+1])]}
+            for j in range(ny) for i in range(nx)]
+
+def roi_mask(roi, shape, scale=(1.0, 1.0)):
+    ''' ROI -> bool のマスク (shape は (h, w), scale は座標の倍率) '''
+    import cv2
+    h, w = shape
+    sx, sy = scale
+    mask = np.zeros((h, w), np.uint8)
+    if 'rect' in roi:
+        x0, y0, x1, y1 = roi['rect']
+        mask[max(int(round(y0*sy)), 0):int(round(y1*sy)), max(int(round(x0*sx)), 0):int(round(x1*sx))] = 1
+    elif 'poly' in roi:
+        pts = np.round(np.array(roi['poly'], np.float64) * (sx, sy)).astype(np.int32)
+        cv2.fillPoly(mask, [pts], 1)
+    else:
+        raise ValueError(f'ROI には rect か poly が必要: {roi}')
+    return mask.view(bool)
+
+class _roi_index():
+    ''' ある大きさの画像での ROI の画素番号 (全 ROI 分をつなげたもの) '''
+    def __init__(self, rois, shape, scale):
+        idx = [np.flatnonzero(roi_mask(r, shape, scale)) for r in rois]
+        self.size = np.array([len(i) for i in idx])
+        self.used = np.flatnonzero(self.size)          # 画素のある ROI (空の ROI は reduceat に入れない)
+        sizes = self.size[self.used]
+        self.idx = np.concatenate([idx[k] for k in self.used]) if len(self.used) else np.zeros(0, np.intp)
+        self.starts = np.concatenate(([0], np.cumsum(sizes)[:-1])).astype(np.intp)
+        self.nsize = sizes
+        self.key = np.repeat(np.arange(len(self.used), dtype=np.uint32) << 16, sizes) # 中央値用のソートキー
+
+class roi_stats():
+    ''' ROI ごとの min / median / mean [m] と有効画素の割合 '''
+    def __init__(self, rois, size=None, depth_scale=0.001, min_depth=0.0, max_depth=None, median=True):
+        self.rois = list(rois)
+        self.names = [r.get('name', f'roi{i}') for i, r in enumerate(self.rois)]
+        self.size = tuple(size) if size else None   # 座標の基準の画像の大きさ (w, h), None なら最初のフレーム
+        self.depth_scale = depth_scale
+        self.min_depth = min_depth
+        self.max_depth = max_depth
+        self.median = median
+        self._index = {}
+
+    def index(self, shape):
+        ''' 画像の大きさ (h, w) ごとの画素番号 '''
+        ix = self._index.get(shape)
+        if ix is None:
+            if self.size is None:
+                self.size = (shape[1], shape[0])
+            scale = (shape[1] / self.size[0], shape[0] / self.size[1])
+            ix = self._index[shape] = _roi_index(self.rois, shape, scale)
+        return ix
+
+    def __call__(self, depth, depth_scale=None):
+        ''' 深度画像 (uint16) -> {'min', 'median', 'mean', 'valid'} (float32, 値の無い ROI は NaN) '''
+        scale = depth_scale or self.depth_scale
+        ix = self.index(depth.shape[:2])
+        n = len(self.rois)
+        out = {k: np.full(n, np.nan, np.float32) for k in STATS}
+        out['valid'][:] = 0
+        if not len(ix.used): return out
+        v = depth.reshape(-1).take(ix.idx)
+        lo = max(int(np.ceil(self.min_depth / scale)), 1)
+        if self.max_depth:
+            valid = (v >= lo) & (v <= int(self.max_depth / scale))
+            v[~valid] = 0
+        else:
+            valid = v >= lo
+            if lo > 1: v[~valid] = 0
+        cnt = np.add.reduceat(valid, ix.starts, dtype=np.int64)
+        total = np.add.reduceat(v, ix.starts, dtype=np.int64)
+        v[~valid] = 0xffff # min と中央値で無効な画素が最後に来るように
+        vmin = np.minimum.reduceat(v, ix.starts)
+        has = cnt > 0
+        used = ix.used[has]
+        out['valid'][ix.used] = cnt / ix.nsize
+        out['min'][used] = vmin[has] * scale
+        out['mean'][used] = total[has] / cnt[has] * scale
+        if self.median:
+            s = np.sort(ix.key | v) & 0xffff
+            lo_i = ix.starts[has] + (cnt[has] - 1) // 2
+            hi_i = ix.starts[has] + cnt[has] // 2
+            out['median'][used] = (s[lo_i] + s[hi_i].astype(np.float64)) * (0.5 * scale)
+        return out
+
+# ----- 列ごとのファイルへの書き出し
+class roi_log():
+    ''' 1フレーム1行, 列ごとに追記 (chunk 行ごとに書き出す) '''
+    def __init__(self, path, names, depth_scale=None, chunk=300, meta=None):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.names = list(names)
+        self.chunk = chunk
+        self.rows = 0
+        self._n = 0
+        n = len(self.names)
+        self._buf = {'frame_no': np.zeros(chunk, np.int64), 'timestamp': np.zeros(chunk, np.float64)}
+        self._buf.update({k: np.zeros((chunk, n), np.float32) for k in STATS})
+        self._files = {k: open(os.path.join(path, k + _ext(b.dtype)), 'wb') for k, b in self._buf.items()}
+        self.meta = {'rois': self.names, 'columns': {k: b.dtype.str for k, b in self._buf.items()},
+                     'depth_scale': depth_scale, 'unit': 'm', 'rows': 0}
+        self.meta.update(meta or {})
+        self._write_meta()
+
+    def write(self, frame_no, timestamp, stats):
+        i = self._n
+        self._buf['frame_no'][i] = frame_no
+        self._buf['timestamp'][i] = timestamp
+        for k in STATS:
+            self._buf[k][i] = stats[k]
+        self._n += 1
+        if self._n == self.chunk:
+            self.flush()
+
+    def flush(self):
+        if not self._n: return
+        for k, f in self._files.items():
+            f.write(self._buf[k][:self._n].tobytes())
+            f.flush()
+        self.rows += self._n
+        self._n = 0
+        self._write_meta()
+
+    def close(self):
+        self.flush()
+        for f in self._files.values(): f.close()
+
+    def _write_meta(self):
+        self.meta['rows'] = self.rows
+        tmp = os.path.join(self.path, 'meta.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.meta, f, indent=2)
+        os.replace(tmp, os.path.join(self.path, 'meta.json'))
+
+class roi_recorder():
+    ''' ROI の JSON から統計を計算して roi_log に書く '''
+    def __init__(self, rois_path, out, max_depth=None, meta=None):
+        self.rois, self.size = load_rois(rois_path)
+        self.out = out
+        self.max_depth = max_depth
+        self.meta = meta
+        self.stage = self.log = None
+
+    def write(self, frame_no, timestamp, depth, depth_scale):
+        if self.stage is None:
+            self.stage = roi_stats(self.rois, self.size, depth_scale, max_depth=self.max_depth)
+            self.log = roi_log(self.out, self.stage.names, depth_scale, meta=self.meta)
+        stats = self.stage(depth, depth_scale)
+        self.log.write(frame_no, timestamp, stats)
+        return stats
+
+    def close(self):
+        if self.log: self.log.close()
+
+def _ext(dtype):
+    return f'.{dtype.kind}{dtype.itemsize}'
+
+def read_log(path):
+    ''' roi_log -> (meta, {列: 配列}) (meta.json の行数まで, 書き込み中でも読める) '''
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    rows, n = meta['rows'], len(meta['rois'])
+    cols = {}
+    for k, dt in meta['columns'].items():
+        dt = np.dtype(dt)
+        a = np.fromfile(os.path.join(path, k + _ext(dt)), dt, count=rows * (1 if k in ('frame_no', 'timestamp') else n))
+        cols[k] = a if k in ('frame_no', 'timestamp') else a.reshape(rows, n)
+    return meta, cols
+
+# ----- 入力
+def depth_frames(src):
+    ''' .bag / raw_rec 形式 / 'live' -> (frame_no, timestamp, depth, depth_scale) '''
+    if src == 'live' or src.endswith('.bag'):
+        import pyrealsense2 as rs
+        from raw_rec import open_bag
+        if src == 'live':
+            pipeline = rs.pipeline()
+            profile = pipeline.start()
+        else:
+            pipeline, profile = open_bag(src)
+        scale = profile.get_device().first_depth_sensor().get_depth_scale()
+        try:
+            while True:
+                ok, frames = pipeline.try_wait_for_frames(1000)
+                if not ok: break
+                d = frames.get_depth_frame()
+                yield d.get_frame_number(), d.get_timestamp(), np.asanyarray(d.get_data()), scale
+        finally:
+            pipeline.stop()
+        return
+    from segment import is_session, session_reader
+    from raw_rec import raw_reader
+    reader = session_reader(src) if is_session(src) else raw_reader(src)
+    scale = reader.streams['depth'].get('depth_scale', 0.001)
+    for fr in reader:
+        yield fr['frame_no'], fr['timestamp'], fr['depth'], scale
+
+def run(src, rois_path, out, max_depth=None):
+    rec = roi_recorder(rois_path, out, max_depth, meta={'src': src})
+    n = 0
+    t = 0.0
+    try:
+        for frame_no, ts, depth, scale in depth_frames(src):
+            start = time.perf_counter()
+            rec.write(frame_no, ts, depth, scale)
+            t += time.perf_counter() - start
+            n += 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        rec.close()
+    print(f'{n} frames, {len(rec.rois)} ROIs, {1000*t/max(n, 1):.2f} ms/frame -> {out}')
+
+def show(path, rows=5):
+    meta, cols = read_log(path)
+    print(f'{meta["rows"]} rows x {len(meta["rois"])} ROIs ({meta.get("src", "")})')
+    for i in range(max(0, meta['rows'] - rows), meta['rows']):
+        vals = ', '.join(f'{name}: {cols["median"][i, k]:.3f} m ({cols["valid"][i, k]*100:.0f} %)'
+                         for k, name in enumerate(meta['rois'][:6]))
+        print(f'  {cols["frame_no"][i]}: {vals}{" ..." if len(meta["rois"]) > 6 else ""}')
+
+def bench(n_rois=300, w=1280, h=720, repeat=30):
+    from np_filter import synthetic_depth
+    depth = synthetic_depth(w, h)
+    nx = int(np.ceil(np.sqrt(n_rois * w / h)))
+    rois = grid_rois((w, h), nx, int(np.ceil(n_rois / nx)), margin=40)[:n_rois]
+    for median in (False, True):
+        stage = roi_stats(rois, (w, h), median=median)
+        stage(depth)
+        start = time.perf_counter()
+        for _ in range(repeat): stage(depth)
+        ms = (time.perf_counter() - start) * 1000 / repeat
+        print(f'{len(rois)} ROIs, {len(stage.index(depth.shape).idx)} px, median={median}: {ms:.2f} ms/frame')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ROI ごとの距離の統計')
+    parser.add_argument('cmd', choices=('run', 'show', 'bench'))
+    parser.add_argument('src', nargs='?', help='.bag / raw_rec 形式 / live (run), roi_log (show)')
+    parser.add_argument('--rois', help='ROI の JSON')
+    parser.add_argument('--out', default='roi_log')
+    parser.add_argument('--max-depth', type=float, help='これより遠い画素を無効にする [m]')
+    parser.add_argument('-n', type=int, default=300, help='ROI の数 (bench)')
+    args = parser.parse_args()
+    if args.cmd == 'bench':
+        bench(args.n)
+    elif args.cmd == 'show':
+        show(args.src)
+    else:
+        if not args.src or not args.rois: sys.exit('usage: py roi_stats.py run <src> --rois rois.json')
+        run(args.src, args.rois, args.out, args.max_depth)
@@ -0,0 +1,41 @@
+'''
+    librealsense の後処理フィルタ一式
+
+    decimation -> disparity -> spatial -> depth -> hole filling
+    フィルタは内部状態を持つので, スレッドごとに別のインスタンスを使うこと
+'''
+
+import pyrealsense2 as rs
+
+class rs_filter_chain():
+    ''' 深度フレーム用フィルタチェーン '''
+    def __init__(self, decimate=1, spatial=1, smooth_alpha=0.25, smooth_delta=50, hole_filling=1):
+        self.decimate = rs.decimation_filter()
+        self.decimate.set_option(rs.option.filter_magnitude, decimate)
+        self.spatial = rs.spatial_filter()
+        self.spatial.set_option(rs.option.filter_magnitude, spatial)
+        self.spatial.set_option(rs.option.filter_smooth_alpha, smooth_alpha)
+        self.spatial.set_option(rs.option.filter_smooth_delta, smooth_delta)
+        self.hole_filling = rs.hole_filling_filter(hole_filling)
+        self.depth_to_disparity = rs.disparity_transform(True)
+        self.disparity_to_depth = rs.disparity_transform(False)
+        self.magnitude = decimate
+        self.use_spatial = True
+
+    def configure(self, decimate=None, spatial=None):
+        ''' 処理中に間引き率と spatial filter の有無を変える (quality.py) '''
+        if decimate is not None and decimate != self.magnitude:
+            self.decimate.set_option(rs.option.filter_magnitude, decimate)
+            self.magnitude = decimate
+        if spatial is not None:
+            self.use_spatial = spatial
+
+    def process(self, depth_frame):
+        ''' フィルタを順に適用して深度フレームを返す '''
+        ff = self.decimate.process(depth_frame)
+        if self.use_spatial:
+            ff = self.depth_to_disparity.process(ff)
+            ff = self.spatial.process(ff)
+            ff = self.disparity_to_depth.process(ff)
+        ff = self.hole_filling.process(ff)
+        return ff.as_depth_frame()
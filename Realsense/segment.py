@@ -0,0 +1,158 @@
+'''
+    長時間録画の分割 (セッション)
+
+    一定の長さ (秒) かサイズ (byte) を超えたらフレームの間で次のファイルに切り替える
+    ライブのフレームを自分で書き込むので切り替え時にフレームは落ちない
+    (閉じる処理は別スレッドで行う)
+
+    <session_dir>/session.json   セグメントの一覧 (ファイル, フレーム番号, 時刻の範囲)
+    <session_dir>/seg_00000.bag  (fmt='bag')
+    <session_dir>/seg_00000/     (fmt='raw', raw_rec 形式)
+
+    session.json は切り替えと各セグメントの最初のフレームで書き直すので, 電源断でも書けたセグメントまでは繋がる
+    (最後のセグメントの frames / end_ts は最初のフレームの値のまま, フレームの無いセグメントは読む時に飛ばす)
+'''
+
+import os
+import json
+import threading
+import numpy as np
+from raw_rec import raw_writer, raw_reader, bag_sink
+
+MANIFEST = 'session.json'
+
+def write_manifest(path, manifest):
+    ''' 途中で切れても壊れないように置き換えで書く '''
+    tmp = os.path.join(path, MANIFEST + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, os.path.join(path, MANIFEST))
+
+def read_manifest(path):
+    with open(os.path.join(path, MANIFEST)) as f:
+        return json.load(f)
+
+def is_session(path):
+    return os.path.isfile(os.path.join(path, MANIFEST))
+
+def segments(path):
+    ''' フレームが書かれたセグメントの一覧 (manifest の segments) '''
+    return [s for s in read_manifest(path)['segments'] if 'start_ts' in s]
+
+def segment_files(path):
+    ''' セッションのセグメントを順番に (絶対パス, raw 形式はディレクトリ) '''
+    return [os.path.join(path, s['file']) for s in segments(path)]
+
+class segment_writer():
+    ''' 長さ/サイズで自動的にファイルを切り替える録画
+
+        fmt='raw' で codec (depth_codec.frame_codec) を渡すと compress のストリームを可逆圧縮する
+        (max_bytes は圧縮前の大きさで判定する)
+    '''
+    def __init__(self, path, streams, fmt='bag', max_sec=None, max_bytes=None, meta=None, codec=None, compress=('depth',)):
+        self.path = path
+        self.codec = codec
+        self.compress = compress
+        self.streams = streams
+        self.fmt = fmt
+        self.max_sec = max_sec
+        self.max_bytes = max_bytes
+        self.frames = 0
+        self.dropped = 0    # raw で圧縮が追いつかず欠けたフレーム (raw_writer.dropped の合計)
+        self._sink = None
+        self._seg = None
+        self._closing = []
+        os.makedirs(path, exist_ok=True)
+        self.manifest = dict(meta or {}, session=os.path.basename(os.path.normpath(path)),
+                             format=fmt, streams=streams, segments=[])
+
+    def accepts(self, codec):
+        ''' 圧縮済みのまま write(encoded=) に渡せるストリーム (raw_writer.accepts と同じ) '''
+        if self.fmt != 'raw' or self.codec is None or codec is None or codec.params() != self.codec.params(): return []
+        return [name for name in self.compress if name in self.streams]
+
+    def write(self, frame_no, timestamp, images, encoded=None):
+        ''' 1フレーム書き込み (必要ならその前に次のセグメントへ切り替える) '''
+        if self._seg is None or self._full(timestamp):
+            self._roll()
+        if encoded:
+            self._sink.write(frame_no, timestamp, images, encoded)
+        else:
+            self._sink.write(frame_no, timestamp, images)
+        seg = self._seg
+        first = seg['frames'] == 0
+        if first:
+            seg['first_frame'], seg['start_ts'] = int(frame_no), float(timestamp)
+        seg['last_frame'], seg['end_ts'] = int(frame_no), float(timestamp)
+        seg['frames'] += 1
+        seg['bytes'] += sum(img.nbytes for img in images.values())
+        for name in encoded or (): # 圧縮前の大きさで数える
+            info = self.streams[name]
+            seg['bytes'] += int(np.prod(info['shape'])) * np.dtype(info['dtype']).itemsize
+        self.frames += 1
+        if first: # 電源断でも時刻の範囲が読めるように
+            write_manifest(self.path, self.manifest)
+
+    def close(self):
+        if self._sink:
+            self.dropped += getattr(self._sink, 'dropped', 0)
+            self._sink.close()
+            self._sink = None
+        for th in self._closing:
+            th.join()
+        write_manifest(self.path, self.manifest)
+
+    def _full(self, timestamp):
+        seg = self._seg
+        if not seg['frames']: return False
+        if self.max_sec and (timestamp - seg['start_ts']) / 1000 >= self.max_sec: return True
+        if self.max_bytes and seg['bytes'] >= self.max_bytes: return True
+        return False
+
+    def _roll(self):
+        if self._sink:
+            self.dropped += getattr(self._sink, 'dropped', 0) # 閉じる時には落とさない
+            th = threading.Thread(target=self._sink.close) # 書き出しを待たずに次へ
+            th.start()
+            self._closing.append(th)
+        no = len(self.manifest['segments'])
+        if self.fmt == 'bag':
+            name = f'seg_{no:05d}.bag'
+            self._sink = bag_sink(os.path.join(self.path, name), self.streams)
+        else:
+            name = f'seg_{no:05d}'
+            self._sink = raw_writer(os.path.join(self.path, name), self.streams, codec=self.codec, compress=self.compress)
+        self._seg = {'file': name, 'frames': 0, 'bytes': 0}
+        self.manifest['segments'].append(self._seg)
+        write_manifest(self.path, self.manifest)
+
+class session_reader():
+    ''' raw 形式のセッションを1本の連続したストリームとして読む '''
+    def __init__(self, path):
+        self.manifest = read_manifest(path)
+        self.readers = [raw_reader(f) for f in segment_files(path)]
+        self.streams = self.manifest['streams']
+        self.offsets = np.cumsum([0] + [len(r) for r in self.readers])
+        self.index = np.concatenate([r.index for r in self.readers]) if self.readers else np.zeros(0)
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __iter__(self):
+        for r in self.readers:
+            yield from r
+
+    def frame(self, i):
+        if i < 0: i += len(self)
+        if not 0 <= i < len(self): raise IndexError(i)
+        k = int(np.searchsorted(self.offsets, i, side='right')) - 1
+        return self.readers[k].frame(i - int(self.offsets[k]))
+
+    __getitem__ = frame
+
+    def find(self, timestamp):
+        i = int(np.searchsorted(self.index['timestamp'], timestamp, side='right')) - 1
+        return min(max(i, 0), len(self)-1)
+
+    def at_time(self, timestamp):
+        return self.frame(self.find(timestamp))
@@ -0,0 +1,163 @@
+'''
+    マルチスレッドのフレーム処理パイプライン
+
+    capture -> filter (ワーカープール, 順序保持) -> colorize -> display/output
+    ステージ間は有界キューでつなぎ, 溢れた時の動作は
+        drop : 一番古いフレームを捨てる (遅延優先)
+        block: 空くまで上流を待たせる (全フレーム処理)
+    から選ぶ
+'''
+
+import threading
+import traceback
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+class stage_queue():
+    ''' ステージ間の有界キュー '''
+    def __init__(self, maxsize=4, policy='drop'):
+        if policy not in ('drop', 'block'):
+            raise ValueError(f'unknown queue policy: {policy}')
+        self.maxsize = max(1, maxsize)
+        self.policy = policy
+        self.dropped = 0    # 捨てたフレーム数
+        self.closed = False
+        self._q = collections.deque()
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return len(self._q)
+
+    def put(self, item):
+        ''' 追加 (close 済みなら False) '''
+        with self._cond:
+            while len(self._q) >= self.maxsize and not self.closed:
+                if self.policy == 'drop':
+                    self._q.popleft()
+                    self.dropped += 1
+                    break
+                self._cond.wait()
+            if self.closed: return False
+            self._q.append(item)
+            self._cond.notify_all()
+            return True
+
+    def get(self, timeout=None):
+        ''' 取り出し (タイムアウト or close 後に空なら None) '''
+        with self._cond:
+            while not self._q:
+                if self.closed: return None
+                if not self._cond.wait(timeout): return None
+            item = self._q.popleft()
+            self._cond.notify_all()
+            return item
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+class stage_pipeline():
+    ''' ステージを別スレッドで動かすパイプライン '''
+    def __init__(self, qsize=4, policy='drop'):
+        self.qsize = qsize
+        self.policy = policy
+        self.stages = []    # (name, func, workers)
+        self.queues = []
+        self.threads = []
+        self.pools = []
+        self._stop = threading.Event()
+
+    def add(self, name, func, workers=1):
+        ''' ステージ追加 (func(item) -> item, None を返すとそのフレームは破棄) '''
+        self.stages.append((name, func, workers))
+        return self
+
+    def start(self, source):
+        ''' source() を capture スレッドで繰り返し呼んで流し込む '''
+        self.queues = [stage_queue(self.qsize, self.policy) for _ in range(len(self.stages)+1)]
+        self._spawn('capture', self._source_loop, source, self.queues[0])
+        for i, (name, func, workers) in enumerate(self.stages):
+            in_q, out_q = self.queues[i], self.queues[i+1]
+            if workers > 1:
+                self._spawn_pool(name, func, workers, in_q, out_q)
+            else:
+                self._spawn(name, self._stage_loop, func, in_q, out_q)
+        return self
+
+    def get(self, timeout=None):
+        ''' 最終ステージの出力を取得 '''
+        return self.queues[-1].get(timeout)
+
+    def stop(self):
+        self._stop.set()
+        for q in self.queues: q.close()
+        for th in self.threads: th.join(timeout=2.0)
+        for pool in self.pools: pool.shutdown(wait=False)
+
+    @property
+    def running(self):
+        return not self._stop.is_set()
+
+    def stats(self):
+        ''' キューごとの滞留数と破棄数 '''
+        names = ['capture'] + [s[0] for s in self.stages]
+        return {n: {'depth': len(q), 'dropped': q.dropped} for n, q in zip(names, self.queues)}
+
+    def _spawn(self, name, target, *args):
+        th = threading.Thread(target=target, args=args, name=name, daemon=True)
+        th.start()
+        self.threads.append(th)
+
+    def _spawn_pool(self, name, func, workers, in_q, out_q):
+        ''' ワーカープールで処理し, 入力順に出力する '''
+        pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self.pools.append(pool)
+        futures = stage_queue(workers, 'block') # 実行中の数を workers 個に制限
+        self._spawn(f'{name}-submit', self._submit_loop, pool, func, in_q, futures)
+        self._spawn(f'{name}-collect', self._collect_loop, futures, out_q)
+
+    def _source_loop(self, source, out_q):
+        while not self._stop.is_set():
+            try:
+                item = source()
+            except Exception:
+                traceback.print_exc()
+                self._stop.set()
+                break
+            if item is not None:
+                out_q.put(item)
+        out_q.close()
+
+    def _stage_loop(self, func, in_q, out_q):
+        while True:
+            item = in_q.get()
+            if item is None: break
+            try:
+                item = func(item)
+            except Exception:
+                traceback.print_exc()
+                continue
+            if item is not None:
+                out_q.put(item)
+        out_q.close()
+
+    def _submit_loop(self, pool, func, in_q, futures):
+        while True:
+            item = in_q.get()
+            if item is None: break
+            futures.put(pool.submit(func, item))
+        futures.close()
+
+    def _collect_loop(self, futures, out_q):
+        while True:
+            fut = futures.get()
+            if fut is None: break
+            try:
+                item = fut.result()
+            except Exception:
+                traceback.print_exc()
+                continue
+            if item is not None:
+                out_q.put(item)
+        out_q.close()
@@ -0,0 +1,51 @@
+# depth_codec.py は可逆でなければならない (カメラ不要): python3 -m pytest test_depth_codec.py
+import itertools
+import numpy as np
+import pytest
+from depth_codec import PREDICTORS, encode, decode, frame_codec
+
+def image(dtype, ch, h=37, w=53, seed=0):
+    ''' 滑らかな面 + ノイズ + 端の値 (0 と最大値) '''
+    rng = np.random.default_rng(seed)
+    top = np.iinfo(dtype).max
+    y, x = np.mgrid[:h, :w]
+    img = (x * 7 + y * 3) % (top + 1) + rng.integers(0, 4, (h, w))
+    img = np.stack([img + c for c in range(ch)], -1) if ch > 1 else img
+    img = img.astype(dtype)
+    img[0, :5] = 0
+    img[-1, -5:] = top
+    img[h//2] = rng.integers(0, top, img[h//2].shape, endpoint=True, dtype=dtype) # 大きな差 (桁あふれ)
+    return img
+
+@pytest.mark.parametrize('predictor, tiles, dtype, ch',
+                         list(itertools.product(PREDICTORS, (1, 3, 100), (np.uint8, np.uint16), (1, 3))))
+def test_round_trip(predictor, tiles, dtype, ch):
+    img = image(dtype, ch)
+    out = decode(encode(img, predictor, tiles=tiles))
+    assert out.dtype == img.dtype and out.shape == img.shape
+    assert np.array_equal(out, img)
+
+def test_non_contiguous_input():
+    img = image(np.uint16, 3)[:, ::2]
+    assert np.array_equal(decode(encode(img, 'none')), img)
+
+def test_decode_into_out():
+    img = image(np.uint16, 1)
+    out = np.zeros_like(img)
+    assert decode(encode(img), out) is out
+    assert np.array_equal(out, img)
+
+@pytest.mark.parametrize('predictor', PREDICTORS)
+def test_frame_codec_submit(predictor):
+    codec = frame_codec(predictor, workers=2, tiles=2)
+    try:
+        imgs = [image(np.uint16, 1, seed=i) for i in range(4)]
+        futs = [codec.submit(img) for img in imgs]
+        for img, fut in zip(imgs, futs):
+            assert np.array_equal(codec.decode(fut.result()), img)
+    finally:
+        codec.close()
+
+def test_unsupported_dtype():
+    with pytest.raises(ValueError):
+        encode(np.zeros((4, 4), np.int16))
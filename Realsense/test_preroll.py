@@ -0,0 +1,132 @@
+# preroll.py のリング (合成フレーム, カメラ不要): python3 -m pytest test_preroll.py
+import time
+import threading
+import numpy as np
+import pytest
+from concurrent.futures import Future
+from preroll import preroll_buffer
+from depth_codec import frame_codec, decode
+
+SHAPE = (12, 16)
+STREAMS = {
+    'depth': {'shape': SHAPE, 'dtype': '<u2'},
+    'color': {'shape': (*SHAPE, 3), 'dtype': 'u1'},
+}
+
+def images(no, noisy=False):
+    ''' frame_no から中身が決まる画像 (noisy=True はほとんど縮まない) '''
+    rng = np.random.default_rng(no)
+    depth = rng.integers(0, 65536, SHAPE) if noisy else 1000 + np.arange(SHAPE[1]) + no % 100
+    return {'depth': np.broadcast_to(depth, SHAPE).astype(np.uint16),
+            'color': np.full((*SHAPE, 3), no % 256, np.uint8)}
+
+def check(no, imgs, enc=None, noisy=False):
+    want = images(no, noisy)
+    for name, img in imgs.items():
+        assert np.array_equal(img, want[name]), (no, name)
+    for name, buf in (enc or {}).items():
+        assert np.array_equal(decode(buf), want[name]), (no, name)
+
+def settle(pre, timeout=2.0):
+    ''' 圧縮の終わりを待つ '''
+    t0 = time.monotonic()
+    while pre._pending and time.monotonic() - t0 < timeout:
+        pre._retire()
+        time.sleep(0.001)
+
+@pytest.fixture
+def codec():
+    c = frame_codec('left', workers=2)
+    yield c
+    c.close()
+
+@pytest.mark.parametrize('compressed', [False, True])
+def test_overwrite_and_order(codec, compressed):
+    pre = preroll_buffer(STREAMS, seconds=1, fps=10, codec=codec if compressed else None, margin=2)
+    for no in range(25): # 10 フレームのリングに 25
+        pre.push(no, no * 100.0, images(no))
+        settle(pre)
+    got = []
+    for no, ts, imgs, enc in pre.frames():
+        assert ts == no * 100.0
+        check(no, imgs)
+        got.append(no)
+    assert got == list(range(25 - 10 + 2, 25)) # 古いものは上書き, 次に上書きされる margin 個は読まない
+    assert pre.lost == 0 and pre.dropped == 0
+
+def test_encoded_passthrough(codec):
+    pre = preroll_buffer(STREAMS, seconds=1, fps=10, codec=codec)
+    for no in range(5):
+        pre.push(no, float(no), images(no))
+    settle(pre)
+    got = []
+    for no, ts, imgs, enc in pre.frames(encoded=['depth']):
+        assert 'depth' not in imgs and set(enc) == {'depth'}
+        check(no, imgs, enc)
+        got.append(no)
+    assert got == list(range(5))
+
+def test_poorly_compressed_frames_shorten_the_ring(codec):
+    pre = preroll_buffer(STREAMS, seconds=1, fps=10, codec=codec, min_ratio=2.0)
+    for no in range(30):
+        pre.push(no, float(no), images(no, noisy=True))
+        settle(pre)
+    assert pre.available() < 10 # arena に入るだけ
+    got = []
+    for no, ts, imgs, enc in pre.frames():
+        check(no, imgs, noisy=True)
+        got.append(no)
+    assert got and got == list(range(got[0], 30)) # 残っているのは新しい方から連続
+    assert pre.overflow == 0
+
+class held_codec():
+    ''' 圧縮が終わらない codec '''
+    workers = 1
+    def submit(self, img):
+        return Future()
+
+def test_push_never_waits_for_the_codec():
+    pre = preroll_buffer(STREAMS, seconds=1, fps=10, codec=held_codec(), max_pending=2)
+    t0 = time.perf_counter()
+    for no in range(6):
+        pre.push(no, float(no), images(no))
+    assert time.perf_counter() - t0 < 0.5
+    assert pre.dropped == 4
+    assert list(pre.frames(wait=0.01)) == []
+
+def test_reset_and_stop():
+    pre = preroll_buffer(STREAMS, seconds=1, fps=10)
+    for no in range(8):
+        pre.push(no, float(no), images(no))
+    assert [no for no, *_ in pre.frames(stop=lambda i: i >= 5)] == [0, 1, 2, 3, 4]
+    pre.reset()
+    assert list(pre.frames()) == []
+    pre.push(8, 8.0, images(8))
+    assert [no for no, *_ in pre.frames()] == [8]
+
+@pytest.mark.parametrize('compressed', [False, True])
+def test_read_while_pushing(codec, compressed):
+    ''' 読み出し中に上書きされたフレームは返さない (返したものは壊れていない) '''
+    pre = preroll_buffer(STREAMS, seconds=0.5, fps=10, codec=codec if compressed else None, margin=1)
+    for no in range(5):
+        pre.push(no, float(no), images(no))
+    settle(pre)
+    done = threading.Event()
+    def pusher():
+        for no in range(5, 3000):
+            pre.push(no, float(no), images(no))
+        done.set()
+    th = threading.Thread(target=pusher)
+    th.start()
+    n = 0
+    try:
+        while not done.is_set():
+            last = -1
+            for no, ts, imgs, enc in pre.frames(wait=0.01):
+                assert no > last # 古い順, 抜けることはあっても戻らない
+                check(no, imgs)
+                last = no
+                n += 1
+    finally:
+        th.join()
+    assert n > 0
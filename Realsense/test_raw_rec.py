@@ -0,0 +1,127 @@
+# raw_rec.py の書き込み -> 読み込み (合成フレーム, カメラ不要): python3 -m pytest test_raw_rec.py
+import os
+import numpy as np
+import pytest
+from concurrent.futures import Future
+from raw_rec import raw_writer, raw_reader, pack_path, INDEX_DTYPE
+from depth_codec import frame_codec
+
+STREAMS = {
+    'depth': {'shape': (12, 16), 'dtype': '<u2', 'fmt': 'z16'},
+    'color': {'shape': (12, 16, 3), 'dtype': 'u1', 'fmt': 'rgb8'},
+}
+
+def frames(n, seed=0):
+    rng = np.random.default_rng(seed)
+    out = []
+    for i in range(n):
+        depth = (1000 + np.cumsum(rng.integers(-3, 4, (12, 16)), axis=1) + i).astype(np.uint16)
+        color = rng.integers(0, 256, (12, 16, 3), dtype=np.uint8)
+        out.append((100 + i, 33.3 * i, {'depth': depth, 'color': color}))
+    return out
+
+@pytest.fixture
+def codec():
+    c = frame_codec('left', workers=2)
+    yield c
+    c.close()
+
+def write(path, data, codec=None, close=True, fps=4):
+    w = raw_writer(str(path), STREAMS, frames_per_segment=fps, codec=codec)
+    for no, ts, images in data:
+        w.write(no, ts, images)
+    if close: w.close()
+    return w
+
+def check(reader, data):
+    assert len(reader) == len(data)
+    for i, (no, ts, images) in enumerate(data):
+        f = reader[i]
+        assert f['frame_no'] == no and f['timestamp'] == ts
+        for name, img in images.items():
+            assert np.array_equal(f[name], img), (i, name)
+
+@pytest.mark.parametrize('compressed', [False, True])
+def test_round_trip(tmp_path, codec, compressed):
+    data = frames(10) # 3 セグメント (最後は途中まで)
+    write(tmp_path, data, codec if compressed else None)
+    r = raw_reader(str(tmp_path))
+    check(r, data)
+    assert ('codec' in r.streams['depth']) == compressed
+    assert 'codec' not in r.streams['color']
+    assert r.find_frame_no(105) == 5
+    assert r.at_time(33.3 * 7 + 1)['frame_no'] == 107
+
+def test_last_segment_is_truncated(tmp_path):
+    write(tmp_path, frames(6))
+    size = os.path.getsize(tmp_path / 'color_00001.raw')
+    assert size == 2 * 12 * 16 * 3
+
+class held_codec():
+    ''' release() するまで圧縮が終わらない codec '''
+    def __init__(self, codec):
+        self.codec = codec
+        self.workers = 8 # max_pending に掛からない
+        self.futures = []
+    def params(self):
+        return self.codec.params()
+    def submit(self, img):
+        fut = Future()
+        self.futures.append((fut, self.codec.encode(img)))
+        return fut
+    def release(self):
+        for fut, buf in self.futures:
+            if not fut.done(): fut.set_result(buf)
+
+def test_readable_before_close(tmp_path, codec):
+    data = frames(10)
+    held = held_codec(codec)
+    w = raw_writer(str(tmp_path), STREAMS, frames_per_segment=4, codec=held)
+    for no, ts, images in data[:6]:
+        w.write(no, ts, images)
+    held.release() # frames 0-5 は次の write でまとめて書かれる
+    for no, ts, images in data[6:]:
+        w.write(no, ts, images)
+    # 電源断: close されていない, index は 10 フレーム, 圧縮した depth は 6 フレーム (2 番目のセグメントの途中) まで
+    check(raw_reader(str(tmp_path)), data[:6])
+    held.release()
+    w.close()
+    check(raw_reader(str(tmp_path)), data)
+
+def test_truncated_index(tmp_path, codec):
+    data = frames(10)
+    write(tmp_path, data, codec)
+    index = tmp_path / 'index.bin'
+    os.truncate(index, 7 * INDEX_DTYPE.itemsize + 5) # 8 番目のレコードの途中で切れた
+    r = raw_reader(str(tmp_path))
+    check(r, data[:7])
+
+def test_index_ahead_of_pack(tmp_path, codec):
+    data = frames(10)
+    write(tmp_path, data, codec)
+    pack = pack_path(str(tmp_path), 'depth', 2) # frames 8, 9
+    pos = np.fromfile(pack_path(str(tmp_path), 'depth', 2, '.pos'), np.int64).reshape(-1, 2)
+    os.truncate(pack, pos[1, 0] + 1) # 最後のフレームの中身が途中まで
+    r = raw_reader(str(tmp_path))
+    check(r, data[:9])
+
+def test_encoded_passthrough(tmp_path, codec):
+    data = frames(5)
+    w = raw_writer(str(tmp_path), STREAMS, frames_per_segment=4, codec=codec)
+    assert w.accepts(codec) == ['depth']
+    assert w.accepts(frame_codec('gradient', workers=1)) == []
+    for no, ts, images in data:
+        w.write(no, ts, {'color': images['color']}, {'depth': codec.encode(images['depth'])})
+    w.close()
+    check(raw_reader(str(tmp_path)), data)
+
+def test_dropped_frames_read_as_zero(tmp_path, codec):
+    w = raw_writer(str(tmp_path), STREAMS, frames_per_segment=4, codec=codec, max_pending=1)
+    w.max_pending = 0 # 圧縮が常に追いついていない
+    no, ts, images = frames(1)[0]
+    w.write(no, ts, images)
+    w.close()
+    assert w.dropped == 1
+    f = raw_reader(str(tmp_path))[0]
+    assert not f['depth'].any()
+    assert np.array_equal(f['color'], images['color'])
@@ -0,0 +1,94 @@
+# segment.py のセッション (合成フレーム, カメラ不要): python3 -m pytest test_segment.py
+import os
+import numpy as np
+import pytest
+from segment import segment_writer, session_reader, read_manifest, segments, segment_files
+from depth_codec import frame_codec
+
+STREAMS = {
+    'depth': {'shape': (12, 16), 'dtype': '<u2', 'fmt': 'z16'},
+    'color': {'shape': (12, 16, 3), 'dtype': 'u1', 'fmt': 'rgb8'},
+}
+FRAME_BYTES = 12 * 16 * 2 + 12 * 16 * 3
+
+def frames(n, seed=0):
+    rng = np.random.default_rng(seed)
+    out = []
+    for i in range(n):
+        depth = (1000 + np.cumsum(rng.integers(-3, 4, (12, 16)), axis=1) + i).astype(np.uint16)
+        color = rng.integers(0, 256, (12, 16, 3), dtype=np.uint8)
+        out.append((100 + i, 33.3 * i, {'depth': depth, 'color': color}))
+    return out
+
+def check(reader, data):
+    assert len(reader) == len(data)
+    for i, (no, ts, images) in enumerate(data):
+        f = reader[i]
+        assert f['frame_no'] == no and f['timestamp'] == ts
+        for name, img in images.items():
+            assert np.array_equal(f[name], img), (i, name)
+
+@pytest.fixture
+def codec():
+    c = frame_codec('left', workers=2)
+    yield c
+    c.close()
+
+@pytest.mark.parametrize('compressed', [False, True])
+def test_roll_at_bytes(tmp_path, codec, compressed):
+    data = frames(10)
+    w = segment_writer(str(tmp_path), STREAMS, 'raw', max_bytes=3 * FRAME_BYTES, codec=codec if compressed else None)
+    for no, ts, images in data:
+        w.write(no, ts, images)
+    w.close()
+    segs = read_manifest(str(tmp_path))['segments']
+    assert [s['frames'] for s in segs] == [3, 3, 3, 1] # 圧縮前の大きさで切り替え
+    for a, b in zip(segs, segs[1:]): # 境目でフレームが抜けていない
+        assert b['first_frame'] == a['last_frame'] + 1
+    assert [os.path.basename(f) for f in segment_files(str(tmp_path))] == ['seg_00000', 'seg_00001', 'seg_00002', 'seg_00003']
+    check(session_reader(str(tmp_path)), data)
+
+def test_roll_at_seconds(tmp_path):
+    data = frames(10) # 33.3 ms 間隔
+    w = segment_writer(str(tmp_path), STREAMS, 'raw', max_sec=0.1)
+    for no, ts, images in data:
+        w.write(no, ts, images)
+    w.close()
+    segs = segments(str(tmp_path))
+    assert sum(s['frames'] for s in segs) == 10
+    assert all(s['end_ts'] - s['start_ts'] < 100 for s in segs)
+    r = session_reader(str(tmp_path))
+    check(r, data)
+    assert r.at_time(33.3 * 4 + 1)['frame_no'] == 104
+
+def test_manifest_before_close(tmp_path):
+    data = frames(7)
+    w = segment_writer(str(tmp_path), STREAMS, 'raw', max_bytes=3 * FRAME_BYTES)
+    for no, ts, images in data:
+        w.write(no, ts, images)
+    # 電源断: close されていない
+    segs = segments(str(tmp_path))
+    assert [s['first_frame'] for s in segs] == [100, 103, 106]
+    check(session_reader(str(tmp_path)), data)
+    w.close()
+
+def test_empty_segment_is_skipped(tmp_path):
+    w = segment_writer(str(tmp_path), STREAMS, 'raw', max_bytes=FRAME_BYTES)
+    for no, ts, images in frames(2):
+        w.write(no, ts, images)
+    w._roll() # 切り替えた直後に電源断 (start_ts の無いセグメント)
+    assert len(read_manifest(str(tmp_path))['segments']) == 3
+    assert len(segments(str(tmp_path))) == 2
+    assert len(session_reader(str(tmp_path))) == 2
+    w.close()
+
+def test_encoded_passthrough(tmp_path, codec):
+    data = frames(5)
+    w = segment_writer(str(tmp_path), STREAMS, 'raw', max_bytes=2 * FRAME_BYTES, codec=codec)
+    assert w.accepts(codec) == ['depth']
+    assert segment_writer(str(tmp_path / 'bag'), STREAMS, 'bag').accepts(codec) == []
+    for no, ts, images in data:
+        w.write(no, ts, {'color': images['color']}, {'depth': codec.encode(images['depth'])})
+    w.close()
+    assert [s['frames'] for s in segments(str(tmp_path))] == [2, 2, 1] # 圧縮前の大きさで数える
+    check(session_reader(str(tmp_path)), data)